@@ -0,0 +1,487 @@
+"""
+Restore the custom nodes of a ComfyUI-Manager snapshot
+
+Unlike `comfy node restore-snapshot`, custom nodes that are already installed at the
+commit of the snapshot are skipped, the others are cloned (or downloaded from the
+registry) in parallel and the requirements of all of them are installed with one pip
+call. A wheel folder with prebuilt wheels, e.g. on the network volume, is used before
+the package index.
+
+Usage:
+    python3 restore_snapshot.py /snapshot.json --workspace /comfyui
+    python3 restore_snapshot.py /snapshot.json --wheel-dir /runpod-volume/wheels
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Folder of ComfyUI, which contains the "custom_nodes"
+COMFY_WORKSPACE = os.environ.get("COMFY_WORKSPACE", "/comfyui")
+# Folder with prebuilt wheels of the requirements, e.g. made with "pip wheel -w"
+SNAPSHOT_WHEEL_DIR = os.environ.get("SNAPSHOT_WHEEL_DIR")
+# Number of custom nodes that are cloned at the same time
+SNAPSHOT_JOBS = int(os.environ.get("SNAPSHOT_JOBS", 8))
+# The registry of the "cnr_custom_nodes" of a snapshot
+COMFY_REGISTRY_URL = os.environ.get("COMFY_REGISTRY_URL", "https://api.comfy.org")
+# Time to wait for the registry in seconds
+REGISTRY_TIMEOUT_S = 60
+
+
+def log(message):
+    print(f"runpod-worker-comfy - {message}", flush=True)
+
+
+def run(command, cwd=None):
+    """
+    Run a command and fail with its output
+
+    Args:
+        command (list): The command and its arguments
+        cwd (str, optional): The working directory
+
+    Returns:
+        str: The output of the command
+    """
+    result = subprocess.run(
+        command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed: {result.stdout.strip()}")
+    return result.stdout
+
+
+def node_name(url):
+    """
+    Returns:
+        str: The folder of a custom node in "custom_nodes", named after its repository
+    """
+    name = url.rstrip("/").rsplit("/", 1)[-1]
+    return name[:-4] if name.endswith(".git") else name
+
+
+def get_commit(path):
+    """
+    Returns:
+        str: The commit that is checked out in a git repository or None
+    """
+    if not os.path.isdir(os.path.join(path, ".git")):
+        return None
+    try:
+        return run(["git", "rev-parse", "HEAD"], cwd=path).strip()
+    except RuntimeError:
+        return None
+
+
+def plan_nodes(snapshot, custom_nodes_path):
+    """
+    Compare the custom nodes of a snapshot with the installed ones
+
+    Args:
+        snapshot (dict): The snapshot of ComfyUI-Manager
+        custom_nodes_path (str): The "custom_nodes" folder of ComfyUI
+
+    Returns:
+        list: A dict per custom node with its "name", "url", "hash", "path" and the
+              "action": "skip" if it is installed, "checkout" if it is installed at
+              another commit, "clone" if it is missing or "disabled". The nodes from
+              the registry have a "version" instead of "url" and "hash" and the
+              action "install" if they are missing or installed in another version.
+    """
+    nodes = []
+    for url, info in snapshot.get("git_custom_nodes", {}).items():
+        path = os.path.join(custom_nodes_path, node_name(url))
+        commit = get_commit(path)
+        if info.get("disabled"):
+            action = "disabled"
+        elif commit is None:
+            action = "clone"
+        elif commit != info.get("hash"):
+            action = "checkout"
+        else:
+            action = "skip"
+        nodes.append(
+            {
+                "name": node_name(url),
+                "url": url,
+                "hash": info.get("hash"),
+                "path": path,
+                "action": action,
+            }
+        )
+    for name, version in snapshot.get("cnr_custom_nodes", {}).items():
+        path = os.path.join(custom_nodes_path, name)
+        installed = get_node_version(path)
+        nodes.append(
+            {
+                "name": name,
+                "version": version,
+                "path": path,
+                "action": "skip" if installed == version else "install",
+            }
+        )
+    return nodes
+
+
+def get_node_version(path):
+    """
+    Returns:
+        str: The version in the pyproject.toml of a custom node from the registry or
+             None if it is not installed
+    """
+    try:
+        with open(os.path.join(path, "pyproject.toml")) as f:
+            content = f.read()
+    except OSError:
+        return None
+    project = re.search(r"^\[project\]$(.*?)(?=^\[|\Z)", content, re.M | re.S)
+    version = re.search(r'^version\s*=\s*"([^"]+)"', project.group(1) if project else "", re.M)
+    return version.group(1) if version else None
+
+
+def is_shallow(path):
+    """
+    Returns:
+        bool: True if the git repository only has a part of the history
+    """
+    return run(["git", "rev-parse", "--is-shallow-repository"], cwd=path).strip() == "true"
+
+
+def restore_node(node):
+    """
+    Clone a custom node or check out the commit of the snapshot. Only the commit
+    itself is fetched, the whole repository only if the server doesn't allow that.
+
+    Args:
+        node (dict): A custom node of plan_nodes
+    """
+    path = node["path"]
+    if node["action"] == "clone":
+        if os.path.exists(path):
+            raise RuntimeError(f"{path} exists, but is not a git repository")
+        os.makedirs(path)
+        run(["git", "init", "-q"], cwd=path)
+        run(["git", "remote", "add", "origin", node["url"]], cwd=path)
+
+    if not node["hash"]:
+        run(["git", "fetch", "-q", "--depth", "1", "origin", "HEAD"], cwd=path)
+    else:
+        try:
+            run(["git", "fetch", "-q", "--depth", "1", "origin", node["hash"]], cwd=path)
+        except RuntimeError:
+            # The server doesn't allow to fetch a commit by its hash
+            unshallow = ["--unshallow"] if is_shallow(path) else []
+            run(["git", "fetch", "-q", *unshallow, "origin"], cwd=path)
+    run(["git", "checkout", "-q", "--force", node["hash"] or "FETCH_HEAD"], cwd=path)
+    if os.path.isfile(os.path.join(path, ".gitmodules")):
+        run(["git", "submodule", "update", "-q", "--init", "--recursive"], cwd=path)
+
+
+def install_registry_node(node):
+    """
+    Download the version of a custom node of the snapshot from the registry, like
+    ComfyUI-Manager does, and replace the installed version with it
+
+    Args:
+        node (dict): A custom node of plan_nodes with a "version"
+    """
+    name = urllib.parse.quote(node["name"])
+    version = urllib.parse.quote(node["version"])
+    url = f"{COMFY_REGISTRY_URL}/nodes/{name}/install?version={version}"
+    path = node["path"]
+    # The installed version is only replaced when the new one was extracted
+    temporary = f"{path}.download"
+    shutil.rmtree(temporary, ignore_errors=True)
+    try:
+        with urllib.request.urlopen(url, timeout=REGISTRY_TIMEOUT_S) as response:
+            download_url = json.load(response)["downloadUrl"]
+        with tempfile.TemporaryFile() as f:
+            with urllib.request.urlopen(download_url, timeout=REGISTRY_TIMEOUT_S) as response:
+                shutil.copyfileobj(response, f)
+            with zipfile.ZipFile(f) as archive:
+                archive.extractall(temporary)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise RuntimeError(f"{node['name']} {node['version']} could not be downloaded: {e}")
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary, path)
+
+
+def read_requirements(path):
+    """
+    Returns:
+        list: The requirements in a requirements.txt, without comments
+    """
+    try:
+        with open(path) as f:
+            lines = [line.split("#", 1)[0].strip() for line in f]
+    except OSError:
+        return []
+    return [line for line in lines if line]
+
+
+def canonical_name(name):
+    return name.lower().replace("_", "-").replace(".", "-")
+
+
+def get_installed_packages(python):
+    """
+    Returns:
+        dict: The version of every package of a Python by its canonical name
+    """
+    output = run(pip_command(python, "list", "--format", "json"))
+    return {canonical_name(p["name"]): p["version"] for p in json.loads(output)}
+
+
+def missing_pips(pips, installed):
+    """
+    Find the pinned packages of the snapshot that are not installed in that version.
+    Packages from URLs are skipped, like `--pip-non-url` does.
+
+    Args:
+        pips (dict): The "pips" of the snapshot, e.g. {"aiohttp==3.11.2": ""}
+        installed (dict): See get_installed_packages
+
+    Returns:
+        list: The requirements that have to be installed
+    """
+    missing = []
+    for requirement in pips:
+        name, separator, version = requirement.partition("==")
+        if not separator or "://" in requirement or requirement.startswith("-"):
+            continue
+        if installed.get(canonical_name(name.strip())) != version.strip():
+            missing.append(requirement)
+    return missing
+
+
+def pip_command(python, *args):
+    """
+    Returns:
+        list: The command to run pip for the environment of another Python
+    """
+    command = [sys.executable, "-m", "pip"]
+    # Not resolved, the Python of a virtual environment is a link to another one
+    if python and os.path.abspath(python) != os.path.abspath(sys.executable):
+        command += ["--python", python]
+    return command + list(args)
+
+
+def install_requirements(
+    requirements, python=None, wheel_dir=None, offline=False, no_deps=False
+):
+    """
+    Install requirements with one pip call. The wheels in the wheel folder are
+    preferred, the other packages come from the package index.
+
+    Args:
+        requirements (list): The requirements, e.g. "numpy>=1.25"
+        python (str, optional): The Python to install them for
+        wheel_dir (str, optional): A folder with prebuilt wheels, which is ignored
+                                   while it doesn't contain any
+        offline (bool, optional): Only install from the wheel folder
+        no_deps (bool, optional): Don't install the dependencies of the requirements
+    """
+    if not requirements:
+        return
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        f.write("\n".join(requirements) + "\n")
+    options = ["--no-deps"] if no_deps else []
+    if offline:
+        options += ["--no-index"]
+    if wheel_dir and has_wheels(wheel_dir):
+        options += ["--find-links", wheel_dir]
+    try:
+        run(pip_command(python, "install", "-q", *options, "-r", f.name))
+    finally:
+        os.remove(f.name)
+
+
+def has_wheels(folder):
+    """
+    Returns:
+        bool: If the folder exists and contains at least one wheel
+    """
+    try:
+        return any(name.endswith(".whl") for name in os.listdir(folder))
+    except OSError:
+        return False
+
+
+def install_pins(pins, python=None, wheel_dir=None, offline=False):
+    """
+    Install the pinned packages of a snapshot without their dependencies. When that
+    fails, e.g. because a snapshot that was made on Windows contains pywin32, they are
+    installed one at a time and the ones that fail are skipped.
+
+    Args:
+        pins (list): The requirements, e.g. "aiohttp==3.11.2"
+        python (str, optional): The Python to install them for
+        wheel_dir (str, optional): The folder where the wheels are kept
+        offline (bool, optional): Only install from the wheel folder
+
+    Returns:
+        list: The pins that could not be installed
+    """
+    try:
+        install_requirements(pins, python, wheel_dir, offline, no_deps=True)
+        return []
+    except RuntimeError:
+        log("could not install the pinned packages at once, installing them one at a time")
+    failed = []
+    for pin in pins:
+        try:
+            install_requirements([pin], python, wheel_dir, offline, no_deps=True)
+        except RuntimeError as e:
+            log(f"skipping {pin}: {str(e).splitlines()[-1]}")
+            failed.append(pin)
+    return failed
+
+
+def restore_snapshot(
+    path, workspace=COMFY_WORKSPACE, jobs=SNAPSHOT_JOBS, wheel_dir=None, python=None, offline=False
+):
+    """
+    Restore the custom nodes and packages of a snapshot
+
+    Args:
+        path (str): The snapshot file
+        workspace (str): The folder of ComfyUI
+        jobs (int): The number of custom nodes that are cloned at the same time
+        wheel_dir (str, optional): The folder where the wheels are kept
+        python (str, optional): The Python of ComfyUI, defaults to this one
+        offline (bool, optional): Only install packages from the wheel folder
+
+    Returns:
+        dict: The "action", "seconds" and "error" of every custom node, the number of
+              "packages" and "seconds" of pip, and the "total_seconds"
+    """
+    started = time.monotonic()
+    with open(path) as f:
+        snapshot = json.load(f)
+    python = python or sys.executable
+    custom_nodes_path = os.path.join(workspace, "custom_nodes")
+    os.makedirs(custom_nodes_path, exist_ok=True)
+
+    comfy_commit = get_commit(workspace)
+    if snapshot.get("comfyui") and comfy_commit and comfy_commit != snapshot["comfyui"]:
+        log(f"ComfyUI is at {comfy_commit}, the snapshot was made with {snapshot['comfyui']}")
+    for node in snapshot.get("file_custom_nodes", []):
+        log(f"skipping {node.get('filename')}, single file nodes have to be copied")
+
+    nodes = plan_nodes(snapshot, custom_nodes_path)
+    report = {"nodes": {}, "pip": {}}
+
+    def restore(node):
+        node_started = time.monotonic()
+        result = {"action": node["action"]}
+        if node["action"] in ("clone", "checkout", "install"):
+            try:
+                if node["action"] == "install":
+                    install_registry_node(node)
+                else:
+                    restore_node(node)
+            except (RuntimeError, OSError) as e:
+                result["error"] = str(e)
+                # Don't leave a broken repository behind, the next restore clones it
+                if node["action"] == "clone":
+                    shutil.rmtree(node["path"], ignore_errors=True)
+        result["seconds"] = round(time.monotonic() - node_started, 2)
+        return node, result
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for node, result in executor.map(restore, nodes):
+            report["nodes"][node["name"]] = result
+            log(f"{node['name']}: {result['action']} ({result['seconds']}s)")
+
+    changed = [
+        node
+        for node in nodes
+        if node["action"] in ("clone", "checkout", "install")
+        and "error" not in report["nodes"][node["name"]]
+    ]
+    requirements = []
+    for node in changed:
+        requirements += read_requirements(os.path.join(node["path"], "requirements.txt"))
+    requirements = list(dict.fromkeys(requirements))
+
+    pip_started = time.monotonic()
+    try:
+        install_requirements(requirements, python, wheel_dir, offline)
+        # The pips of the snapshot are the complete list of packages, their
+        # dependencies don't have to be resolved again
+        pips = missing_pips(snapshot.get("pips", {}), get_installed_packages(python))
+        failed = install_pins(pips, python, wheel_dir, offline)
+        report["pip"]["packages"] = len(requirements) + len(pips) - len(failed)
+        if failed:
+            report["pip"]["skipped"] = failed
+    except RuntimeError as e:
+        report["pip"]["error"] = str(e)
+    report["pip"]["seconds"] = round(time.monotonic() - pip_started, 2)
+    log(f"pip: {report['pip'].get('packages', 0)} package(s) ({report['pip']['seconds']}s)")
+
+    # Like ComfyUI-Manager, run the install scripts after the requirements
+    for node in changed:
+        script = os.path.join(node["path"], "install.py")
+        if not os.path.isfile(script):
+            continue
+        script_started = time.monotonic()
+        result = report["nodes"][node["name"]]
+        try:
+            run([python, "install.py"], cwd=node["path"])
+        except RuntimeError as e:
+            result["error"] = str(e)
+        result["seconds"] = round(result["seconds"] + time.monotonic() - script_started, 2)
+
+    report["total_seconds"] = round(time.monotonic() - started, 2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("snapshot", help="The snapshot file of ComfyUI-Manager")
+    parser.add_argument("--workspace", default=COMFY_WORKSPACE, help="The folder of ComfyUI")
+    parser.add_argument("--jobs", type=int, default=SNAPSHOT_JOBS, help="Parallel clones")
+    parser.add_argument("--wheel-dir", default=SNAPSHOT_WHEEL_DIR, help="Install the wheels in this folder")
+    parser.add_argument("--offline", action="store_true", help="Only use the wheel folder")
+    parser.add_argument("--python", help="The Python of ComfyUI, defaults to this one")
+    parser.add_argument("--report", help="Save the timings as JSON to this file")
+    args = parser.parse_args(argv)
+
+    report = restore_snapshot(
+        args.snapshot,
+        workspace=args.workspace,
+        jobs=args.jobs,
+        wheel_dir=args.wheel_dir,
+        python=args.python,
+        offline=args.offline,
+    )
+    log(f"restored {args.snapshot} in {report['total_seconds']}s")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = [name for name, node in report["nodes"].items() if "error" in node]
+    if failed or "error" in report["pip"]:
+        for name in failed:
+            log(f"{name} failed: {report['nodes'][name]['error']}")
+        if "error" in report["pip"]:
+            log(f"pip failed: {report['pip']['error']}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
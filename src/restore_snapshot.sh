@@ -11,6 +11,8 @@ fi
 
 echo "runpod-worker-comfy: restoring snapshot: $SNAPSHOT_FILE"
 
-comfy --workspace /comfyui node restore-snapshot "$SNAPSHOT_FILE" --pip-non-url
+# Skips the custom nodes that are already installed and clones the others in parallel,
+# set SNAPSHOT_WHEEL_DIR to install their requirements from a folder of prebuilt wheels
+python3 "$(dirname "$0")/restore_snapshot.py" "$SNAPSHOT_FILE" --workspace /comfyui
 
 echo "runpod-worker-comfy: restored snapshot file: $SNAPSHOT_FILE"
\ No newline at end of file
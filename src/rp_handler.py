@@ -1,29 +1,941 @@
+import asyncio
 import runpod
 from runpod.serverless.utils import rp_upload
 import json
-import urllib.request
-import urllib.parse
 import time
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import base64
-from io import BytesIO
+import binascii
+import hashlib
+import mimetypes
+import shutil
+import tempfile
+import threading
+import uuid
+import websocket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
+# Time in seconds that jobs wait for ComfyUI to start, before the worker gives up
+COMFY_STARTUP_TIMEOUT_S = float(os.environ.get("COMFY_STARTUP_TIMEOUT_S", 120))
 # Maximum number of API check attempts
-COMFY_API_AVAILABLE_MAX_RETRIES = 500
+COMFY_API_AVAILABLE_MAX_RETRIES = max(
+    int(COMFY_STARTUP_TIMEOUT_S * 1000 / COMFY_API_AVAILABLE_INTERVAL_MS), 1
+)
+# Number of API check attempts once ComfyUI was reachable before, to fail fast
+COMFY_API_FAILFAST_RETRIES = int(os.environ.get("COMFY_API_FAILFAST_RETRIES", 3))
+# Time in seconds for which a successful check of the ComfyUI API is trusted
+COMFY_HEALTH_TTL_S = float(os.environ.get("COMFY_HEALTH_TTL_S", 30))
 # Time to wait between poll attempts in milliseconds
 COMFY_POLLING_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 250))
 # Maximum number of poll attempts
 COMFY_POLLING_MAX_RETRIES = int(os.environ.get("COMFY_POLLING_MAX_RETRIES", 500))
+# How to wait for a queued workflow: "websocket" (falls back to polling) or "polling"
+COMFY_COMPLETION_MODE = os.environ.get("COMFY_COMPLETION_MODE", "websocket").lower()
+# Time to wait for a single WebSocket message before checking the history in seconds
+COMFY_WEBSOCKET_RECV_TIMEOUT_S = float(
+    os.environ.get("COMFY_WEBSOCKET_RECV_TIMEOUT_S", 10)
+)
+# Maximum time a job may take in seconds, jobs can set their own "timeout"; 0 means
+# that only COMFY_POLLING_INTERVAL_MS * COMFY_POLLING_MAX_RETRIES limits the wait
+COMFY_JOB_TIMEOUT_S = float(os.environ.get("COMFY_JOB_TIMEOUT_S", 0))
+# Time between checks if a job was cancelled or its deadline passed in seconds
+CANCEL_CHECK_INTERVAL_S = 1
+# Time between two checks of the status of a running job with the RunPod API in seconds,
+# its prompt is stopped when the job was cancelled. Needs RUNPOD_API_KEY; 0 disables it
+COMFY_CANCEL_POLL_S = float(os.environ.get("COMFY_CANCEL_POLL_S", 10))
+# The status of a job is requested from <RUNPOD_API_URL>/<endpoint id>/status/<job id>
+RUNPOD_API_URL = os.environ.get("RUNPOD_API_URL", "https://api.runpod.ai/v2")
+# Job statuses of the RunPod API that stop the prompt of a running job
+RUNPOD_STOPPED_STATUSES = {"CANCELLED", "TIMED_OUT"}
+# Time to wait for an interrupted prompt to show up in the history in seconds
+COMFY_INTERRUPT_TIMEOUT_S = 5
+# Send the progress of running jobs to RunPod with progress_update
+COMFY_PROGRESS_UPDATES = os.environ.get("COMFY_PROGRESS_UPDATES", "true").lower() == "true"
+# Minimum time between two progress updates of a job in seconds
+COMFY_PROGRESS_INTERVAL_S = float(os.environ.get("COMFY_PROGRESS_INTERVAL_S", 1))
+# Stream the progress and every output file as soon as it was saved, instead of
+# returning all outputs at the end, see stream_handler
+COMFY_STREAM_OUTPUTS = os.environ.get("COMFY_STREAM_OUTPUTS", "false").lower() == "true"
+# Forward the preview images of the sampler, ComfyUI only creates them when it is
+# started with --preview-method
+COMFY_STREAM_PREVIEWS = os.environ.get("COMFY_STREAM_PREVIEWS", "false").lower() == "true"
+# The first 4 bytes of a binary WebSocket message with a preview image
+PREVIEW_IMAGE_EVENT = (1).to_bytes(4, "big")
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
+# ComfyUI servers that the jobs are distributed to, comma separated "host:port" or
+# "host:port=output_path", e.g. one per GPU. Defaults to COMFY_HOST
+COMFY_BACKENDS = os.environ.get("COMFY_BACKENDS", "")
+# Number of running jobs that a backend, which has already loaded the models of a
+# job, is preferred over a less busy one
+COMFY_AFFINITY_WEIGHT = float(os.environ.get("COMFY_AFFINITY_WEIGHT", 1))
+# Number of the most recently used models of a backend that are assumed to be loaded
+BACKEND_RECENT_MODELS = 4
+# Host names of ComfyUI servers that share the input folder of the worker
+LOCAL_HOSTNAMES = ("127.0.0.1", "localhost", "::1")
+# Time to wait for a connection to ComfyUI to be established in seconds
+COMFY_CONNECT_TIMEOUT_S = float(os.environ.get("COMFY_CONNECT_TIMEOUT_S", 5))
+# Time to wait for ComfyUI to send a response in seconds
+COMFY_READ_TIMEOUT_S = float(os.environ.get("COMFY_READ_TIMEOUT_S", 60))
+# Maximum number of retries of a single request to ComfyUI
+COMFY_REQUEST_MAX_RETRIES = int(os.environ.get("COMFY_REQUEST_MAX_RETRIES", 3))
+# Base delay between retries in seconds, doubled with every attempt
+COMFY_REQUEST_BACKOFF_S = float(os.environ.get("COMFY_REQUEST_BACKOFF_S", 0.1))
+# Maximum number of keep-alive connections to ComfyUI
+COMFY_POOL_MAXSIZE = int(os.environ.get("COMFY_POOL_MAXSIZE", 10))
+# Status codes that are worth another attempt of a GET request
+COMFY_RETRY_STATUS_CODES = (502, 503, 504)
+# Maximum number of input images that are decoded and uploaded at the same time
+COMFY_UPLOAD_CONCURRENCY = int(os.environ.get("COMFY_UPLOAD_CONCURRENCY", 4))
+# Maximum number of output files that are encoded or uploaded at the same time
+COMFY_OUTPUT_CONCURRENCY = int(os.environ.get("COMFY_OUTPUT_CONCURRENCY", 4))
+# Size of the chunks in which output files are read for base64 encoding in bytes,
+# a multiple of 3 so that the encoded chunks can be concatenated
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024
+# Formats that outputs can be re-encoded to, with the matching file extension
+OUTPUT_FORMATS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+# Quality of re-encoded JPEG and WebP outputs if none is requested
+DEFAULT_OUTPUT_QUALITY = 90
+# Check the workflow against the nodes and models of ComfyUI before queuing it
+COMFY_VALIDATE_WORKFLOW = (
+    os.environ.get("COMFY_VALIDATE_WORKFLOW", "true").lower() == "true"
+)
+# Folder with the models of ComfyUI
+COMFY_MODELS_PATH = os.environ.get("COMFY_MODELS_PATH", "/comfyui/models")
+# Additional model folders of ComfyUI, e.g. on the network volume
+COMFY_EXTRA_MODEL_PATHS = os.environ.get(
+    "COMFY_EXTRA_MODEL_PATHS", "/comfyui/extra_model_paths.yaml"
+)
+# Model inputs of the loader nodes and the type of model they load
+MODEL_LOADERS = {
+    "CheckpointLoaderSimple": {"ckpt_name": "checkpoints"},
+    "CheckpointLoader": {"ckpt_name": "checkpoints", "config_name": "configs"},
+    "LoraLoader": {"lora_name": "loras"},
+    "LoraLoaderModelOnly": {"lora_name": "loras"},
+    "VAELoader": {"vae_name": "vae"},
+    "ControlNetLoader": {"control_net_name": "controlnet"},
+    "UNETLoader": {"unet_name": "unet"},
+    "CLIPLoader": {"clip_name": "clip"},
+    "DualCLIPLoader": {"clip_name1": "clip", "clip_name2": "clip"},
+    "CLIPVisionLoader": {"clip_name": "clip_vision"},
+    "UpscaleModelLoader": {"model_name": "upscale_models"},
+    "StyleModelLoader": {"style_model_name": "style_models"},
+}
+# Folders of a model type in COMFY_MODELS_PATH, including their newer names
+MODEL_FOLDERS = {"unet": ("unet", "diffusion_models"), "clip": ("clip", "text_encoders")}
+# Checkpoints that are loaded by a minimal workflow before the first job, comma separated
+COMFY_WARMUP_MODELS = [
+    name.strip() for name in os.environ.get("COMFY_WARMUP_MODELS", "").split(",") if name.strip()
+]
+# JSON file with the workflow that is used for the warm-up, see WARMUP_WORKFLOW
+COMFY_WARMUP_WORKFLOW = os.environ.get("COMFY_WARMUP_WORKFLOW")
+# Time in seconds that the warm-up of each model may take
+COMFY_WARMUP_TIMEOUT_S = float(os.environ.get("COMFY_WARMUP_TIMEOUT_S", 300))
+# Read the files of the warm-up models into the page cache before they are loaded
+COMFY_PRELOAD_MODELS = os.environ.get("COMFY_PRELOAD_MODELS", "false").lower() == "true"
+# Number of model files that are read at the same time
+COMFY_PRELOAD_CONCURRENCY = int(os.environ.get("COMFY_PRELOAD_CONCURRENCY", 4))
+# Size of the reads of the preload
+PRELOAD_CHUNK_SIZE = 16 * 1024 * 1024
+# The workflow of test_input.json with 1 step at 64x64, the ckpt_name of every
+# checkpoint loader is replaced with the model that is warmed up
+WARMUP_WORKFLOW = {
+    "3": {
+        "inputs": {
+            "seed": 0,
+            "steps": 1,
+            "cfg": 8,
+            "sampler_name": "euler",
+            "scheduler": "normal",
+            "denoise": 1,
+            "model": ["4", 0],
+            "positive": ["6", 0],
+            "negative": ["7", 0],
+            "latent_image": ["5", 0],
+        },
+        "class_type": "KSampler",
+    },
+    "4": {"inputs": {"ckpt_name": ""}, "class_type": "CheckpointLoaderSimple"},
+    "5": {"inputs": {"width": 64, "height": 64, "batch_size": 1}, "class_type": "EmptyLatentImage"},
+    "6": {"inputs": {"text": "warm-up", "clip": ["4", 1]}, "class_type": "CLIPTextEncode"},
+    "7": {"inputs": {"text": "", "clip": ["4", 1]}, "class_type": "CLIPTextEncode"},
+    "8": {"inputs": {"samples": ["3", 0], "vae": ["4", 2]}, "class_type": "VAEDecode"},
+    # Writes to the temp folder of ComfyUI instead of the output folder
+    "9": {"inputs": {"images": ["8", 0]}, "class_type": "PreviewImage"},
+}
+# Cache the outputs of deterministic workflows: "disk", "volume" or disabled if empty
+COMFY_RESULT_CACHE = os.environ.get("COMFY_RESULT_CACHE", "").lower()
+# Folder of the result cache, defaults to a local folder or one on the network volume
+COMFY_RESULT_CACHE_PATH = os.environ.get("COMFY_RESULT_CACHE_PATH")
+# Maximum size of the result cache in MB
+COMFY_RESULT_CACHE_MAX_MB = int(os.environ.get("COMFY_RESULT_CACHE_MAX_MB", 2048))
+# Default folders of the result cache backends
+RESULT_CACHE_PATHS = {
+    "disk": "/tmp/runpod-worker-comfy/result-cache",
+    "volume": "/runpod-volume/runpod-worker-comfy/result-cache",
+}
+# Inputs that contain the seed of a node
+SEED_INPUTS = ("seed", "noise_seed")
+# Comma separated folders with workflow templates, one JSON file per template that is
+# named after the file, see load_templates
+COMFY_TEMPLATES_PATH = os.environ.get(
+    "COMFY_TEMPLATES_PATH", "/workflows,/runpod-volume/runpod-worker-comfy/workflows"
+)
+# Name of the AWS S3 bucket, defaults to the current month like rp_upload ("%m-%y")
+BUCKET_NAME = os.environ.get("BUCKET_NAME")
+# Return "presigned" URLs or "public" URLs to the uploaded outputs
+BUCKET_URL_MODE = os.environ.get("BUCKET_URL_MODE", "presigned").lower()
+# Base URL of public outputs, defaults to "<BUCKET_ENDPOINT_URL>/<bucket>"
+BUCKET_PUBLIC_URL = os.environ.get("BUCKET_PUBLIC_URL")
+# Time until a presigned URL expires in seconds
+BUCKET_PRESIGNED_URL_EXPIRES_S = int(
+    os.environ.get("BUCKET_PRESIGNED_URL_EXPIRES_S", 604800)
+)
+# Outputs of at least this size in MB are uploaded in parts
+BUCKET_MULTIPART_THRESHOLD_MB = int(os.environ.get("BUCKET_MULTIPART_THRESHOLD_MB", 8))
+# Size of a single part of a multipart upload in MB
+BUCKET_MULTIPART_CHUNKSIZE_MB = int(os.environ.get("BUCKET_MULTIPART_CHUNKSIZE_MB", 8))
+# Maximum number of parts of one output that are uploaded at the same time
+BUCKET_UPLOAD_CONCURRENCY = int(os.environ.get("BUCKET_UPLOAD_CONCURRENCY", 8))
+# Folder where ComfyUI stores the uploaded input images
+COMFY_INPUT_PATH = os.environ.get("COMFY_INPUT_PATH", "/comfyui/input")
+# Maximum size of the input images that are kept for reuse in MB, 0 disables it
+COMFY_INPUT_CACHE_MAX_MB = int(os.environ.get("COMFY_INPUT_CACHE_MAX_MB", 1024))
+# Size of the chunks in which input images are decoded while uploading in bytes
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Folder where the input images that are fetched from a 'url' are kept for reuse
+COMFY_URL_CACHE_PATH = os.environ.get(
+    "COMFY_URL_CACHE_PATH", "/tmp/runpod-worker-comfy/url-cache"
+)
+# Maximum size of the input images from URLs that are kept in MB, 0 disables it
+COMFY_URL_CACHE_MAX_MB = int(os.environ.get("COMFY_URL_CACHE_MAX_MB", 2048))
+# Maximum time to fetch an input image from a URL in seconds
+COMFY_URL_TIMEOUT_S = float(os.environ.get("COMFY_URL_TIMEOUT_S", 60))
+# Maximum size of an input image from a URL in MB
+COMFY_URL_MAX_MB = int(os.environ.get("COMFY_URL_MAX_MB", 100))
+# Schemes of the URLs that input images can be fetched from
+URL_SCHEMES = ("http", "https", "s3")
+# File signatures used to detect the MIME type of input images
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+)
+# Remove the input images and output files of a job once its result is returned
+COMFY_CLEANUP_FILES = os.environ.get("COMFY_CLEANUP_FILES", "true").lower() == "true"
+# Copy the output files into this folder, e.g. on the network volume, instead of
+# returning them as base64
+OUTPUT_VOLUME_PATH = os.environ.get("OUTPUT_VOLUME_PATH")
+# The temp folder of ComfyUI, e.g. for preview images
+COMFY_TEMP_PATH = os.environ.get("COMFY_TEMP_PATH", "/comfyui/temp")
+# Time between two runs of the janitor that removes old files in seconds, 0 disables it
+COMFY_JANITOR_INTERVAL_S = float(os.environ.get("COMFY_JANITOR_INTERVAL_S", 600))
+# Files that the worker created in the input, output and temp folder of ComfyUI that
+# are older than this are removed by the janitor, in seconds
+COMFY_JANITOR_MAX_AGE_S = float(os.environ.get("COMFY_JANITOR_MAX_AGE_S", 3600))
+# Maximum size of the files that the worker created in the input, output and temp
+# folder of ComfyUI in MB, the janitor removes the oldest files first
+COMFY_JANITOR_MAX_MB = int(os.environ.get("COMFY_JANITOR_MAX_MB", 4096))
+# Folder inside of COMFY_INPUT_PATH that keeps cached input images between jobs
+INPUT_CACHE_FOLDER = ".cache"
+# Maximum number of jobs that the worker handles at the same time. With more than one,
+# the next job is queued in ComfyUI while the outputs of the last one are processed.
+# Defaults to one job per backend
+COMFY_MAX_CONCURRENT_JOBS = int(
+    os.environ.get(
+        "COMFY_MAX_CONCURRENT_JOBS",
+        max(len([host for host in COMFY_BACKENDS.split(",") if host.strip()]), 1),
+    )
+)
+# Time in milliseconds that a job waits for compatible jobs, which are run as one
+# prompt in ComfyUI, while another batch is running. 0 disables the batching
+COMFY_BATCH_WINDOW_MS = int(os.environ.get("COMFY_BATCH_WINDOW_MS", 0))
+# Maximum number of jobs in one batch
+COMFY_BATCH_MAX_JOBS = int(os.environ.get("COMFY_BATCH_MAX_JOBS", 4))
+# Inputs that define the size of the images of a workflow
+BATCH_SIZE_INPUTS = ("width", "height", "batch_size")
+# Add the durations of the stages of every job to its result under "metrics",
+# jobs can also ask for them with "metrics": true in their input
+COMFY_RETURN_METRICS = os.environ.get("COMFY_RETURN_METRICS", "false").lower() == "true"
+# Print the durations of the stages of every job as a JSON log line
+COMFY_METRICS_LOG = os.environ.get("COMFY_METRICS_LOG", "true").lower() == "true"
+# Port of the Prometheus endpoint /metrics of the worker, 0 disables it
+COMFY_METRICS_PORT = int(os.environ.get("COMFY_METRICS_PORT", 0))
+# Upper bounds of the buckets of the Prometheus histograms in seconds
+METRICS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
 # Enforce a clean state after each job is done
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
 
 
+def create_session():
+    """
+    Create the HTTP session that is shared by all requests to ComfyUI
+
+    Returns:
+        requests.Session: A session that keeps the connections to ComfyUI alive
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=COMFY_POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    return session
+
+
+# One session for the lifetime of the worker, so that connections are reused
+SESSION = create_session()
+# Session for fetching input images from URLs, separate from the one to ComfyUI
+URL_SESSION = requests.Session()
+URL_SESSION.mount("http://", HTTPAdapter(pool_maxsize=COMFY_UPLOAD_CONCURRENCY))
+URL_SESSION.mount("https://", HTTPAdapter(pool_maxsize=COMFY_UPLOAD_CONCURRENCY))
+
+# Health of ComfyUI as seen by this worker: "unknown" until the first check,
+# then "healthy" or "unhealthy" depending on the last check or request
+COMFY_HEALTH = {"state": "unknown", "checked_at": 0.0}
+COMFY_HEALTH_LOCK = threading.Lock()
+
+
+class ComfyBackend:
+    """
+    A ComfyUI server that runs jobs, see COMFY_BACKENDS
+
+    Args:
+        host (str, optional): The host and port, defaults to COMFY_HOST
+        output_path (str, optional): The output folder of this server, defaults to
+                                     COMFY_OUTPUT_PATH
+        health (dict, optional): The health of the server, see COMFY_HEALTH
+    """
+
+    def __init__(self, host=None, output_path=None, health=None):
+        self.host = host
+        self.output_path = output_path
+        self.health = health if health is not None else {"state": "unknown", "checked_at": 0.0}
+        # Background thread that waits for the server to start, see start_health_probe
+        self.probe = None
+        # Number of jobs that were sent to this server and are not done yet
+        self.outstanding = 0
+        # The most recently used models, the last one is the newest
+        self.models = OrderedDict()
+
+    @property
+    def address(self):
+        return self.host or COMFY_HOST
+
+    @property
+    def local(self):
+        """
+        Returns:
+            bool: If the server runs on this machine, so that it reads its input images
+                  from COMFY_INPUT_PATH
+        """
+        hostname = self.address.rpartition(":")[0] or self.address
+        return hostname.strip("[]") in LOCAL_HOSTNAMES
+
+
+def parse_backends(backends):
+    """
+    Args:
+        backends (str): See COMFY_BACKENDS
+
+    Returns:
+        list: A ComfyBackend per server, the first one shares COMFY_HEALTH
+    """
+    parsed = []
+    for entry in backends.split(","):
+        host, _, output_path = entry.strip().partition("=")
+        if host:
+            parsed.append(ComfyBackend(host, output_path.strip() or None))
+    if not parsed:
+        parsed.append(ComfyBackend())
+    parsed[0].health = COMFY_HEALTH
+    return parsed
+
+
+BACKENDS = parse_backends(COMFY_BACKENDS)
+BACKENDS_LOCK = threading.Lock()
+# The backend of the job that is handled by the current thread, see use_backend
+BACKEND_CONTEXT = threading.local()
+
+
+def get_backend():
+    """
+    Returns:
+        ComfyBackend: The backend of the current job or the first one
+    """
+    return getattr(BACKEND_CONTEXT, "backend", None) or BACKENDS[0]
+
+
+@contextmanager
+def use_backend(backend):
+    """
+    Send all requests to ComfyUI of the current thread to a backend
+
+    Args:
+        backend (ComfyBackend): The backend
+    """
+    previous = getattr(BACKEND_CONTEXT, "backend", None)
+    BACKEND_CONTEXT.backend = backend
+    try:
+        yield backend
+    finally:
+        BACKEND_CONTEXT.backend = previous
+
+
+def get_output_path():
+    """
+    Returns:
+        str: The output folder of the backend of the current job
+    """
+    return get_backend().output_path or os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+
+
+def get_workflow_models(workflow):
+    """
+    Returns:
+        set: The names of the models that the loader nodes of a workflow load
+    """
+    models = set()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs") or {}
+        for name in MODEL_LOADERS.get(node.get("class_type"), {}):
+            if isinstance(inputs.get(name), str):
+                models.add(inputs[name])
+    return models
+
+
+def select_backend(workflow, exclude=()):
+    """
+    Pick the backend for a job: the one with the least outstanding jobs, where a
+    backend that has recently loaded all models of the workflow counts as
+    COMFY_AFFINITY_WEIGHT jobs less busy. Backends that were unhealthy within the
+    last COMFY_HEALTH_TTL_S seconds are skipped, unless all of them are.
+
+    Args:
+        workflow (dict): The workflow of the job
+        exclude (tuple, optional): Backends that must not be used
+
+    Returns:
+        ComfyBackend: The backend, which has to be released with release_backend
+    """
+    models = get_workflow_models(workflow)
+    now = time.monotonic()
+    with BACKENDS_LOCK:
+        candidates = [b for b in BACKENDS if b not in exclude] or list(BACKENDS)
+        healthy = [
+            b
+            for b in candidates
+            if b.health["state"] != "unhealthy"
+            or now - b.health["checked_at"] >= COMFY_HEALTH_TTL_S
+        ]
+
+        def load(backend):
+            affinity = bool(models) and all(m in backend.models for m in models)
+            return backend.outstanding - (COMFY_AFFINITY_WEIGHT if affinity else 0)
+
+        # On a tie the less busy backend wins, so that idle servers are used first
+        backend = min(healthy or candidates, key=lambda b: (load(b), b.outstanding))
+        backend.outstanding += 1
+        for model in models:
+            backend.models.pop(model, None)
+            backend.models[model] = True
+        while len(backend.models) > BACKEND_RECENT_MODELS:
+            backend.models.popitem(last=False)
+    return backend
+
+
+def release_backend(backend):
+    """
+    Args:
+        backend (ComfyBackend): A backend of select_backend, whose job is done
+    """
+    with BACKENDS_LOCK:
+        backend.outstanding -= 1
+
+
+# Background thread that waits for ComfyUI to start, see start_health_probe
+STARTUP_PROBE = None
+# Unix timestamps of the startup of the worker by event, see record_startup.
+# start.sh sets WORKER_STARTED_AT when the container starts and HANDLER_STARTED_AT
+# before it runs the handler
+STARTUP = {
+    event: float(os.environ[name])
+    for event, name in (
+        ("container_started", "WORKER_STARTED_AT"),
+        ("handler_started", "HANDLER_STARTED_AT"),
+    )
+    if os.environ.get(name)
+}
+STARTUP_LOCK = threading.Lock()
+# State of the warm-up: "disabled", "running" or "done", and the duration per model
+WARMUP = {"state": "disabled", "models": {}, "preload_ms": None, "total_ms": None}
+# Background thread that warms up the models, see start_warmup
+WARMUP_THREAD = None
+
+
+def record_startup(event):
+    """
+    Record when an event of the startup happened the first time. Once the first job
+    was accepted, the timeline of the startup is logged.
+
+    Args:
+        event (str): "comfy_listening", "handler_imported" or "first_job_accepted"
+    """
+    with STARTUP_LOCK:
+        if event in STARTUP:
+            return
+        STARTUP[event] = time.time()
+    if event == "first_job_accepted":
+        print("runpod-worker-comfy - startup " + json.dumps(get_startup_timeline()))
+
+
+def get_startup_timeline():
+    """
+    Returns:
+        dict: The seconds from the start of the container, or of the handler if that
+              is not known, to each event of the startup
+    """
+    with STARTUP_LOCK:
+        events = dict(STARTUP)
+    if not events:
+        return {}
+    origin = events.get("container_started", events.get("handler_started", min(events.values())))
+    return {
+        event: round(timestamp - origin, 3)
+        for event, timestamp in sorted(events.items(), key=lambda item: item[1])
+    }
+
+
+def set_comfy_health(healthy):
+    """
+    Record the result of a check of or a request to ComfyUI
+
+    Args:
+        healthy (bool): If ComfyUI responded as expected
+    """
+    health = get_backend().health
+    with COMFY_HEALTH_LOCK:
+        health["state"] = "healthy" if healthy else "unhealthy"
+        health["checked_at"] = time.monotonic()
+
+
+def is_comfy_healthy():
+    """
+    Returns:
+        bool: True if ComfyUI was healthy within the last COMFY_HEALTH_TTL_S seconds
+    """
+    health = get_backend().health
+    with COMFY_HEALTH_LOCK:
+        return (
+            health["state"] == "healthy"
+            and time.monotonic() - health["checked_at"] < COMFY_HEALTH_TTL_S
+        )
+
+
+def start_health_probe():
+    """
+    Wait for every backend to become available in a background thread, so that the
+    worker doesn't block on it and the first job can reuse the result.
+
+    Returns:
+        threading.Thread: The thread that is running the check of the first backend
+    """
+    global STARTUP_PROBE
+
+    def probe(backend):
+        with use_backend(backend):
+            check_server(
+                f"http://{backend.address}",
+                COMFY_API_AVAILABLE_MAX_RETRIES,
+                COMFY_API_AVAILABLE_INTERVAL_MS,
+            )
+
+    for backend in BACKENDS:
+        backend.probe = threading.Thread(target=probe, args=(backend,), daemon=True)
+        backend.probe.start()
+    STARTUP_PROBE = BACKENDS[0].probe
+    return STARTUP_PROBE
+
+
+def ensure_comfy_available():
+    """
+    Make sure that ComfyUI can accept work, without checking it on every job
+
+    A recent healthy state is trusted as is. While ComfyUI is starting up, the full
+    COMFY_API_AVAILABLE_MAX_RETRIES attempts are allowed. Once ComfyUI was reachable
+    before, only COMFY_API_FAILFAST_RETRIES attempts are made, so that jobs fail fast
+    when ComfyUI went down.
+
+    Returns:
+        bool: True if ComfyUI is available
+    """
+    if is_comfy_healthy():
+        return True
+
+    backend = get_backend()
+    probe = backend.probe
+    if probe is not None and probe.is_alive():
+        probe.join()
+        if is_comfy_healthy():
+            return True
+
+    with COMFY_HEALTH_LOCK:
+        starting = backend.health["state"] == "unknown"
+
+    return check_server(
+        f"http://{backend.address}",
+        COMFY_API_AVAILABLE_MAX_RETRIES if starting else COMFY_API_FAILFAST_RETRIES,
+        COMFY_API_AVAILABLE_INTERVAL_MS,
+    )
+
+
+def get_connection_stats():
+    """
+    Count the connections that were opened to ComfyUI and how often they were reused
+
+    Returns:
+        dict: The number of "requests", "opened" connections and "reused" connections
+    """
+    stats = {"requests": 0, "opened": 0, "reused": 0}
+    pools = SESSION.get_adapter("http://").poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        stats["requests"] += pool.num_requests
+        stats["opened"] += pool.num_connections
+    stats["reused"] = max(stats["requests"] - stats["opened"], 0)
+    return stats
+
+
+class JobMetrics:
+    """
+    The durations of the stages of a job
+
+    Stages that run in several threads at the same time, e.g. the encoding of each
+    output file, are summed up. Their wall time is part of the enclosing stage,
+    e.g. "outputs".
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.nodes = {}
+        self.class_types = {}
+        # If the job asked for its metrics to be returned
+        self.requested = False
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage):
+        """
+        Measure the duration of the code in the with statement
+
+        Args:
+            stage (str): The name of the stage, e.g. "upload"
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_node(self, node_id, seconds):
+        with self.lock:
+            self.nodes[node_id] = self.nodes.get(node_id, 0.0) + seconds
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: The "total_ms" of the job, the "stages" in milliseconds and the
+                  execution time of each node in ComfyUI, if it was reported
+        """
+        with self.lock:
+            return {
+                "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+                "stages": {
+                    stage: round(seconds * 1000, 1)
+                    for stage, seconds in self.stages.items()
+                },
+                "nodes": {
+                    node_id: {
+                        "class_type": self.class_types.get(node_id),
+                        "ms": round(seconds * 1000, 1),
+                    }
+                    for node_id, seconds in self.nodes.items()
+                },
+            }
+
+
+def measure(metrics, stage):
+    """
+    Measure the duration of a stage, if the metrics of the job are recorded
+
+    Args:
+        metrics (JobMetrics): The metrics of the job or None
+        stage (str): The name of the stage
+
+    Returns:
+        A context manager for the with statement
+    """
+    return metrics.span(stage) if metrics is not None else nullcontext()
+
+
+class Histogram:
+    """
+    A Prometheus histogram with one series per value of its label
+    """
+
+    def __init__(self, name, label, help_text, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.label = label
+        self.help_text = help_text
+        self.buckets = buckets
+        # label value -> [count per bucket, sum of the observations, count]
+        self.series = {}
+
+    def observe(self, value, seconds):
+        series = self.series.setdefault(value, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                series[0][i] += 1
+        series[1] += seconds
+        series[2] += 1
+
+    def render(self):
+        """
+        Returns:
+            list: The lines of the histogram in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for value, (buckets, total, count) in sorted(self.series.items()):
+            label = f'{self.label}="{value}"'
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label}}} {round(total, 6)}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+# Metrics of all jobs that were handled by this worker, see render_metrics
+METRICS = {
+    "jobs": {},
+    "stages": Histogram(
+        "runpod_worker_comfy_stage_seconds", "stage", "Duration of the stages of a job"
+    ),
+    "nodes": Histogram(
+        "runpod_worker_comfy_node_seconds",
+        "class_type",
+        "Execution time of the nodes of a workflow in ComfyUI",
+    ),
+}
+METRICS_LOCK = threading.Lock()
+
+
+def record_job_metrics(job_id, metrics, result):
+    """
+    Add the durations of a finished job to METRICS and log them as JSON
+
+    Args:
+        job_id (str): The unique identifier for the job
+        metrics (JobMetrics): The durations of the job
+        result (dict): The result of the job
+    """
+    status = "error" if "error" in result or result.get("status") == "error" else "success"
+    summary = metrics.as_dict()
+
+    with METRICS_LOCK:
+        METRICS["jobs"][status] = METRICS["jobs"].get(status, 0) + 1
+        METRICS["stages"].observe("total", summary["total_ms"] / 1000)
+        for stage, ms in summary["stages"].items():
+            METRICS["stages"].observe(stage, ms / 1000)
+        for node in summary["nodes"].values():
+            # Nodes that ComfyUI added to the workflow, e.g. "3.0.0.1", have no class_type
+            METRICS["nodes"].observe(str(node.get("class_type") or "unknown"), node["ms"] / 1000)
+
+    if COMFY_METRICS_LOG:
+        print(
+            "runpod-worker-comfy - metrics "
+            + json.dumps({"job_id": job_id, "status": status, **summary})
+        )
+
+
+def render_metrics():
+    """
+    Returns:
+        str: The metrics of all jobs in the Prometheus text format
+    """
+    with METRICS_LOCK:
+        lines = [
+            "# HELP runpod_worker_comfy_jobs_total Number of finished jobs",
+            "# TYPE runpod_worker_comfy_jobs_total counter",
+        ]
+        for status, count in sorted(METRICS["jobs"].items()):
+            lines.append(f'runpod_worker_comfy_jobs_total{{status="{status}"}} {count}')
+        lines += METRICS["stages"].render()
+        lines += METRICS["nodes"].render()
+    if len(BACKENDS) > 1:
+        lines += [
+            "# HELP runpod_worker_comfy_backend_jobs Number of jobs that run on a backend",
+            "# TYPE runpod_worker_comfy_backend_jobs gauge",
+        ]
+        lines += [
+            f'runpod_worker_comfy_backend_jobs{{backend="{b.address}"}} {b.outstanding}'
+            for b in BACKENDS
+        ]
+        lines += [
+            "# HELP runpod_worker_comfy_backend_healthy If the last check of a backend succeeded",
+            "# TYPE runpod_worker_comfy_backend_healthy gauge",
+        ]
+        lines += [
+            f'runpod_worker_comfy_backend_healthy{{backend="{b.address}"}} '
+            f'{int(b.health["state"] == "healthy")}'
+            for b in BACKENDS
+        ]
+    timeline = get_startup_timeline()
+    if timeline:
+        lines += [
+            "# HELP runpod_worker_comfy_startup_seconds Time from the start of the container "
+            "to an event of the startup",
+            "# TYPE runpod_worker_comfy_startup_seconds gauge",
+        ]
+        for event, seconds in timeline.items():
+            lines.append(f'runpod_worker_comfy_startup_seconds{{event="{event}"}} {seconds}')
+    if WARMUP["models"]:
+        lines += [
+            "# HELP runpod_worker_comfy_warmup_seconds Duration of the warm-up of a model",
+            "# TYPE runpod_worker_comfy_warmup_seconds gauge",
+        ]
+        for model, warmup in sorted(dict(WARMUP["models"]).items()):
+            lines.append(
+                f'runpod_worker_comfy_warmup_seconds{{model="{model}"}} '
+                f'{round(warmup["ms"] / 1000, 6)}'
+            )
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/ready":
+            # Ready once the warm-up has finished, for readiness probes
+            ready = WARMUP["state"] != "running"
+            body = json.dumps({**WARMUP, "models": dict(WARMUP["models"])}).encode("utf-8")
+            self.send_response(200 if ready else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=None):
+    """
+    Serve the metrics for Prometheus at /metrics and the state of the warm-up at
+    /ready in a background thread
+
+    Args:
+        port (int, optional): The port, defaults to COMFY_METRICS_PORT
+
+    Returns:
+        ThreadingHTTPServer: The running server
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", port or COMFY_METRICS_PORT), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"runpod-worker-comfy - metrics are served on port {server.server_port}")
+    return server
+
+
+def is_connect_error(error):
+    """
+    Check if a request failed before anything was sent to ComfyUI
+
+    Args:
+        error (requests.ConnectionError): The error of the request
+
+    Returns:
+        bool: True if the connection couldn't be opened, e.g. because it was refused
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def comfy_request(method, path, retries=None, **kwargs):
+    """
+    Send a request to ComfyUI using the shared session
+
+    Failed connections and responses of GET requests with a status code from
+    COMFY_RETRY_STATUS_CODES are retried with exponential backoff. Other requests than
+    GET are only retried when the connection couldn't be opened, so that a workflow is
+    never queued twice when ComfyUI fails or the connection drops after it was sent.
+
+    Args:
+        method (str): The HTTP method
+        path (str): The path of the endpoint, e.g. "/prompt"
+        retries (int, optional): Number of retries, defaults to COMFY_REQUEST_MAX_RETRIES
+        **kwargs: Passed on to requests.Session.request
+
+    Returns:
+        requests.Response: The response of ComfyUI
+    """
+    if retries is None:
+        retries = COMFY_REQUEST_MAX_RETRIES
+    kwargs.setdefault("timeout", (COMFY_CONNECT_TIMEOUT_S, COMFY_READ_TIMEOUT_S))
+    url = f"http://{get_backend().address}{path}"
+
+    for attempt in range(retries + 1):
+        try:
+            response = SESSION.request(method, url, **kwargs)
+            if (
+                method != "GET"
+                or response.status_code not in COMFY_RETRY_STATUS_CODES
+                or attempt == retries
+            ):
+                set_comfy_health(response.status_code < 500)
+                return response
+        except requests.ReadTimeout:
+            if method != "GET" or attempt == retries:
+                set_comfy_health(False)
+                raise
+        except requests.ConnectionError as e:
+            if (method != "GET" and not is_connect_error(e)) or attempt == retries:
+                set_comfy_health(False)
+                raise
+
+        time.sleep(COMFY_REQUEST_BACKOFF_S * 2**attempt)
+
+
 def validate_input(job_input):
     """
     Validates the input for the handler function.
@@ -46,24 +958,78 @@ def validate_input(job_input):
         except json.JSONDecodeError:
             return None, "Invalid JSON format in input"
 
-    # Validate 'workflow' in input
+    # Validate 'workflow' in input or build it from 'template' and 'params'
     workflow = job_input.get("workflow")
+    template = None
+    if job_input.get("template") is not None:
+        if workflow is not None:
+            return None, "Provide either 'workflow' or 'template', not both"
+        if not isinstance(job_input["template"], str):
+            return None, "'template' must be the name of a template"
+        template = TEMPLATES.get(job_input["template"])
+        if template is None:
+            return None, f"Unknown template '{job_input['template']}'"
+        workflow, error_message = template.apply(job_input.get("params"))
+        if error_message:
+            return None, error_message
     if workflow is None:
         return None, "Missing 'workflow' parameter"
+    if not isinstance(workflow, dict):
+        return None, "'workflow' must be an object"
 
     # Validate 'images' in input, if provided
     images = job_input.get("images")
     if images is not None:
         if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
+            isinstance(image, dict)
+            and "name" in image
+            and ("image" in image or "hash" in image or "url" in image)
+            for image in images
         ):
             return (
                 None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
+                "'images' must be a list of objects with 'name' and 'image' (or 'hash' "
+                "or 'url') keys",
+            )
+        for image in images:
+            if "url" in image and urlparse(str(image["url"])).scheme not in URL_SCHEMES:
+                return None, f"'url' of image '{image['name']}' must be http(s):// or s3://"
+
+    # Validate 'output_format' and 'output_quality' in input, if provided
+    output_format = job_input.get("output_format")
+    if output_format is not None:
+        output_format = str(output_format).lower()
+        if output_format == "jpg":
+            output_format = "jpeg"
+        if output_format not in OUTPUT_FORMATS:
+            return (
+                None,
+                f"'output_format' must be one of: {', '.join(OUTPUT_FORMATS)}",
             )
+    output_quality = job_input.get("output_quality")
+    if output_quality is not None and (
+        not isinstance(output_quality, int) or not 1 <= output_quality <= 100
+    ):
+        return None, "'output_quality' must be an integer between 1 and 100"
+
+    # Validate 'timeout' in input, if provided
+    timeout = job_input.get("timeout")
+    if timeout is not None and (
+        isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0
+    ):
+        return None, "'timeout' must be a positive number of seconds"
 
     # Return validated data and no error
-    return {"workflow": workflow, "images": images}, None
+    return {
+        "workflow": workflow,
+        "images": images,
+        "output_format": output_format,
+        "output_quality": output_quality,
+        "metrics": job_input.get("metrics") is True,
+        "timeout": timeout,
+        "previews": job_input.get("previews") is True,
+        "template": template,
+    }, None
 
 
 def check_server(url, retries=500, delay=50):
@@ -81,11 +1047,13 @@ def check_server(url, retries=500, delay=50):
 
     for i in range(retries):
         try:
-            response = requests.get(url)
+            response = SESSION.get(url, timeout=COMFY_CONNECT_TIMEOUT_S)
 
             # If the response status code is 200, the server is up and running
             if response.status_code == 200:
                 print(f"runpod-worker-comfy - API is reachable")
+                set_comfy_health(True)
+                record_startup("comfy_listening")
                 return True
         except requests.RequestException as e:
             # If an exception occurs, the server may not be ready
@@ -97,183 +1065,2806 @@ def check_server(url, retries=500, delay=50):
     print(
         f"runpod-worker-comfy - Failed to connect to server at {url} after {retries} attempts."
     )
+    set_comfy_health(False)
     return False
 
 
-def upload_images(images):
+def strip_base64(image_data):
     """
-    Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
+    Remove a data URI prefix and whitespace from a base64 encoded string
 
     Args:
-        images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
-        server_address (str): The address of the ComfyUI server.
+        image_data (str): The base64 encoded string, e.g. "data:image/png;base64,iVBO..."
 
     Returns:
-        list: A list of responses from the server for each image upload.
+        str: The plain base64 encoded string
     """
-    if not images:
-        return {"status": "success", "message": "No images to upload", "details": []}
-
-    responses = []
-    upload_errors = []
-
-    print(f"runpod-worker-comfy - image(s) upload")
-
-    for image in images:
-        name = image["name"]
-        image_data = image["image"]
-        blob = base64.b64decode(image_data)
+    if image_data.startswith("data:"):
+        image_data = image_data.partition(",")[2]
+    if any(c in image_data for c in " \n\r\t"):
+        image_data = "".join(image_data.split())
+    return image_data
 
-        # Prepare the form data
-        files = {
-            "image": (name, BytesIO(blob), "image/png"),
-            "overwrite": (None, "true"),
-        }
 
-        # POST request to upload the image
-        response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files)
-        if response.status_code != 200:
-            upload_errors.append(f"Error uploading {name}: {response.text}")
-        else:
-            responses.append(f"Successfully uploaded {name}")
+def iter_base64_decode(image_data, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Decode a base64 encoded string chunk by chunk instead of all at once
 
-    if upload_errors:
-        print(f"runpod-worker-comfy - image(s) upload with errors")
-        return {
-            "status": "error",
-            "message": "Some images failed to upload",
-            "details": upload_errors,
-        }
+    Args:
+        image_data (str): The plain base64 encoded string
+        chunk_size (int, optional): The size of the decoded chunks in bytes
 
-    print(f"runpod-worker-comfy - image(s) upload complete")
-    return {
-        "status": "success",
-        "message": "All images uploaded successfully",
-        "details": responses,
-    }
+    Yields:
+        bytes: The decoded chunks
+    """
+    # 4 base64 characters are decoded into 3 bytes
+    step = max(chunk_size // 3, 1) * 4
+    for start in range(0, len(image_data), step):
+        yield base64.b64decode(image_data[start : start + step])
 
 
-def queue_workflow(workflow):
+def sniff_mime_type(head, name):
     """
-    Queue a workflow to be processed by ComfyUI
+    Detect the MIME type of an image from the first bytes of its content
 
     Args:
-        workflow (dict): A dictionary containing the workflow to be processed
+        head (bytes): At least the first 12 bytes of the image
+        name (str): The name of the image, used when the content is not recognized
 
     Returns:
-        dict: The JSON response from ComfyUI after processing the workflow
+        str: The MIME type
     """
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return mimetypes.guess_type(name)[0] or "application/octet-stream"
 
-    # The top level element "prompt" is required by ComfyUI
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
 
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+class MultipartImageBody:
+    """
+    The multipart/form-data body for /upload/image that decodes the base64 encoded
+    image, or reads the file at path, while it is sent, so that the image is never
+    held in memory as a whole. It can be iterated more than once, which allows the
+    request to be retried.
+    """
 
+    def __init__(self, name, image_data, mime_type, subfolder="", path=None):
+        self.name = name
+        self.image_data = image_data
+        self.mime_type = mime_type
+        self.subfolder = subfolder
+        self.path = path
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
 
-def get_history(prompt_id):
+    def __iter__(self):
+        filename = self.name.replace('"', "%22")
+        if self.subfolder:
+            yield (
+                f"--{self.boundary}\r\n"
+                'Content-Disposition: form-data; name="subfolder"\r\n\r\n'
+                f"{self.subfolder}\r\n"
+            ).encode("utf-8")
+        yield (
+            f"--{self.boundary}\r\n"
+            'Content-Disposition: form-data; name="overwrite"\r\n\r\n'
+            "true\r\n"
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+            f"Content-Type: {self.mime_type}\r\n\r\n"
+        ).encode("utf-8")
+        if self.path:
+            with open(self.path, "rb") as f:
+                yield from iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b"")
+        else:
+            yield from iter_base64_decode(self.image_data)
+        yield f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+
+
+# Index of the input images in COMFY_INPUT_PATH by the SHA-256 of their content,
+# in least recently used order: hash -> {"names": set of file names, "size": bytes}
+INPUT_CACHE = OrderedDict()
+# The hash of the content that is currently stored under a file name
+INPUT_CACHE_NAMES = {}
+# The input subfolders of the jobs that are running, their images are never evicted
+ACTIVE_INPUT_SUBFOLDERS = set()
+INPUT_CACHE_LOCK = threading.Lock()
+
+
+def hash_base64(image_data):
     """
-    Retrieve the history of a given prompt using its ID
+    Calculate the SHA-256 of the decoded content of a base64 encoded string
 
     Args:
-        prompt_id (str): The ID of the prompt whose history is to be retrieved
+        image_data (str): The plain base64 encoded string
 
     Returns:
-        dict: The history of the prompt, containing all the processing steps and results
+        tuple: A tuple containing the hex digest and the size of the decoded content
     """
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
-        return json.loads(response.read())
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter_base64_decode(image_data):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
 
 
-def base64_encode(img_path):
+def input_cache_path(name):
     """
-    Returns base64 encoded image.
+    Returns:
+        str: The path of an input image in COMFY_INPUT_PATH or None if the name
+             points outside of it
+    """
+    root = os.path.abspath(COMFY_INPUT_PATH)
+    path = os.path.abspath(os.path.join(root, name))
+    return path if path.startswith(root + os.sep) else None
 
-    Args:
-        img_path (str): The path to the image
 
+def file_size(path):
+    """
     Returns:
-        str: The base64 encoded image
+        int: The size of the file in bytes or None if it doesn't exist
     """
-    with open(img_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        return f"{encoded_string}"
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
 
 
-def process_output_images(outputs, job_id):
+def forget_cached_input_name(name):
     """
-    This function takes the "outputs" from image generation and the job ID,
-    then determines the correct way to return the image, either as a direct URL
-    to an AWS S3 bucket or as a base64 encoded string, depending on the
-    environment configuration.
+    Remove a file name from the index, e.g. because it gets new content.
+    Has to be called while holding INPUT_CACHE_LOCK.
+    """
+    old_hash = INPUT_CACHE_NAMES.pop(name, None)
+    entry = INPUT_CACHE.get(old_hash)
+    if entry is not None:
+        entry["names"].discard(name)
+        if not entry["names"]:
+            del INPUT_CACHE[old_hash]
+
+
+def input_cache_enabled():
+    """
+    Returns:
+        bool: If input images are cached for the backend of the current job. Servers on
+              other machines don't read their input images from COMFY_INPUT_PATH.
+    """
+    return COMFY_INPUT_CACHE_MAX_MB > 0 and get_backend().local
+
+
+def lookup_cached_input(name, image_hash):
+    """
+    Make an input image that is already in COMFY_INPUT_PATH available under the given
+    name, by linking or copying it if it is stored under another name.
+
+    Args:
+        name (str): The name that the workflow uses for the image
+        image_hash (str): The SHA-256 of the content of the image
+
+    Returns:
+        bool: True if the image is available, False if it has to be uploaded
+    """
+    target = input_cache_path(name)
+    if not input_cache_enabled() or target is None:
+        return False
+
+    with INPUT_CACHE_LOCK:
+        entry = INPUT_CACHE.get(image_hash)
+        if entry is None:
+            return False
+
+        # Ignore files that were removed or changed outside of the worker
+        for cached_name in list(entry["names"]):
+            if file_size(input_cache_path(cached_name)) != entry["size"]:
+                forget_cached_input_name(cached_name)
+        if image_hash not in INPUT_CACHE:
+            return False
+        INPUT_CACHE.move_to_end(image_hash)
+
+        if name in entry["names"]:
+            return True
+
+        source = input_cache_path(next(iter(entry["names"])))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temporary = f"{target}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(source, temporary)
+        except OSError:
+            shutil.copyfile(source, temporary)
+        os.replace(temporary, target)
+
+        forget_cached_input_name(name)
+        entry["names"].add(name)
+        INPUT_CACHE_NAMES[name] = image_hash
+        return True
+
+
+def record_cached_input(name, image_hash, size):
+    """
+    Add an uploaded input image to the index and evict the least recently used
+    images from COMFY_INPUT_PATH when the index grows beyond COMFY_INPUT_CACHE_MAX_MB.
+
+    Args:
+        name (str): The name under which the image was uploaded
+        image_hash (str): The SHA-256 of the content of the image
+        size (int): The size of the image in bytes
+    """
+    if not input_cache_enabled() or input_cache_path(name) is None:
+        return
+
+    with INPUT_CACHE_LOCK:
+        forget_cached_input_name(name)
+        entry = INPUT_CACHE.setdefault(image_hash, {"names": set(), "size": size})
+        entry["names"].add(name)
+        INPUT_CACHE_NAMES[name] = image_hash
+        INPUT_CACHE.move_to_end(image_hash)
+
+        evict_cached_inputs()
+
+
+def evict_cached_inputs():
+    """
+    Remove the least recently used images from the index until it is not larger than
+    COMFY_INPUT_CACHE_MAX_MB. Only their files in INPUT_CACHE_FOLDER are removed,
+    images that a running job uses are kept until the job is done. Has to be called
+    while holding INPUT_CACHE_LOCK.
+    """
+    max_bytes = COMFY_INPUT_CACHE_MAX_MB * 1024 * 1024
+    total = sum(e["size"] for e in INPUT_CACHE.values())
+    # The most recently used image is always kept
+    for image_hash in list(INPUT_CACHE)[:-1]:
+        if total <= max_bytes:
+            break
+        entry = INPUT_CACHE[image_hash]
+        if any(name.split("/", 1)[0] in ACTIVE_INPUT_SUBFOLDERS for name in entry["names"]):
+            continue
+        del INPUT_CACHE[image_hash]
+        total -= entry["size"]
+        for evicted_name in entry["names"]:
+            INPUT_CACHE_NAMES.pop(evicted_name, None)
+            if evicted_name.startswith(f"{INPUT_CACHE_FOLDER}/"):
+                try:
+                    os.remove(input_cache_path(evicted_name))
+                except OSError:
+                    pass
+
+
+def load_input_cache():
+    """
+    Rebuild the index from the images in INPUT_CACHE_FOLDER, which are named after the
+    SHA-256 of their content, so that they can be referenced by their hash and are
+    evicted again after the worker was restarted.
+
+    Returns:
+        int: The number of images that were added to the index
+    """
+    folder = input_cache_path(INPUT_CACHE_FOLDER)
+    if COMFY_INPUT_CACHE_MAX_MB <= 0 or folder is None or not os.path.isdir(folder):
+        return 0
+
+    files = []
+    for filename in os.listdir(folder):
+        if len(filename) != 64 or any(c not in "0123456789abcdef" for c in filename):
+            continue
+        try:
+            stat = os.stat(os.path.join(folder, filename))
+        except OSError:
+            continue
+        files.append((stat.st_mtime, filename, stat.st_size))
+
+    with INPUT_CACHE_LOCK:
+        # The oldest files are the least recently used ones, and older than the
+        # images that are already in the index
+        for _, image_hash, size in sorted(files, reverse=True):
+            name = f"{INPUT_CACHE_FOLDER}/{image_hash}"
+            forget_cached_input_name(name)
+            entry = INPUT_CACHE.setdefault(image_hash, {"names": set(), "size": size})
+            entry["names"].add(name)
+            INPUT_CACHE_NAMES[name] = image_hash
+            INPUT_CACHE.move_to_end(image_hash, last=False)
+        evict_cached_inputs()
+    if files:
+        print(f"runpod-worker-comfy - found {len(files)} cached input image(s)")
+    return len(files)
+
+
+class UrlCache:
+    """
+    Keeps the input images that were fetched from URLs on disk, so that they are only
+    downloaded again when they changed on the server.
+
+    Each entry is named after the SHA-256 of its URL: the file "<key>" contains the
+    image and "<key>.json" its "url", "etag", "last_modified", "sha256" and "size".
+    When the cache grows beyond max_bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def entry_path(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def get(self, url):
+        """
+        Returns:
+            dict: The metadata of the cached image with its "path" or None if the URL
+                  is not in the cache
+        """
+        path = self.entry_path(url)
+        try:
+            with open(f"{path}.json") as f:
+                entry = json.load(f)
+            if entry.get("url") != url or file_size(path) != entry.get("size"):
+                return None
+            # Mark the entry as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return {**entry, "path": path}
+
+    def put(self, url, temporary, entry):
+        """
+        Move a downloaded image into the cache
+
+        Args:
+            url (str): The URL of the image
+            temporary (str): The downloaded file in the cache folder
+            entry (dict): The metadata of the image, see UrlCache
+
+        Returns:
+            dict: The metadata with the "path" of the cached image
+        """
+        path = self.entry_path(url)
+        with self.lock:
+            os.replace(temporary, path)
+            with open(f"{path}.json", "w") as f:
+                json.dump({**entry, "url": url}, f)
+        self.evict(keep=path)
+        return {**entry, "url": url, "path": path}
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits into max_bytes
+
+        Args:
+            keep (str, optional): An entry that must not be removed
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                if name.startswith(".") or name.endswith(".json") or path == keep:
+                    continue
+                try:
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except OSError:
+                    continue
+
+            total = sum(size for _, size, _ in entries) + (file_size(keep) or 0 if keep else 0)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for stale in (path, f"{path}.json"):
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass
+                total -= size
+
+
+def get_url_cache():
+    """
+    Returns:
+        UrlCache: The cache in COMFY_URL_CACHE_PATH, with a size of 0 if it is disabled
+    """
+    os.makedirs(COMFY_URL_CACHE_PATH, exist_ok=True)
+    return UrlCache(COMFY_URL_CACHE_PATH, max(COMFY_URL_CACHE_MAX_MB, 0) * 1024 * 1024)
+
+
+def save_url_stream(chunks, deadline):
+    """
+    Write a downloaded image into a temporary file of the URL cache
+
+    Args:
+        chunks (iterable): The content of the image
+        deadline (float): The time.monotonic() by which the download has to be done
+
+    Returns:
+        tuple: The path of the file, the SHA-256 of its content and its size
+    """
+    max_bytes = COMFY_URL_MAX_MB * 1024 * 1024
+    temporary = os.path.join(COMFY_URL_CACHE_PATH, f".{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(temporary, "wb") as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"it is larger than {COMFY_URL_MAX_MB} MB")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"it took longer than {COMFY_URL_TIMEOUT_S:g}s")
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    return temporary, digest.hexdigest(), size
+
+
+def fetch_image_url(url):
+    """
+    Download an input image from an http(s) or s3 URL into the URL cache, unless the
+    cached image has still the same ETag (or Last-Modified) on the server. s3 URLs are
+    read with the BUCKET_* credentials.
+
+    Args:
+        url (str): The URL of the image
+
+    Returns:
+        tuple: The metadata of the image with its "path", "sha256" and "size" and an
+               error message, if any. The image has to be removed after its upload
+               when "temporary" is True. The structure is (image, error_message).
+    """
+    cache = get_url_cache()
+    cached = cache.get(url) if cache.max_bytes > 0 else None
+    deadline = time.monotonic() + COMFY_URL_TIMEOUT_S
+    # Presigned URLs contain credentials, which must not end up in the logs
+    public_url = url.split("?")[0]
+    max_bytes = COMFY_URL_MAX_MB * 1024 * 1024
+
+    try:
+        parsed = urlparse(url)
+        if parsed.scheme == "s3":
+            client, _ = get_s3_client()
+            if client is None:
+                return None, f"can't fetch {public_url} without the BUCKET_* credentials"
+            from botocore.exceptions import ClientError
+
+            request = {"Bucket": parsed.netloc, "Key": parsed.path.lstrip("/")}
+            if cached and cached.get("etag"):
+                request["IfNoneMatch"] = cached["etag"]
+            try:
+                response = client.get_object(**request)
+            except ClientError as e:
+                status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+                if cached and status == 304:
+                    return cached, None
+                raise
+            if response["ContentLength"] > max_bytes:
+                response["Body"].close()
+                return None, f"{public_url} is larger than {COMFY_URL_MAX_MB} MB"
+            with closing(response["Body"]) as body:
+                temporary, image_hash, size = save_url_stream(
+                    body.iter_chunks(UPLOAD_CHUNK_SIZE), deadline
+                )
+            etag, last_modified = response.get("ETag"), None
+        else:
+            headers = {}
+            if cached and cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            elif cached and cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+            with URL_SESSION.get(
+                url, headers=headers, stream=True, timeout=COMFY_URL_TIMEOUT_S
+            ) as response:
+                if cached and response.status_code == 304:
+                    return cached, None
+                response.raise_for_status()
+                length = response.headers.get("Content-Length")
+                if length and length.isdigit() and int(length) > max_bytes:
+                    return None, f"{public_url} is larger than {COMFY_URL_MAX_MB} MB"
+                temporary, image_hash, size = save_url_stream(
+                    response.iter_content(UPLOAD_CHUNK_SIZE), deadline
+                )
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+    except Exception as e:
+        message = str(e).replace(url, public_url)
+        return None, f"could not fetch {public_url}: {message}"
+
+    image = {"etag": etag, "last_modified": last_modified, "sha256": image_hash, "size": size}
+    # Images that can't be revalidated are downloaded again anyway
+    if cache.max_bytes <= 0 or not (etag or last_modified):
+        return {**image, "path": temporary, "temporary": True}, None
+    return cache.put(url, temporary, image), None
+
+
+def upload_image(image, subfolder="", metrics=None):
+    """
+    Upload a single base64 encoded image to ComfyUI
+
+    Images whose content is already in the input folder of ComfyUI are not uploaded
+    again. Instead of the base64 encoded 'image', the SHA-256 'hash' of an image that
+    was uploaded before or a 'url' to fetch the image from can be given.
+
+    Args:
+        image (dict): A dictionary containing the 'name' and the base64 encoded 'image',
+                      the 'hash' of its content or its 'url'
+        subfolder (str, optional): The folder inside of the input folder of ComfyUI
+        metrics (JobMetrics, optional): Records the time to decode the image
+
+    Returns:
+        tuple: A tuple containing the result message and an error message, if any.
+               The structure is (message, error_message).
+    """
+    name = image["name"]
+    cache_name = f"{subfolder}/{name}" if subfolder else name
+    if "image" not in image and "url" not in image:
+        image_hash = str(image["hash"]).lower()
+        if lookup_cached_input(cache_name, image_hash):
+            return f"Reused cached {name}", None
+        return (
+            None,
+            f"Error uploading {name}: unknown image hash {image_hash}, "
+            "please send the 'image' instead",
+        )
+
+    fetched = None
+    try:
+        if "url" in image:
+            with measure(metrics, "image_fetch"):
+                fetched, error_message = fetch_image_url(str(image["url"]))
+            if error_message:
+                return None, f"Error uploading {name}: {error_message}"
+            image_hash, size = fetched["sha256"], fetched["size"]
+            if lookup_cached_input(cache_name, image_hash):
+                return f"Reused cached {name}", None
+
+            with open(fetched["path"], "rb") as f:
+                mime_type = sniff_mime_type(f.read(16), name)
+            body = MultipartImageBody(name, None, mime_type, subfolder, fetched["path"])
+        else:
+            with measure(metrics, "image_decode"):
+                image_data = strip_base64(image["image"])
+                image_hash = None
+                if input_cache_enabled():
+                    image_hash, size = hash_base64(image_data)
+            if image_hash and lookup_cached_input(cache_name, image_hash):
+                return f"Reused cached {name}", None
+
+            mime_type = sniff_mime_type(base64.b64decode(image_data[:16]), name)
+            body = MultipartImageBody(name, image_data, mime_type, subfolder)
+
+        # POST request to upload the image
+        response = comfy_request(
+            "POST",
+            "/upload/image",
+            data=body,
+            headers={"Content-Type": body.content_type},
+        )
+    except (binascii.Error, ValueError) as e:
+        return None, f"Error uploading {name}: invalid base64 data ({e})"
+    except (requests.RequestException, OSError) as e:
+        return None, f"Error uploading {name}: {e}"
+    finally:
+        if fetched and fetched.get("temporary"):
+            os.remove(fetched["path"])
+
+    if response.status_code != 200:
+        return None, f"Error uploading {name}: {response.text}"
+
+    if image_hash:
+        record_cached_input(cache_name, image_hash, size)
+    return f"Successfully uploaded {name}", None
+
+
+# The /object_info of ComfyUI, which only changes when ComfyUI is restarted
+OBJECT_INFO = {}
+OBJECT_INFO_LOCK = threading.Lock()
+# The folders per model type, see get_model_folders
+MODEL_FOLDER_CACHE = {}
+
+
+def get_object_info():
+    """
+    Get the definitions of all nodes from ComfyUI, which are fetched only once
+
+    Returns:
+        dict: The node definitions by class_type or None if they are not available
+    """
+    with OBJECT_INFO_LOCK:
+        if not OBJECT_INFO:
+            try:
+                response = comfy_request("GET", "/object_info")
+                if response.status_code != 200:
+                    return None
+                OBJECT_INFO.update(response.json())
+            except (requests.RequestException, ValueError) as e:
+                print(f"runpod-worker-comfy - could not get the object info: {e}")
+                return None
+        return OBJECT_INFO
+
+
+def get_model_folders():
+    """
+    Get the folders that ComfyUI searches for models, from COMFY_MODELS_PATH and
+    from COMFY_EXTRA_MODEL_PATHS, which are read only once
+
+    Returns:
+        dict: A list of folders by model type, e.g. "checkpoints"
+    """
+    if MODEL_FOLDER_CACHE:
+        return MODEL_FOLDER_CACHE
+
+    folders = {}
+    for model_type in set().union(*(m.values() for m in MODEL_LOADERS.values())):
+        folders[model_type] = [
+            os.path.join(COMFY_MODELS_PATH, name)
+            for name in MODEL_FOLDERS.get(model_type, (model_type,))
+        ]
+
+    try:
+        import yaml
+
+        with open(COMFY_EXTRA_MODEL_PATHS) as f:
+            extra_model_paths = yaml.safe_load(f) or {}
+    except (ImportError, OSError, ValueError):
+        extra_model_paths = {}
+
+    for config in extra_model_paths.values():
+        if not isinstance(config, dict):
+            continue
+        base_path = config.get("base_path", "")
+        for model_type, paths in config.items():
+            if model_type in folders and isinstance(paths, str):
+                folders[model_type] += [
+                    os.path.join(base_path, path.strip())
+                    for path in paths.splitlines()
+                    if path.strip()
+                ]
+
+    MODEL_FOLDER_CACHE.update(folders)
+    return MODEL_FOLDER_CACHE
+
+
+def get_input_options(input_spec):
+    """
+    Returns:
+        list: The allowed values of a combo input of /object_info or None
+    """
+    if not isinstance(input_spec, (list, tuple)) or not input_spec:
+        return None
+    if isinstance(input_spec[0], list):
+        return input_spec[0]
+    if input_spec[0] == "COMBO" and len(input_spec) > 1:
+        return input_spec[1].get("options")
+    return None
+
+
+def find_cycle(workflow):
+    """
+    Find a cycle in the links between the nodes of a workflow
+
+    Returns:
+        str: The ID of a node that is part of a cycle or None if there is no cycle
+    """
+    links = {
+        node_id: [
+            str(value[0])
+            for value in (node.get("inputs") or {}).values()
+            if isinstance(value, list) and len(value) == 2 and str(value[0]) in workflow
+        ]
+        for node_id, node in workflow.items()
+    }
+
+    # 0 = not visited, 1 = on the current path, 2 = done
+    state = dict.fromkeys(workflow, 0)
+    for start in workflow:
+        if state[start]:
+            continue
+        stack = [(start, iter(links[start]))]
+        state[start] = 1
+        while stack:
+            node_id, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                state[node_id] = 2
+                stack.pop()
+            elif state[child] == 1:
+                return child
+            elif state[child] == 0:
+                state[child] = 1
+                stack.append((child, iter(links[child])))
+    return None
+
+
+def validate_workflow(workflow, object_info=None):
+    """
+    Check the node graph of a workflow before it is sent to ComfyUI
+
+    Every node needs a class_type that ComfyUI knows, all of its required inputs,
+    links that point to existing outputs of other nodes and model files that exist.
+    The links must not form a cycle. The node definitions are taken from /object_info,
+    without them only the structure of the graph is checked.
+
+    Args:
+        workflow (dict): The workflow in the API format
+        object_info (dict, optional): The node definitions, defaults to the ones of
+                                      ComfyUI, see get_object_info
+
+    Returns:
+        list: The errors, each with the "node_id", "class_type" and a "message"
+    """
+    errors = []
+
+    def error(node_id, node, message):
+        errors.append(
+            {
+                "node_id": node_id,
+                "class_type": node.get("class_type") if isinstance(node, dict) else None,
+                "message": message,
+            }
+        )
+
+    if object_info is None:
+        object_info = get_object_info() or {}
+    model_folders = get_model_folders()
+
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or "class_type" not in node:
+            error(node_id, node, "node has no 'class_type'")
+            continue
+        inputs = node.get("inputs") or {}
+        if not isinstance(inputs, dict):
+            error(node_id, node, "'inputs' must be an object")
+            continue
+
+        definition = object_info.get(node["class_type"])
+        if object_info and definition is None:
+            error(node_id, node, f"unknown node type '{node['class_type']}'")
+
+        for name, value in inputs.items():
+            if not (isinstance(value, list) and len(value) == 2):
+                continue
+            source_id, output_index = str(value[0]), value[1]
+            if source_id not in workflow:
+                error(node_id, node, f"input '{name}' is linked to missing node {source_id}")
+                continue
+            source = workflow[source_id]
+            source_definition = object_info.get(
+                source.get("class_type") if isinstance(source, dict) else None
+            )
+            if source_definition and not (
+                isinstance(output_index, int)
+                and 0 <= output_index < len(source_definition.get("output", []))
+            ):
+                error(
+                    node_id,
+                    node,
+                    f"input '{name}' is linked to missing output {output_index} of node {source_id}",
+                )
+
+        if definition:
+            required = (definition.get("input") or {}).get("required") or {}
+            for name in required:
+                if name not in inputs:
+                    error(node_id, node, f"required input '{name}' is missing")
+
+        for name, model_type in MODEL_LOADERS.get(node["class_type"], {}).items():
+            value = inputs.get(name)
+            if not isinstance(value, str):
+                continue
+            spec = ((definition or {}).get("input") or {}).get("required", {}).get(name)
+            options = get_input_options(spec)
+            if options and value in options:
+                continue
+            # The model could have been added after /object_info was fetched
+            folders = [f for f in model_folders.get(model_type, []) if os.path.isdir(f)]
+            if folders and not any(
+                os.path.isfile(os.path.join(folder, value)) for folder in folders
+            ):
+                error(node_id, node, f"{model_type} model '{value}' does not exist")
+
+    cycle = find_cycle(
+        {
+            node_id: node
+            for node_id, node in workflow.items()
+            if isinstance(node, dict) and isinstance(node.get("inputs") or {}, dict)
+        }
+    )
+    if cycle is not None:
+        error(cycle, workflow[cycle], "the links between the nodes form a cycle")
+
+    return errors
+
+
+class WorkflowTemplate:
+    """
+    A workflow that is loaded once and that jobs refer to by its name, instead of
+    sending the whole workflow with every job
+
+    Args:
+        name (str): The name of the template
+        workflow (dict): The workflow in the API format, which is never changed
+    """
+
+    def __init__(self, name, workflow):
+        self.name = name
+        self.workflow = workflow
+        # The errors of the full validation with the node definitions of ComfyUI or
+        # None as long as it has not been validated, see validate
+        self.errors = None
+        self.lock = threading.Lock()
+
+    def apply(self, params):
+        """
+        Args:
+            params (dict): New values of inputs by "<node_id>.<input>", e.g. "6.text"
+
+        Returns:
+            tuple: A copy of the workflow with the new values, in which only the changed
+                   nodes are copied, and an error message, if any.
+                   The structure is (workflow, error_message).
+        """
+        if params is None:
+            return self.workflow, None
+        if not isinstance(params, dict):
+            return None, "'params' must be an object"
+
+        changed = {}
+        for key, value in params.items():
+            node_id, _, name = str(key).rpartition(".")
+            node = self.workflow.get(node_id)
+            if node is None:
+                return None, f"'params' refers to unknown node '{node_id}' in '{key}'"
+            if name not in (node.get("inputs") or {}):
+                return None, f"'params' refers to unknown input '{name}' in '{key}'"
+            changed.setdefault(node_id, {})[name] = value
+
+        workflow = dict(self.workflow)
+        for node_id, inputs in changed.items():
+            node = workflow[node_id]
+            workflow[node_id] = {**node, "inputs": {**node["inputs"], **inputs}}
+        return workflow, None
+
+    def validate(self, workflow):
+        """
+        Validate a workflow of apply. The template itself is only validated once, the
+        workflow again only if the params changed links or models.
+
+        Args:
+            workflow (dict): The result of apply
+
+        Returns:
+            list: The errors, see validate_workflow
+        """
+        with self.lock:
+            if self.errors is None:
+                object_info = get_object_info()
+                errors = validate_workflow(self.workflow, object_info or {})
+                # Check it again once ComfyUI can tell which nodes exist
+                if object_info is None:
+                    return errors
+                self.errors = errors
+        if self.errors:
+            return self.errors
+
+        for node_id, node in workflow.items():
+            original = self.workflow[node_id]
+            # apply only copies the nodes that it changes
+            if node is original:
+                continue
+            loaders = MODEL_LOADERS.get(node["class_type"], {})
+            for name, value in node["inputs"].items():
+                if value != original["inputs"][name] and (
+                    isinstance(value, list) or name in loaders
+                ):
+                    return validate_workflow(workflow)
+        return []
+
+
+def load_templates(paths):
+    """
+    Read and check the structure of the workflow templates in some folders. A file
+    can contain the workflow itself or the input of a job like test_input.json.
+
+    Args:
+        paths (str): See COMFY_TEMPLATES_PATH
+
+    Returns:
+        dict: The WorkflowTemplate by name, a template with the same name in a later
+              folder replaces the earlier one
+    """
+    templates = {}
+    for folder in paths.split(","):
+        folder = folder.strip()
+        if not folder or not os.path.isdir(folder):
+            continue
+        for filename in sorted(os.listdir(folder)):
+            name, extension = os.path.splitext(filename)
+            if extension != ".json":
+                continue
+            path = os.path.join(folder, filename)
+            try:
+                with open(path) as f:
+                    workflow = json.load(f)
+                workflow = workflow.get("input", workflow)
+                workflow = workflow.get("workflow", workflow)
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"runpod-worker-comfy - could not read the template {path}: {e}")
+                continue
+            if not isinstance(workflow, dict) or not workflow:
+                print(f"runpod-worker-comfy - the template {path} contains no workflow")
+                continue
+            # The node definitions are not available before ComfyUI is started
+            errors = validate_workflow(workflow, {})
+            if errors:
+                print(
+                    f"runpod-worker-comfy - the template {path} is invalid: {json.dumps(errors)}"
+                )
+                continue
+            templates[name] = WorkflowTemplate(name, workflow)
+    if templates:
+        print(f"runpod-worker-comfy - loaded the templates {', '.join(sorted(templates))}")
+    return templates
+
+
+TEMPLATES = load_templates(COMFY_TEMPLATES_PATH)
+
+
+def scope_image_names(workflow, images, subfolder):
+    """
+    Point the inputs of a workflow that use one of the uploaded images to the
+    subfolder the images were uploaded to, e.g. "image.png" -> "<subfolder>/image.png"
+
+    Args:
+        workflow (dict): The workflow in the API format
+        images (list): The uploaded images with their 'name'
+        subfolder (str): The folder inside of the input folder of ComfyUI
+
+    Returns:
+        dict: A copy of the workflow, only the changed nodes are copied
+    """
+    names = {image["name"] for image in images or []}
+    scoped = dict(workflow)
+    for node_id, node in workflow.items():
+        inputs = node.get("inputs") or {}
+        changed = {
+            key: f"{subfolder}/{value}"
+            for key, value in inputs.items()
+            if isinstance(value, str) and value in names
+        }
+        if changed:
+            scoped[node_id] = {**node, "inputs": {**inputs, **changed}}
+    return scoped
+
+
+def remove_input_subfolder(subfolder):
+    """
+    Remove the input images of a job from the input folder and from the index
+
+    Images that are only known under the job's subfolder are moved to
+    INPUT_CACHE_FOLDER first, so that later jobs can still reuse them.
+
+    Args:
+        subfolder (str): The folder inside of the input folder of ComfyUI
+    """
+    path = input_cache_path(subfolder)
+    if path is None:
+        return
+    with INPUT_CACHE_LOCK:
+        ACTIVE_INPUT_SUBFOLDERS.discard(subfolder)
+        for name in [n for n in INPUT_CACHE_NAMES if n.startswith(f"{subfolder}/")]:
+            image_hash = INPUT_CACHE_NAMES[name]
+            if INPUT_CACHE[image_hash]["names"] == {name}:
+                cache_name = f"{INPUT_CACHE_FOLDER}/{image_hash}"
+                try:
+                    os.makedirs(input_cache_path(INPUT_CACHE_FOLDER), exist_ok=True)
+                    os.replace(input_cache_path(name), input_cache_path(cache_name))
+                    INPUT_CACHE[image_hash]["names"].add(cache_name)
+                    INPUT_CACHE_NAMES[cache_name] = image_hash
+                except OSError as e:
+                    print(f"runpod-worker-comfy - could not keep {name} in the cache: {e}")
+            forget_cached_input_name(name)
+        # The images of the job may have been kept beyond COMFY_INPUT_CACHE_MAX_MB
+        evict_cached_inputs()
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def output_file_paths(outputs, output_path=None):
+    """
+    Returns:
+        list: The paths of the files of a prompt in the output and temp folder of
+              ComfyUI, from the "outputs" of its history
+    """
+    folders = {
+        "output": output_path or get_output_path(),
+        "temp": COMFY_TEMP_PATH,
+    }
+    paths = []
+    for node_output in (outputs or {}).values():
+        for items in node_output.values():
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                if not isinstance(item, dict) or "filename" not in item:
+                    continue
+                folder = folders.get(item.get("type", "output"))
+                if folder is None:
+                    continue
+                paths.append(os.path.join(folder, item.get("subfolder", ""), item["filename"]))
+    return paths
+
+
+# The output files of the prompts that ran on this worker, the janitor only removes
+# these and the job subfolders of the input folder: path -> None, in the order they
+# were created
+OUTPUT_FILES = OrderedDict()
+OUTPUT_FILES_LOCK = threading.Lock()
+
+
+def record_output_files(outputs, output_path=None):
+    """
+    Remember the files of a prompt, so that the janitor can remove them later
+
+    Args:
+        outputs (dict): The "outputs" of the prompt history
+        output_path (str, optional): The output folder of ComfyUI
+    """
+    paths = output_file_paths(outputs, output_path)
+    with OUTPUT_FILES_LOCK:
+        for path in paths:
+            OUTPUT_FILES[path] = None
+
+
+def remove_output_files(outputs, output_path=None):
+    """
+    Remove the files of a prompt from the output and temp folder of ComfyUI
+
+    Args:
+        outputs (dict): The "outputs" of the prompt history
+        output_path (str, optional): The output folder of ComfyUI
+
+    Returns:
+        int: The number of files that were removed
+    """
+    removed = 0
+    for path in output_file_paths(outputs, output_path):
+        with OUTPUT_FILES_LOCK:
+            OUTPUT_FILES.pop(path, None)
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+# Start times of the jobs that are running, the janitor keeps all files newer than that
+RUNNING_JOBS = {}
+RUNNING_JOBS_LOCK = threading.Lock()
+
+
+def clean_folders(max_age_s, max_bytes):
+    """
+    Remove old files that the worker created in the folders of ComfyUI, so that the
+    disk of a worker that is not refreshed after each job doesn't fill up
+
+    Only the job subfolders of COMFY_INPUT_PATH and the recorded output files of the
+    prompts that ran on this worker are removed, files that are part of the image or
+    were added by the user are never touched. Files that are older than max_age_s are
+    removed. When the remaining files are larger than max_bytes, the oldest files are
+    removed first. Files that were created after the start of a running job and the
+    images of the input cache are kept.
+
+    Args:
+        max_age_s (float): The maximum age of a file in seconds
+        max_bytes (int): The maximum size of all files
+
+    Returns:
+        int: The number of files that were removed
+    """
+    now = time.time()
+    with RUNNING_JOBS_LOCK:
+        keep_after = min(RUNNING_JOBS.values(), default=now)
+    with INPUT_CACHE_LOCK:
+        cached = {input_cache_path(name) for name in INPUT_CACHE_NAMES}
+    with OUTPUT_FILES_LOCK:
+        paths = list(OUTPUT_FILES)
+
+    # The subfolders of the jobs are left behind when a worker was stopped during a job
+    try:
+        job_folders = [
+            os.path.join(COMFY_INPUT_PATH, name)
+            for name in os.listdir(COMFY_INPUT_PATH)
+            if name.startswith("job-") and os.path.isdir(os.path.join(COMFY_INPUT_PATH, name))
+        ]
+    except OSError:
+        job_folders = []
+    # Folders that were created after the start of a running job are kept as well
+    folder_times = {}
+    for folder in job_folders:
+        for root, dirs, filenames in os.walk(folder):
+            paths.extend(os.path.join(root, filename) for filename in filenames)
+            try:
+                folder_times[root] = os.stat(root).st_mtime
+            except OSError:
+                pass
+
+    files = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with OUTPUT_FILES_LOCK:
+                OUTPUT_FILES.pop(path, None)
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, path in sorted(files):
+        if mtime >= keep_after or path in cached:
+            continue
+        if now - mtime <= max_age_s and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+        with OUTPUT_FILES_LOCK:
+            OUTPUT_FILES.pop(path, None)
+
+    # Remove the job subfolders that are empty now
+    for root in sorted(folder_times, reverse=True):
+        if folder_times[root] < keep_after:
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+    return removed
+
+
+def start_janitor():
+    """
+    Run clean_folders every COMFY_JANITOR_INTERVAL_S seconds in a background thread
+
+    Returns:
+        threading.Thread: The thread of the janitor
+    """
+
+    def run():
+        while True:
+            time.sleep(COMFY_JANITOR_INTERVAL_S)
+            removed = clean_folders(COMFY_JANITOR_MAX_AGE_S, COMFY_JANITOR_MAX_MB * 1024 * 1024)
+            if removed:
+                print(f"runpod-worker-comfy - janitor removed {removed} old file(s)")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def upload_images(images, subfolder="", metrics=None):
+    """
+    Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
+
+    The images are uploaded concurrently by up to COMFY_UPLOAD_CONCURRENCY threads.
+
+    Args:
+        images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
+        subfolder (str, optional): The folder inside of the input folder of ComfyUI.
+        metrics (JobMetrics, optional): Records the time to decode the images.
+
+    Returns:
+        list: A list of responses from the server for each image upload.
+    """
+    if not images:
+        return {"status": "success", "message": "No images to upload", "details": []}
+
+    responses = []
+    upload_errors = []
+
+    print(f"runpod-worker-comfy - image(s) upload")
+
+    # The images go to the backend of the job, not the one of the upload thread
+    backend = get_backend()
+
+    def upload(image):
+        with use_backend(backend):
+            return upload_image(image, subfolder, metrics)
+
+    workers = max(min(COMFY_UPLOAD_CONCURRENCY, len(images)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for message, error in executor.map(upload, images):
+            if error:
+                upload_errors.append(error)
+            else:
+                responses.append(message)
+
+    if upload_errors:
+        print(f"runpod-worker-comfy - image(s) upload with errors")
+        return {
+            "status": "error",
+            "message": "Some images failed to upload",
+            "details": upload_errors,
+        }
+
+    print(f"runpod-worker-comfy - image(s) upload complete")
+    return {
+        "status": "success",
+        "message": "All images uploaded successfully",
+        "details": responses,
+    }
+
+
+def queue_workflow(workflow, client_id=None):
+    """
+    Queue a workflow to be processed by ComfyUI
+
+    Args:
+        workflow (dict): A dictionary containing the workflow to be processed
+        client_id (str, optional): The WebSocket client that receives the execution events
+
+    Returns:
+        dict: The JSON response from ComfyUI after processing the workflow
+    """
+
+    # The top level element "prompt" is required by ComfyUI
+    payload = {"prompt": workflow}
+    if client_id:
+        payload["client_id"] = client_id
+    data = json.dumps(payload).encode("utf-8")
+
+    response = comfy_request(
+        "POST", "/prompt", data=data, headers={"Content-Type": "application/json"}
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def get_history(prompt_id):
+    """
+    Retrieve the history of a given prompt using its ID
+
+    Args:
+        prompt_id (str): The ID of the prompt whose history is to be retrieved
+
+    Returns:
+        dict: The history of the prompt, containing all the processing steps and results
+    """
+    response = comfy_request("GET", f"/history/{prompt_id}")
+    response.raise_for_status()
+    return response.json()
+
+
+def connect_websocket(client_id):
+    """
+    Open a connection to the WebSocket event stream of ComfyUI
+
+    Args:
+        client_id (str): The ID that is used to queue the workflow, ComfyUI only sends
+                         the execution events of a prompt to the client that queued it
+
+    Returns:
+        websocket.WebSocket: The open connection or None if it could not be established
+    """
+    try:
+        ws = websocket.WebSocket()
+        ws.connect(
+            f"ws://{get_backend().address}/ws?clientId={client_id}",
+            timeout=COMFY_WEBSOCKET_RECV_TIMEOUT_S,
+        )
+        return ws
+    except (websocket.WebSocketException, OSError) as e:
+        print(f"runpod-worker-comfy - websocket not available, using polling: {e}")
+        return None
+
+
+def check_stopped(deadline=None, cancelled=None):
+    """
+    Check if a job has to stop
+
+    Args:
+        deadline (float, optional): The time.monotonic() by which the job has to be done
+        cancelled (threading.Event, optional): Is set when the job was cancelled
+
+    Returns:
+        str: The reason why the job has to stop or None
+    """
+    if cancelled is not None and cancelled.is_set():
+        return "Job was cancelled"
+    if deadline is not None and time.monotonic() > deadline:
+        return "Job timed out"
+    return None
+
+
+def poll_for_completion(prompt_id, deadline=None, cancelled=None):
+    """
+    Poll the history of a prompt until its outputs are available
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        deadline (float, optional): The time.monotonic() by which the job has to be done
+        cancelled (threading.Event, optional): Is set when the job was cancelled
+
+    Returns:
+        tuple: A tuple containing the history and an error message, if any.
+               The structure is (history, error_message).
+    """
+    retries = 0
+    try:
+        while retries < COMFY_POLLING_MAX_RETRIES:
+            stop_reason = check_stopped(deadline, cancelled)
+            if stop_reason:
+                return None, stop_reason
+
+            history = get_history(prompt_id)
+
+            # Exit the loop if we have found the history
+            if prompt_id in history and history[prompt_id].get("outputs"):
+                return history, None
+
+            # Wait before trying again
+            time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
+            retries += 1
+    except Exception as e:
+        return None, f"Error waiting for image generation: {str(e)}"
+
+    return None, "Max retries reached while waiting for image generation"
+
+
+def wait_for_completion(
+    prompt_id, ws=None, metrics=None, deadline=None, cancelled=None, on_event=None
+):
+    """
+    Wait until ComfyUI has finished the execution of a prompt
+
+    The execution events of ComfyUI are read from the WebSocket and the history is
+    only requested once the prompt is done. Without a WebSocket, or when the connection
+    drops while waiting, the history is polled instead.
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        ws (websocket.WebSocket, optional): An open connection to the event stream
+        metrics (JobMetrics, optional): Records how long the prompt was queued in
+                                        ComfyUI and the execution time of each node
+        deadline (float, optional): The time.monotonic() by which the job has to be done
+        cancelled (threading.Event, optional): Is set when the job was cancelled
+        on_event (callable, optional): Called with the type and the data of every event
+                                       of the prompt and with "preview" and the
+                                       image type (4 bytes) and data of every preview
+
+    Returns:
+        tuple: A tuple containing the history and an error message, if any.
+               The structure is (history, error_message).
+    """
+    if ws is None:
+        return poll_for_completion(prompt_id, deadline, cancelled)
+
+    # Allow the same amount of time as the polling would
+    wait_deadline = (
+        time.monotonic() + COMFY_POLLING_INTERVAL_MS * COMFY_POLLING_MAX_RETRIES / 1000
+    )
+    # The node that is executing and since when
+    waiting_since = time.perf_counter()
+    current_node = None
+    # Wake up regularly to notice when the job has to stop
+    if deadline is not None or cancelled is not None:
+        ws.settimeout(min(COMFY_WEBSOCKET_RECV_TIMEOUT_S, CANCEL_CHECK_INTERVAL_S))
+    last_message = time.monotonic()
+
+    try:
+        while True:
+            if time.monotonic() > wait_deadline:
+                return None, "Timed out while waiting for image generation"
+            stop_reason = check_stopped(deadline, cancelled)
+            if stop_reason:
+                return None, stop_reason
+
+            try:
+                message = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                if time.monotonic() - last_message < COMFY_WEBSOCKET_RECV_TIMEOUT_S:
+                    continue
+                # Make sure that we didn't miss the end of the execution
+                last_message = time.monotonic()
+                history = get_history(prompt_id)
+                if prompt_id in history and history[prompt_id].get("outputs"):
+                    return history, None
+                continue
+            last_message = time.monotonic()
+
+            # An empty message means that the server closed the connection
+            if not message:
+                raise websocket.WebSocketConnectionClosedException(
+                    "connection closed by ComfyUI"
+                )
+
+            # Binary messages contain preview images, which ComfyUI only sends to the
+            # client that queued the prompt
+            if not isinstance(message, str):
+                if on_event is not None and message[:4] == PREVIEW_IMAGE_EVENT:
+                    on_event("preview", message[4:])
+                continue
+
+            event = json.loads(message)
+            data = event.get("data") or {}
+            if data.get("prompt_id") != prompt_id:
+                continue
+            if on_event is not None:
+                on_event(event["type"], data)
+
+            if metrics is not None:
+                now = time.perf_counter()
+                if event["type"] == "execution_start":
+                    metrics.add("comfy_queue", now - waiting_since)
+                elif event["type"] == "executing":
+                    if current_node is not None:
+                        metrics.add_node(current_node[0], now - current_node[1])
+                    current_node = (data.get("node"), now) if data.get("node") else None
+
+            if event["type"] == "execution_error":
+                return (
+                    None,
+                    f"Workflow execution failed in node {data.get('node_id')} "
+                    f"({data.get('node_type')}): {data.get('exception_message')}",
+                )
+            if event["type"] == "execution_interrupted":
+                return None, "Workflow execution was interrupted"
+            # ComfyUI sends "executing" without a node after the history was written
+            if event["type"] == "executing" and data.get("node") is None:
+                break
+    except (websocket.WebSocketException, OSError) as e:
+        print(f"runpod-worker-comfy - websocket closed, falling back to polling: {e}")
+
+    return poll_for_completion(prompt_id, deadline, cancelled)
+
+
+def cancel_prompt(prompt_id):
+    """
+    Stop a prompt in ComfyUI, so that it doesn't hold the GPU for a job that is gone
+
+    A pending prompt is deleted from the queue of ComfyUI, a running prompt is
+    interrupted.
+
+    Args:
+        prompt_id (str): The ID of the prompt
+
+    Returns:
+        str: "deleted", "interrupted" or None if the prompt was not in the queue
+    """
+    try:
+        queue = comfy_request("GET", "/queue").json()
+        if any(item[1] == prompt_id for item in queue.get("queue_pending", [])):
+            comfy_request("POST", "/queue", json={"delete": [prompt_id]})
+            # Make sure that the prompt didn't start in the meantime
+            queue = comfy_request("GET", "/queue").json()
+            if not any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+                return "deleted"
+        if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+            # Older versions of ComfyUI ignore the prompt_id and interrupt the running
+            # prompt, which is this one
+            comfy_request("POST", "/interrupt", json={"prompt_id": prompt_id})
+            return "interrupted"
+    except (requests.RequestException, ValueError, IndexError, TypeError) as e:
+        print(f"runpod-worker-comfy - could not cancel prompt {prompt_id}: {e}")
+    return None
+
+
+def remove_prompt_outputs(prompt_id, output_path=None):
+    """
+    Remove the files that an interrupted prompt wrote before it was stopped
+
+    Args:
+        prompt_id (str): The ID of the prompt
+        output_path (str, optional): The output folder of ComfyUI
+
+    Returns:
+        int: The number of files that were removed
+    """
+    output_path = output_path or get_output_path()
+    deadline = time.monotonic() + COMFY_INTERRUPT_TIMEOUT_S
+    try:
+        while True:
+            history = get_history(prompt_id)
+            if prompt_id in history:
+                break
+            if time.monotonic() > deadline:
+                return 0
+            time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
+    except requests.RequestException as e:
+        print(f"runpod-worker-comfy - could not get the outputs of {prompt_id}: {e}")
+        return 0
+
+    removed = 0
+    for _, _, item in collect_output_files(history[prompt_id].get("outputs") or {}):
+        try:
+            os.remove(os.path.join(output_path, item.get("subfolder", ""), item["filename"]))
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def find_model_file(model_type, name):
+    """
+    Args:
+        model_type (str): The type of the model, e.g. "checkpoints"
+        name (str): The name of the model as used in a workflow
+
+    Returns:
+        str: The path of the model in the first folder that contains it or None
+    """
+    for folder in get_model_folders().get(model_type, []):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def preload_model_file(path):
+    """
+    Read a model file once, so that ComfyUI loads it from the page cache instead of
+    the network volume
+
+    Args:
+        path (str): The path of the model file
+
+    Returns:
+        int: The number of bytes that were read
+    """
+    total = 0
+    buffer = bytearray(PRELOAD_CHUNK_SIZE)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            total += read
+    return total
+
+
+def load_warmup_workflow():
+    """
+    Returns:
+        dict: The workflow from COMFY_WARMUP_WORKFLOW, which can also be a file like
+              test_input.json, or WARMUP_WORKFLOW
+    """
+    if not COMFY_WARMUP_WORKFLOW:
+        return WARMUP_WORKFLOW
+    try:
+        with open(COMFY_WARMUP_WORKFLOW) as f:
+            workflow = json.load(f)
+        workflow = workflow.get("input", workflow)
+        workflow = workflow.get("workflow", workflow)
+        if isinstance(workflow, dict) and workflow:
+            return workflow
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"runpod-worker-comfy - could not read {COMFY_WARMUP_WORKFLOW}: {e}")
+    return WARMUP_WORKFLOW
+
+
+def build_warmup_workflow(model, template=None):
+    """
+    Args:
+        model (str): The checkpoint that is warmed up
+        template (dict, optional): The workflow, defaults to WARMUP_WORKFLOW
+
+    Returns:
+        dict: A copy of the workflow in which every checkpoint loader loads the model
+    """
+    workflow = {}
+    for node_id, node in (template or WARMUP_WORKFLOW).items():
+        inputs = dict(node.get("inputs") or {})
+        for name, model_type in MODEL_LOADERS.get(node.get("class_type"), {}).items():
+            if model_type == "checkpoints" and name in inputs:
+                inputs[name] = model
+        workflow[node_id] = {**node, "inputs": inputs}
+    return workflow
+
+
+def warm_up_model(model, template=None):
+    """
+    Run the warm-up workflow with a model, so that ComfyUI keeps it in memory
+
+    Args:
+        model (str): The checkpoint that is warmed up
+        template (dict, optional): The workflow, see build_warmup_workflow
+
+    Returns:
+        str: An error message or None if the workflow ran
+    """
+    prompt_id, history, error_message = run_prompt(
+        build_warmup_workflow(model, template),
+        deadline=time.monotonic() + COMFY_WARMUP_TIMEOUT_S,
+    )
+    if error_message:
+        return error_message
+    if COMFY_CLEANUP_FILES:
+        remove_output_files(history[prompt_id].get("outputs"))
+    return None
+
+
+def warm_up(models=None):
+    """
+    Load models into ComfyUI before the first job arrives
+
+    With COMFY_PRELOAD_MODELS, the model files are read in parallel first, while
+    ComfyUI is still starting. Then the warm-up workflow runs once per model on every
+    backend. The duration of each model is stored in WARMUP and logged.
+
+    Args:
+        models (list, optional): The checkpoints, defaults to COMFY_WARMUP_MODELS
+
+    Returns:
+        dict: The state of the warm-up, see WARMUP
+    """
+    models = COMFY_WARMUP_MODELS if models is None else models
+    started = time.perf_counter()
+    WARMUP.update(state="running", models={}, preload_ms=None, total_ms=None)
+    try:
+        if COMFY_PRELOAD_MODELS:
+            paths = [p for p in (find_model_file("checkpoints", m) for m in models) if p]
+            with ThreadPoolExecutor(max_workers=max(COMFY_PRELOAD_CONCURRENCY, 1)) as pool:
+                preloaded = sum(pool.map(preload_model_file, paths))
+            WARMUP["preload_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            print(
+                f"runpod-worker-comfy - preloaded {len(paths)} model files "
+                f"({preloaded / 1024 / 1024:.0f} MB) in {WARMUP['preload_ms']} ms"
+            )
+
+        template = load_warmup_workflow()
+
+        def warm_up_backend(backend):
+            with use_backend(backend):
+                if models and not ensure_comfy_available():
+                    print(
+                        f"runpod-worker-comfy - ComfyUI is not available at "
+                        f"{backend.address}, skipping the warm-up"
+                    )
+                    return
+                for model in models:
+                    # Results are listed by model, with several backends by backend too
+                    name = model if len(BACKENDS) == 1 else f"{backend.address}/{model}"
+                    model_started = time.perf_counter()
+                    error_message = warm_up_model(model, template)
+                    ms = round((time.perf_counter() - model_started) * 1000, 2)
+                    WARMUP["models"][name] = {"ms": ms}
+                    if error_message:
+                        WARMUP["models"][name]["error"] = error_message
+                        print(f"runpod-worker-comfy - warm-up of {name} failed: {error_message}")
+                    else:
+                        print(f"runpod-worker-comfy - warmed up {name} in {ms} ms")
+                        with BACKENDS_LOCK:
+                            backend.models[model] = True
+
+        # Every backend loads the models into its own GPU
+        with ThreadPoolExecutor(max_workers=len(BACKENDS)) as pool:
+            list(pool.map(warm_up_backend, BACKENDS))
+    except OSError as e:
+        print(f"runpod-worker-comfy - warm-up failed: {e}")
+    finally:
+        WARMUP["total_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        WARMUP["state"] = "done"
+    print(f"runpod-worker-comfy - warm-up finished in {WARMUP['total_ms']} ms")
+    return WARMUP
+
+
+def start_warmup():
+    """
+    Run warm_up in a background thread, jobs wait for it in wait_for_warmup
+
+    Returns:
+        threading.Thread: The thread that is running the warm-up
+    """
+    global WARMUP_THREAD
+    WARMUP["state"] = "running"
+    WARMUP_THREAD = threading.Thread(target=warm_up, daemon=True)
+    WARMUP_THREAD.start()
+    return WARMUP_THREAD
+
+
+def wait_for_warmup():
+    """
+    Block until the warm-up has finished, so that the first job doesn't compete with
+    it for ComfyUI
+    """
+    thread = WARMUP_THREAD
+    if thread is not None and thread.is_alive():
+        print("runpod-worker-comfy - waiting for the warm-up to finish")
+        thread.join()
+
+
+def base64_encode(img_path, metrics=None):
+    """
+    Returns base64 encoded image.
+
+    The file is read and encoded in chunks of ENCODE_CHUNK_SIZE, and the encoded chunks
+    are joined into the string at the end. At most the encoded file is held twice, as
+    chunks and as the string, but never the content of the file as a whole.
+
+    Args:
+        img_path (str): The path to the image
+        metrics (JobMetrics, optional): Records the time to read and to encode the file
+
+    Returns:
+        str: The base64 encoded image
+    """
+    chunks = []
+    read_time = encode_time = 0.0
+    with open(img_path, "rb") as image_file:
+        while True:
+            start = time.perf_counter()
+            chunk = image_file.read(ENCODE_CHUNK_SIZE)
+            read = time.perf_counter()
+            read_time += read - start
+            if not chunk:
+                break
+            chunks.append(base64.b64encode(chunk).decode("ascii"))
+            encode_time += time.perf_counter() - read
+    if metrics is not None:
+        metrics.add("output_read", read_time)
+        metrics.add("encode", encode_time)
+    return "".join(chunks)
+
+
+def reencode_image(img_path, output_format, quality=None):
+    """
+    Convert an image into another format, e.g. to get a smaller JPEG or WebP
+
+    Animated images and files that are not images are left as they are.
+
+    Args:
+        img_path (str): The path to the image
+        output_format (str): One of OUTPUT_FORMATS
+        quality (int, optional): The quality for JPEG and WebP between 1 and 100
+
+    Returns:
+        str: The path to a temporary file with the converted image, which has to be
+             removed by the caller, or None if the image was not converted
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(img_path) as image:
+            if getattr(image, "is_animated", False):
+                return None
+            if output_format == "jpeg" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            fd, converted_path = tempfile.mkstemp(suffix=OUTPUT_FORMATS[output_format])
+            with os.fdopen(fd, "wb") as converted_file:
+                image.save(
+                    converted_file,
+                    format=output_format.upper(),
+                    quality=quality or DEFAULT_OUTPUT_QUALITY,
+                )
+            return converted_path
+    except (UnidentifiedImageError, OSError) as e:
+        print(f"runpod-worker-comfy - could not convert {img_path}: {e}")
+        return None
+
+
+class DiskResultCache:
+    """
+    Stores the output files of a workflow in a folder, so that the workflow doesn't
+    have to be executed again for the same inputs. The folder can also be on the
+    network volume to share the cache between workers.
+
+    Each entry is a folder named after the cache key, with the "outputs" of the prompt
+    history in "outputs.json" and the files in "files/". When the cache grows beyond
+    max_bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: A tuple containing the cached outputs and the folder of their
+                   files or None if the key is not in the cache
+        """
+        entry = os.path.join(self.path, key)
+        try:
+            with open(os.path.join(entry, "outputs.json")) as f:
+                outputs = json.load(f)
+            # Mark the entry as recently used
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return outputs, os.path.join(entry, "files")
+
+    def put(self, key, outputs, output_path):
+        """
+        Copy the output files of a workflow into the cache
+
+        Args:
+            key (str): The cache key, see result_cache_key
+            outputs (dict): The "outputs" of the prompt history
+            output_path (str): The folder where ComfyUI stored the files
+        """
+        entry = os.path.join(self.path, key)
+        if os.path.exists(entry):
+            return
+
+        temporary = os.path.join(self.path, f".{key}.{uuid.uuid4().hex}")
+        try:
+            for _, _, item in collect_output_files(outputs):
+                subfolder = item.get("subfolder", "")
+                os.makedirs(os.path.join(temporary, "files", subfolder), exist_ok=True)
+                shutil.copyfile(
+                    os.path.join(output_path, subfolder, item["filename"]),
+                    os.path.join(temporary, "files", subfolder, item["filename"]),
+                )
+            with open(os.path.join(temporary, "outputs.json"), "w") as f:
+                json.dump(outputs, f)
+            os.rename(temporary, entry)
+        except OSError as e:
+            # Another worker could have stored the same result in the meantime
+            if not os.path.exists(entry):
+                print(f"runpod-worker-comfy - could not cache the result: {e}")
+            shutil.rmtree(temporary, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits into max_bytes
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.path):
+                entry = os.path.join(self.path, name)
+                if name.startswith(".") or not os.path.isdir(entry):
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(root, filename))
+                    for root, _, filenames in os.walk(entry)
+                    for filename in filenames
+                )
+                entries.append((os.path.getmtime(entry), size, entry))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+
+def get_result_cache():
+    """
+    Get the result cache that is configured with COMFY_RESULT_CACHE
+
+    Returns:
+        DiskResultCache: The cache or None if it is disabled
+    """
+    if COMFY_RESULT_CACHE not in RESULT_CACHE_PATHS:
+        return None
+    path = COMFY_RESULT_CACHE_PATH or RESULT_CACHE_PATHS[COMFY_RESULT_CACHE]
+    os.makedirs(path, exist_ok=True)
+    return DiskResultCache(path, COMFY_RESULT_CACHE_MAX_MB * 1024 * 1024)
+
+
+def has_random_seed(workflow):
+    """
+    Check if the workflow creates different outputs every time it runs
+
+    Negative seeds (e.g. -1) are used by several nodes to request a random seed, and
+    nodes with "Random" in their type create random values themselves, unless they
+    get a seed, like the RandomNoise node of Flux workflows.
+
+    Args:
+        workflow (dict): The workflow in the API format
+
+    Returns:
+        bool: True if the outputs are not deterministic
+    """
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs") or {}
+        seeds = [inputs[name] for name in SEED_INPUTS if name in inputs]
+        if not seeds and "random" in str(node.get("class_type", "")).lower():
+            return True
+        for value in seeds:
+            if isinstance(value, (int, float)) and value < 0:
+                return True
+    return False
+
+
+def result_cache_key(workflow, images):
+    """
+    Create the key of a workflow and its input images for the result cache
+
+    Args:
+        workflow (dict): The workflow in the API format
+        images (list): The input images with their 'name' and 'image' or 'hash'
+
+    Returns:
+        str: The SHA-256 of the canonical JSON of the workflow and the hashes of
+             the images, or None if the workflow is not deterministic or an image
+             is fetched from a 'url', whose content is not known yet
+    """
+    if has_random_seed(workflow) or any("url" in image for image in images or []):
+        return None
+
+    image_hashes = []
+    for image in images or []:
+        if "image" in image:
+            try:
+                image_hash, _ = hash_base64(strip_base64(image["image"]))
+            except (binascii.Error, ValueError):
+                return None
+        else:
+            image_hash = str(image["hash"]).lower()
+        image_hashes.append([image["name"], image_hash])
+
+    canonical = json.dumps(
+        {"workflow": workflow, "images": sorted(image_hashes)},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def collect_output_files(outputs):
+    """
+    Find all files that were written by the workflow
+
+    Besides "images", nodes can return other types of files, like "gifs" for
+    animations and videos. Temporary files, e.g. from a PreviewImage node, are skipped.
+
+    Args:
+        outputs (dict): The "outputs" of the prompt history, keyed by node ID
+
+    Returns:
+        list: A list of (node_id, output_type, file_info) tuples in the order of the outputs
+    """
+    files = []
+    for node_id, node_output in outputs.items():
+        for output_type, items in node_output.items():
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                if (
+                    isinstance(item, dict)
+                    and "filename" in item
+                    and item.get("type", "output") != "temp"
+                ):
+                    files.append((node_id, output_type, item))
+    return files
+
+
+# The S3 client is created once and shared by all uploads, see get_s3_client
+S3_CLIENT = {}
+S3_CLIENT_LOCK = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Get the AWS S3 client for uploading the outputs, which is created on first use
+
+    Returns:
+        tuple: A tuple containing the boto3 client and its TransferConfig or
+               (None, None) if the bucket credentials are not configured
+    """
+    endpoint_url = os.environ.get("BUCKET_ENDPOINT_URL")
+    access_key_id = os.environ.get("BUCKET_ACCESS_KEY_ID")
+    secret_access_key = os.environ.get("BUCKET_SECRET_ACCESS_KEY")
+    if not (endpoint_url and access_key_id and secret_access_key):
+        return None, None
+
+    key = (endpoint_url, access_key_id, secret_access_key)
+    with S3_CLIENT_LOCK:
+        if S3_CLIENT.get("key") != key:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+
+            client = boto3.session.Session().client(
+                "s3",
+                endpoint_url=endpoint_url,
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+                region_name=rp_upload.extract_region_from_url(endpoint_url),
+                config=Config(
+                    signature_version="s3v4",
+                    retries={"max_attempts": 3, "mode": "standard"},
+                    max_pool_connections=BUCKET_UPLOAD_CONCURRENCY
+                    * COMFY_OUTPUT_CONCURRENCY,
+                ),
+            )
+            transfer_config = TransferConfig(
+                multipart_threshold=BUCKET_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+                multipart_chunksize=BUCKET_MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+                max_concurrency=BUCKET_UPLOAD_CONCURRENCY,
+                use_threads=True,
+            )
+            S3_CLIENT.update(key=key, client=client, transfer_config=transfer_config)
+        return S3_CLIENT["client"], S3_CLIENT["transfer_config"]
+
+
+def upload_output_file(job_id, local_path):
+    """
+    Upload an output file to AWS S3
+
+    Large files are uploaded in parts, with several parts being sent at the same time.
+    Without bucket credentials, rp_upload is used, which simulates the upload.
+
+    Args:
+        job_id (str): The unique identifier for the job, used as folder in the bucket
+        local_path (str): The path to the file
+
+    Returns:
+        str: The presigned or public URL of the uploaded file, see BUCKET_URL_MODE
+    """
+    client, transfer_config = get_s3_client()
+    if client is None:
+        return rp_upload.upload_image(job_id, local_path)
+
+    bucket = BUCKET_NAME or time.strftime("%m-%y")
+    extension = os.path.splitext(local_path)[1]
+    key = f"{job_id}/{uuid.uuid4().hex[:8]}{extension}"
+    content_type = mimetypes.guess_type(local_path)[0] or "application/octet-stream"
+
+    client.upload_file(
+        local_path,
+        bucket,
+        key,
+        ExtraArgs={"ContentType": content_type},
+        Config=transfer_config,
+    )
+
+    if BUCKET_URL_MODE == "public":
+        base_url = BUCKET_PUBLIC_URL or (
+            f"{os.environ['BUCKET_ENDPOINT_URL'].rstrip('/')}/{bucket}"
+        )
+        return f"{base_url.rstrip('/')}/{key}"
+
+    return client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=BUCKET_PRESIGNED_URL_EXPIRES_S,
+    )
+
+
+def copy_output_to_volume(job_id, local_path, subfolder, filename):
+    """
+    Copy an output file into OUTPUT_VOLUME_PATH
+
+    Args:
+        job_id (str): The unique identifier for the job, used as folder on the volume
+        local_path (str): The path to the file
+        subfolder (str): The subfolder of the file in the output folder of ComfyUI
+        filename (str): The name of the file
+
+    Returns:
+        str: The path of the copy
+    """
+    target = os.path.join(OUTPUT_VOLUME_PATH, job_id, subfolder, filename)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copyfile(local_path, target)
+    return target
+
+
+def process_output_file(
+    job_id,
+    output_type,
+    item,
+    output_path,
+    output_format=None,
+    output_quality=None,
+    metrics=None,
+):
+    """
+    Upload a single output file to AWS S3, copy it to OUTPUT_VOLUME_PATH or encode it
+    as base64
+
+    Args:
+        job_id (str): The unique identifier for the job
+        output_type (str): The type of the output, e.g. "images" or "gifs"
+        item (dict): The file info from the history, with "filename" and "subfolder"
+        output_path (str): The folder where ComfyUI stores its outputs
+        output_format (str, optional): Convert images into this format before returning them
+        output_quality (int, optional): The quality of converted JPEG and WebP images
+        metrics (JobMetrics, optional): Records the time to convert, encode and upload
+
+    Returns:
+        tuple: A tuple containing the result and an error message, if any.
+               The structure is (result, error_message).
+    """
+    subfolder = item.get("subfolder", "")
+    local_path = os.path.join(output_path, subfolder, item["filename"])
+
+    print(f"runpod-worker-comfy - {local_path}")
+
+    if not os.path.exists(local_path):
+        return None, f"the file does not exist in the specified output folder: {local_path}"
+
+    result = {
+        "filename": item["filename"],
+        "subfolder": subfolder,
+        "output_type": output_type,
+    }
+
+    converted_path = None
+    if output_format and output_type == "images":
+        with measure(metrics, "convert"):
+            converted_path = reencode_image(local_path, output_format, output_quality)
+    if converted_path:
+        local_path = converted_path
+        result["filename"] = (
+            os.path.splitext(item["filename"])[0] + OUTPUT_FORMATS[output_format]
+        )
+
+    try:
+        if os.environ.get("BUCKET_ENDPOINT_URL", False):
+            # URL to the file in AWS S3
+            with measure(metrics, "s3_upload"):
+                result["url"] = upload_output_file(job_id, local_path)
+        elif OUTPUT_VOLUME_PATH:
+            with measure(metrics, "volume_copy"):
+                result["path"] = copy_output_to_volume(
+                    job_id, local_path, subfolder, result["filename"]
+                )
+        else:
+            result["base64"] = base64_encode(local_path, metrics)
+    finally:
+        if converted_path:
+            os.remove(converted_path)
+    return result, None
+
+
+def process_output_images(
+    outputs,
+    job_id,
+    output_format=None,
+    output_quality=None,
+    output_path=None,
+    metrics=None,
+    processed=None,
+):
+    """
+    This function takes the "outputs" from image generation and the job ID,
+    then determines the correct way to return the files, either as direct URLs
+    to an AWS S3 bucket or as base64 encoded strings, depending on the
+    environment configuration.
 
     Args:
         outputs (dict): A dictionary containing the outputs from image generation,
                         typically includes node IDs and their respective output data.
         job_id (str): The unique identifier for the job.
+        output_format (str, optional): Convert images into "png", "jpeg" or "webp".
+        output_quality (int, optional): The quality of converted JPEG and WebP images.
+        output_path (str, optional): The folder of the files, instead of COMFY_OUTPUT_PATH.
+        metrics (JobMetrics, optional): Records the durations of the processing stages.
+        processed (dict, optional): Results of files that were already processed by
+                                    (subfolder, filename), e.g. by JobProgress.
 
     Returns:
-        dict: A dictionary with the status ('success' or 'error') and the message,
-              which is either the URL to the image in the AWS S3 bucket or a base64
-              encoded string of the image. In case of error, the message details the issue.
+        dict: A dictionary with the status ('success' or 'error'), the "outputs"
+              grouped by node ID and the "message". For compatibility, the message is
+              the URL or base64 string of the last output. In case of error, the
+              message details the issue.
 
     The function works as follows:
-    - It first determines the output path for the images from an environment variable,
+    - It first determines the output path for the files from an environment variable,
       defaulting to "/comfyui/output" if not set.
-    - It then iterates through the outputs to find the filenames of the generated images.
-    - After confirming the existence of the image in the output folder, it checks if the
-      AWS S3 bucket is configured via the BUCKET_ENDPOINT_URL environment variable.
-    - If AWS S3 is configured, it uploads the image to the bucket and returns the URL.
-    - If AWS S3 is not configured, it encodes the image in base64 and returns the string.
-    - If the image file does not exist in the output folder, it returns an error status
-      with a message indicating the missing image file.
+    - It then collects all files of all nodes, e.g. every image of a batch and
+      other output types like "gifs".
+    - The files are processed concurrently by up to COMFY_OUTPUT_CONCURRENCY threads:
+      If AWS S3 is configured via the BUCKET_ENDPOINT_URL environment variable,
+      they are uploaded to the bucket, with OUTPUT_VOLUME_PATH they are copied to
+      that folder, otherwise they are encoded as base64.
+    - Files that don't exist in the output folder are reported in "errors".
     """
 
     # The path where ComfyUI stores the generated images
-    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    COMFY_OUTPUT_PATH = output_path or get_output_path()
 
-    output_images = {}
-
-    for node_id, node_output in outputs.items():
-        if "images" in node_output:
-            for image in node_output["images"]:
-                output_images = os.path.join(image["subfolder"], image["filename"])
+    files = collect_output_files(outputs)
 
     print(f"runpod-worker-comfy - image generation is done")
 
-    # expected image output folder
-    local_image_path = f"{COMFY_OUTPUT_PATH}/{output_images}"
+    if not files:
+        return {"status": "error", "message": "the workflow did not produce any output files"}
 
-    print(f"runpod-worker-comfy - {local_image_path}")
+    processed = processed or {}
 
-    # The image is in the output folder
-    if os.path.exists(local_image_path):
-        if os.environ.get("BUCKET_ENDPOINT_URL", False):
-            # URL to image in AWS S3
-            image = rp_upload.upload_image(job_id, local_image_path)
-            print(
-                "runpod-worker-comfy - the image was generated and uploaded to AWS S3"
-            )
+    def process(f):
+        key = (f[2].get("subfolder", ""), f[2]["filename"])
+        if key in processed:
+            return processed[key], None
+        return process_output_file(
+            job_id,
+            f[1],
+            f[2],
+            COMFY_OUTPUT_PATH,
+            output_format,
+            output_quality,
+            metrics,
+        )
+
+    workers = max(min(COMFY_OUTPUT_CONCURRENCY, len(files)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(process, files))
+
+    grouped_outputs = {}
+    errors = []
+    for (node_id, _, _), (result, error) in zip(files, results):
+        if error:
+            errors.append(error)
         else:
-            # base64 image
-            image = base64_encode(local_image_path)
-            print(
-                "runpod-worker-comfy - the image was generated and converted to base64"
-            )
+            grouped_outputs.setdefault(node_id, []).append(result)
 
-        return {
-            "status": "success",
-            "message": image,
-        }
+    if not grouped_outputs:
+        print("runpod-worker-comfy - the output files do not exist in the output folder")
+        return {"status": "error", "message": errors[-1], "errors": errors}
+
+    last = list(grouped_outputs.values())[-1][-1]
+    if "url" in last:
+        destination = "uploaded to AWS S3"
+    elif "path" in last:
+        destination = f"copied to {OUTPUT_VOLUME_PATH}"
     else:
-        print("runpod-worker-comfy - the image does not exist in the output folder")
-        return {
-            "status": "error",
-            "message": f"the image does not exist in the specified output folder: {local_image_path}",
+        destination = "converted to base64"
+    print(
+        f"runpod-worker-comfy - {len(files) - len(errors)} output file(s) were {destination}"
+    )
+
+    response = {
+        "status": "success",
+        "message": last.get("url", last.get("path", last.get("base64"))),
+        "outputs": grouped_outputs,
+    }
+    if errors:
+        response["errors"] = errors
+    return response
+
+
+class JobProgress:
+    """
+    Forwards the events of a running prompt to the client of a job
+
+    The progress of the sampler, the node that is executing and the preview images
+    are sent at most every COMFY_PROGRESS_INTERVAL_S. With stream_outputs, the files
+    of every output node are processed as soon as the node has finished and are sent
+    right away.
+
+    Args:
+        send (callable): Called with every update
+        job_id (str): The unique identifier for the job
+        class_types (dict): The class_type of every node of the workflow
+        output_format (str, optional): See process_output_file
+        output_quality (int, optional): See process_output_file
+        stream_outputs (bool, optional): Send the output files as soon as they were saved
+        previews (bool, optional): Send the preview images of the sampler
+        metrics (JobMetrics, optional): Records the durations of the processing stages
+    """
+
+    def __init__(
+        self,
+        send,
+        job_id,
+        class_types,
+        output_format=None,
+        output_quality=None,
+        stream_outputs=False,
+        previews=False,
+        metrics=None,
+    ):
+        self.send = send
+        self.job_id = job_id
+        self.class_types = class_types
+        self.output_format = output_format
+        self.output_quality = output_quality
+        self.stream_outputs = stream_outputs
+        self.previews = previews
+        self.metrics = metrics
+        # The results of the files that were sent by (subfolder, filename)
+        self.processed = {}
+        self.last_sent = 0.0
+
+    def send_throttled(self, update):
+        now = time.monotonic()
+        if now - self.last_sent < COMFY_PROGRESS_INTERVAL_S:
+            return
+        self.last_sent = now
+        self.send(update)
+
+    def __call__(self, event_type, data):
+        if event_type == "progress":
+            self.send_throttled(
+                {
+                    "status": "progress",
+                    "node": data.get("node"),
+                    "class_type": self.class_types.get(data.get("node")),
+                    "value": data.get("value"),
+                    "max": data.get("max"),
+                }
+            )
+        elif event_type == "executing" and data.get("node"):
+            self.send_throttled(
+                {
+                    "status": "executing",
+                    "node": data["node"],
+                    "class_type": self.class_types.get(data["node"]),
+                }
+            )
+        elif event_type == "preview" and self.previews:
+            self.send_throttled(
+                {
+                    "status": "preview",
+                    "format": "png" if data[:4] == (2).to_bytes(4, "big") else "jpeg",
+                    "image": base64.b64encode(data[4:]).decode("ascii"),
+                }
+            )
+        elif event_type == "executed" and self.stream_outputs:
+            self.send_outputs(data.get("node"), data.get("output") or {})
+
+    def send_outputs(self, node_id, output):
+        """
+        Process the files of an output node that has just finished and send them
+
+        Args:
+            node_id (str): The ID of the node
+            output (dict): The output of the node, e.g. {"images": [...]}
+        """
+        output_path = get_output_path()
+        results = []
+        for _, output_type, item in collect_output_files({node_id: output}):
+            key = (item.get("subfolder", ""), item["filename"])
+            if key in self.processed:
+                continue
+            result, error = process_output_file(
+                self.job_id,
+                output_type,
+                item,
+                output_path,
+                self.output_format,
+                self.output_quality,
+                self.metrics,
+            )
+            if error:
+                print(f"runpod-worker-comfy - {error}")
+                continue
+            self.processed[key] = result
+            results.append(result)
+        if results:
+            self.send({"status": "output", "node": node_id, "outputs": results})
+
+
+def get_links(workflow, node):
+    """
+    Returns:
+        dict: The inputs of a node that are linked to another node of the workflow
+    """
+    return {
+        name: value
+        for name, value in (node.get("inputs") or {}).items()
+        if isinstance(value, list) and len(value) == 2 and str(value[0]) in workflow
+    }
+
+
+def batch_key(workflow):
+    """
+    Workflows with the same key have the same graph, load the same models and create
+    images of the same size, so they only differ in e.g. their prompts or seeds
+
+    Args:
+        workflow (dict): The workflow in the API format
+
+    Returns:
+        str: The key or None if the workflow can't be batched
+    """
+    if not all(isinstance(node, dict) for node in workflow.values()):
+        return None
+    if find_cycle(workflow) is not None:
+        return None
+
+    shape = []
+    for node_id, node in sorted(workflow.items()):
+        inputs = node.get("inputs") or {}
+        links = get_links(workflow, node)
+        models = MODEL_LOADERS.get(node.get("class_type"), {})
+        shape.append(
+            [
+                node_id,
+                node.get("class_type"),
+                sorted((name, str(link[0]), link[1]) for name, link in links.items()),
+                sorted(
+                    (name, inputs[name])
+                    for name in list(models) + list(BATCH_SIZE_INPUTS)
+                    if name in inputs and not isinstance(inputs[name], list)
+                ),
+            ]
+        )
+    return hashlib.sha256(json.dumps(shape, default=str).encode("utf-8")).hexdigest()
+
+
+def merge_workflows(workflows):
+    """
+    Merge workflows into one, that ComfyUI executes as a single prompt
+
+    Nodes that are the same in several workflows, like the checkpoint loader or the
+    negative prompt, are only added once. Output nodes and nodes that no other node
+    is linked to stay separate, so that every workflow gets its own files.
+
+    Args:
+        workflows (list): The workflows in the API format
+
+    Returns:
+        tuple: The merged workflow and for every workflow the ID of each of its nodes
+               in the merged workflow
+    """
+    object_info = get_object_info() or {}
+    merged = {}
+    shared = {}
+    mappings = []
+
+    for index, workflow in enumerate(workflows):
+        mapping = {}
+        linked = {
+            str(link[0])
+            for node in workflow.values()
+            for link in get_links(workflow, node).values()
         }
 
+        def add(node_id):
+            if node_id in mapping:
+                return mapping[node_id]
+            node = workflow[node_id]
+            links = get_links(workflow, node)
+            inputs = {
+                name: [add(str(value[0])), value[1]] if name in links else value
+                for name, value in (node.get("inputs") or {}).items()
+            }
+            signature = json.dumps([node.get("class_type"), inputs], sort_keys=True, default=str)
+            definition = object_info.get(node.get("class_type")) or {}
+            if node_id in linked and not definition.get("output_node") and signature in shared:
+                mapping[node_id] = shared[signature]
+            else:
+                mapping[node_id] = f"{index}_{node_id}"
+                merged[mapping[node_id]] = {**node, "inputs": inputs}
+                shared.setdefault(signature, mapping[node_id])
+            return mapping[node_id]
+
+        for node_id in workflow:
+            add(node_id)
+        mappings.append(mapping)
+
+    return merged, mappings
+
+
+def split_outputs(outputs, mapping):
+    """
+    Args:
+        outputs (dict): The outputs of the merged prompt by node ID
+        mapping (dict): The IDs of the nodes of a workflow in the merged prompt
+
+    Returns:
+        dict: The outputs of the workflow by the IDs of its own nodes
+    """
+    return {
+        node_id: (outputs or {})[merged_id]
+        for node_id, merged_id in mapping.items()
+        if merged_id in (outputs or {})
+    }
+
+
+class BatchEntry:
+    """
+    A workflow that waits in WorkflowBatcher, and its result once the batch has run
+
+    Args:
+        workflow (dict): The workflow in the API format
+        deadline (float, optional): The time.monotonic() by which the job has to be done
+        on_event (callable, optional): Receives the events of the workflow
+        metrics (JobMetrics, optional): Receives the durations of the batch
+    """
+
+    def __init__(self, workflow, deadline=None, on_event=None, metrics=None):
+        self.workflow = workflow
+        self.key = batch_key(workflow)
+        # Only workflows of the same backend are run together
+        self.backend = get_backend()
+        self.deadline = deadline
+        self.on_event = on_event
+        self.metrics = metrics
+        self.queued_at = time.perf_counter()
+        self.done = threading.Event()
+        # The job stopped waiting, because it was cancelled or timed out
+        self.gone = False
+        # The batch failed, so the workflow is run alone
+        self.retry = False
+        self.prompt_id = None
+        self.history = None
+        self.error = None
+
+
+class BatchCancelled:
+    """
+    Is set when all jobs of a batch are gone, see check_stopped
+
+    Args:
+        entries (list): The BatchEntry of each job of the batch
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def is_set(self):
+        return all(entry.gone for entry in self.entries)
+
+
+class WorkflowBatcher:
+    """
+    Runs compatible workflows of jobs, that arrive while ComfyUI is busy, as a single
+    prompt, see batch_key and merge_workflows
+
+    When no batch is running, a workflow is queued right away. Otherwise it waits up
+    to window_s for up to max_jobs compatible workflows. The models are only loaded
+    once per batch and the batch runs without switching models in between.
+
+    Args:
+        window_s (float): The time that a workflow waits for others in seconds
+        max_jobs (int): The maximum number of workflows in one prompt
+    """
+
+    def __init__(self, window_s, max_jobs):
+        self.window_s = window_s
+        self.max_jobs = max(max_jobs, 1)
+        self.pending = []
+        self.running = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def run(self, workflow, deadline=None, cancelled=None, on_event=None, metrics=None):
+        """
+        Run a workflow in the next batch and wait for its outputs
+
+        Args:
+            workflow (dict): The workflow in the API format
+            deadline (float, optional): The time.monotonic() by which the job has to be done
+            cancelled (threading.Event, optional): Is set when the job was cancelled
+            on_event (callable, optional): Receives the events of the workflow
+            metrics (JobMetrics, optional): Records the time until the batch started,
+                                            the stages of its prompt and the execution
+                                            time of the nodes of the workflow
+
+        Returns:
+            tuple: The ID of the prompt, the history with the outputs of this workflow
+                   and an error message, see run_prompt
+        """
+        entry = BatchEntry(workflow, deadline, on_event, metrics)
+        if entry.key is None:
+            return run_prompt(workflow, metrics, deadline, cancelled, on_event)
+
+        with self.condition:
+            self.pending.append(entry)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.dispatch, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+        while not entry.done.wait(CANCEL_CHECK_INTERVAL_S):
+            stop_reason = check_stopped(deadline, cancelled)
+            if stop_reason:
+                with self.condition:
+                    if not entry.done.is_set():
+                        # The batch removes the files of this workflow
+                        entry.gone = True
+                        if entry in self.pending:
+                            self.pending.remove(entry)
+                        return None, None, stop_reason
+
+        if entry.retry:
+            print("runpod-worker-comfy - batch failed, running the workflow alone")
+            return run_prompt(workflow, metrics, deadline, cancelled, on_event)
+        return entry.prompt_id, entry.history, entry.error
+
+    def next_batch(self):
+        """
+        Returns:
+            list: The BatchEntry of the workflows that run together, once they are ready
+        """
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            first = self.pending[0]
+            ready_at = time.monotonic() + self.window_s
+            while True:
+                batch = [
+                    e for e in self.pending if e.key == first.key and e.backend is first.backend
+                ][: self.max_jobs]
+                remaining = ready_at - time.monotonic()
+                if self.running == 0 or len(batch) >= self.max_jobs or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+                if first not in self.pending:
+                    return []
+            for entry in batch:
+                self.pending.remove(entry)
+            self.running += 1
+            return batch
+
+    def dispatch(self):
+        while True:
+            batch = self.next_batch()
+            if batch:
+                threading.Thread(target=self.execute, args=(batch,), daemon=True).start()
+
+    def execute(self, batch):
+        """
+        Run a batch as one prompt on the backend of its jobs and hand the outputs of
+        each workflow to its job
+
+        Args:
+            batch (list): The BatchEntry of each workflow
+        """
+        with use_backend(batch[0].backend):
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        deadlines = [entry.deadline for entry in batch]
+        deadline = None if None in deadlines else max(deadlines)
+        cancelled = BatchCancelled(batch)
+        started = time.perf_counter()
+        for entry in batch:
+            if entry.metrics is not None:
+                entry.metrics.add("batch_window", started - entry.queued_at)
+        metrics = JobMetrics()
+        mappings = []
+        try:
+            if len(batch) == 1:
+                workflow = batch[0].workflow
+                mappings = [{node_id: node_id for node_id in workflow}]
+            else:
+                workflow, mappings = merge_workflows([entry.workflow for entry in batch])
+                print(f"runpod-worker-comfy - running {len(batch)} jobs as one prompt")
+            prompt_id, history, error_message = run_prompt(
+                workflow, metrics, deadline, cancelled, BatchEvents(batch, mappings)
+            )
+        except Exception as e:
+            prompt_id, history, error_message = None, None, f"Error running batch: {str(e)}"
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+        # Run the workflows alone when the batch failed, so that one broken workflow
+        # doesn't fail the others
+        retry = bool(error_message) and len(batch) > 1 and not check_stopped(deadline, cancelled)
+        with self.condition:
+            for index, entry in enumerate(batch):
+                if retry:
+                    entry.retry = True
+                elif history and index < len(mappings):
+                    outputs = split_outputs(history[prompt_id].get("outputs"), mappings[index])
+                    entry.history = {prompt_id: {**history[prompt_id], "outputs": outputs}}
+                    if entry.gone and COMFY_CLEANUP_FILES:
+                        remove_output_files(outputs)
+                if entry.metrics is not None and not retry and index < len(mappings):
+                    add_batch_metrics(entry.metrics, metrics, mappings[index])
+                entry.prompt_id, entry.error = prompt_id, error_message
+                entry.done.set()
+
+
+def add_batch_metrics(job_metrics, batch_metrics, mapping):
+    """
+    Add the durations of the prompt of a batch to the metrics of one of its jobs
+
+    Args:
+        job_metrics (JobMetrics): The metrics of the job
+        batch_metrics (JobMetrics): The metrics of the prompt of the batch
+        mapping (dict): The IDs of the nodes of the workflow of the job in the prompt
+    """
+    with batch_metrics.lock:
+        stages = dict(batch_metrics.stages)
+        nodes = dict(batch_metrics.nodes)
+    for stage in ("queue", "comfy_queue", "wait"):
+        if stage in stages:
+            job_metrics.add(stage, stages[stage])
+    # Nodes that are shared by the workflows count for each of their jobs
+    for node_id, merged_id in mapping.items():
+        if merged_id in nodes:
+            job_metrics.add_node(node_id, nodes[merged_id])
+
+
+class BatchEvents:
+    """
+    Forwards the events of a merged prompt to the jobs of its workflows, with the
+    IDs of their own nodes
+
+    Args:
+        entries (list): The BatchEntry of each workflow
+        mappings (list): The IDs of the nodes of each workflow in the merged prompt
+    """
+
+    def __init__(self, entries, mappings):
+        self.targets = [
+            (entry, {merged_id: node_id for node_id, merged_id in mapping.items()})
+            for entry, mapping in zip(entries, mappings)
+        ]
+        self.executing = None
+
+    def __call__(self, event_type, data):
+        if event_type == "executing":
+            self.executing = data.get("node")
+        for entry, node_ids in self.targets:
+            if entry.on_event is None or entry.gone:
+                continue
+            if event_type == "preview":
+                # Previews belong to the sampler that is executing
+                if self.executing in node_ids:
+                    entry.on_event(event_type, data)
+            elif data.get("node") is None:
+                entry.on_event(event_type, data)
+            elif data["node"] in node_ids:
+                entry.on_event(event_type, {**data, "node": node_ids[data["node"]]})
+
+
+# Runs compatible workflows as one prompt, see COMFY_BATCH_WINDOW_MS
+BATCHER = WorkflowBatcher(COMFY_BATCH_WINDOW_MS / 1000, COMFY_BATCH_MAX_JOBS)
+
+
+def watch_job_status(job_id, cancelled, stop):
+    """
+    Request the status of a job from the RunPod API every COMFY_CANCEL_POLL_S seconds
+    until stop is set. The RunPod worker doesn't tell the handler when a job was
+    cancelled, so this is the only way to stop its prompt early.
+
+    Args:
+        job_id (str): The id of the job
+        cancelled (threading.Event): Is set when the job was cancelled or timed out
+        stop (threading.Event): Is set when the job is done
+    """
+    endpoint_id = os.environ.get("RUNPOD_ENDPOINT_ID")
+    url = f"{RUNPOD_API_URL}/{endpoint_id}/status/{job_id}"
+    headers = {"Authorization": f"Bearer {os.environ.get('RUNPOD_API_KEY')}"}
+    while not stop.wait(COMFY_CANCEL_POLL_S):
+        try:
+            response = requests.get(url, headers=headers, timeout=COMFY_CANCEL_POLL_S)
+            status = response.json().get("status") if response.status_code == 200 else None
+        except (requests.RequestException, ValueError, AttributeError):
+            continue
+        if status in RUNPOD_STOPPED_STATUSES:
+            print(f"runpod-worker-comfy - job {job_id} was {status.lower()} in RunPod")
+            cancelled.set()
+            return
+
+
+def start_status_watcher(job_id, cancelled=None):
+    """
+    Start watch_job_status in a background thread, if it is enabled
+
+    Args:
+        job_id (str): The id of the job
+        cancelled (threading.Event, optional): Is set when the job was cancelled
+
+    Returns:
+        tuple: The event that is set when the job was cancelled, which is created if
+               none was given, and the event that stops the thread or None
+    """
+    if (
+        COMFY_CANCEL_POLL_S <= 0
+        or not os.environ.get("RUNPOD_API_KEY")
+        or not os.environ.get("RUNPOD_ENDPOINT_ID")
+    ):
+        return cancelled, None
+    cancelled = cancelled or threading.Event()
+    stop = threading.Event()
+    threading.Thread(
+        target=watch_job_status, args=(job_id, cancelled, stop), daemon=True
+    ).start()
+    return cancelled, stop
+
 
-def handler(job):
+def handler(job, cancelled=None, on_update=None):
     """
     The main function that handles a job of generating an image.
 
@@ -282,69 +3873,430 @@ def handler(job):
 
     Args:
         job (dict): A dictionary containing job details and input parameters.
+        cancelled (threading.Event, optional): Is set when the job was cancelled.
+        on_update (callable, optional): Receives the progress and the output files while
+                                        the job is running, see stream_handler.
 
     Returns:
         dict: A dictionary containing either an error message or a success status with generated images.
+              With COMFY_RETURN_METRICS or "metrics": true in the input, the durations of
+              the stages of the job are added under "metrics".
+    """
+    record_startup("first_job_accepted")
+    metrics = JobMetrics()
+    token = uuid.uuid4().hex
+    with RUNNING_JOBS_LOCK:
+        RUNNING_JOBS[token] = time.time()
+    cancelled, stop_watching = start_status_watcher(job["id"], cancelled)
+    try:
+        result = run_job(job, metrics, cancelled, on_update)
+    finally:
+        if stop_watching is not None:
+            stop_watching.set()
+        with RUNNING_JOBS_LOCK:
+            del RUNNING_JOBS[token]
+    record_job_metrics(job["id"], metrics, result)
+    if COMFY_RETURN_METRICS or metrics.requested:
+        result = {**result, "metrics": metrics.as_dict()}
+    return result
+
+
+def run_job(job, metrics, cancelled=None, on_update=None):
+    """
+    Validate the input of a job and run it, unless its result is cached
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        metrics (JobMetrics): Records the durations of the stages of the job.
+        cancelled (threading.Event, optional): Is set when the job was cancelled.
+        on_update (callable, optional): Receives the progress of the job, see handler.
+
+    Returns:
+        dict: The result of the job, see handler
     """
+    started = time.monotonic()
     job_input = job["input"]
 
     # Make sure that the input is valid
-    validated_data, error_message = validate_input(job_input)
+    with metrics.span("validate"):
+        validated_data, error_message = validate_input(job_input)
     if error_message:
         return {"error": error_message}
 
     # Extract validated data
     workflow = validated_data["workflow"]
     images = validated_data.get("images")
+    timeout = validated_data["timeout"] or COMFY_JOB_TIMEOUT_S
+    deadline = started + timeout if timeout else None
+    metrics.requested = validated_data["metrics"]
+    metrics.class_types = {
+        node_id: node.get("class_type")
+        for node_id, node in workflow.items()
+        if isinstance(node, dict)
+    }
 
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    )
+    # Return the outputs of an earlier execution of the same deterministic workflow
+    result_cache = get_result_cache()
+    cache_key = result_cache_key(workflow, images) if result_cache else None
+    if cache_key:
+        with metrics.span("result_cache"):
+            cached = result_cache.get(cache_key)
+        if cached:
+            print(f"runpod-worker-comfy - returning cached result {cache_key}")
+            cached_outputs, cached_path = cached
+            with metrics.span("outputs"):
+                images_result = process_output_images(
+                    cached_outputs,
+                    job["id"],
+                    validated_data["output_format"],
+                    validated_data["output_quality"],
+                    cached_path,
+                    metrics,
+                )
+            if images_result["status"] == "success":
+                return {**images_result, "cached": True, "refresh_worker": REFRESH_WORKER}
+
+    # Pick the ComfyUI server for the job, or another one if it is not available
+    tried = []
+    with metrics.span("server_check"):
+        while True:
+            backend = select_backend(workflow, tried)
+            with use_backend(backend):
+                comfy_available = ensure_comfy_available()
+            if comfy_available or len(tried) + 1 >= len(BACKENDS):
+                break
+            release_backend(backend)
+            tried.append(backend)
+    if not comfy_available:
+        release_backend(backend)
+        # The worker can't do anything without ComfyUI, so let RunPod replace it
+        return {
+            "error": f"ComfyUI API is not available at http://{backend.address}",
+            "refresh_worker": True,
+        }
+
+    try:
+        with use_backend(backend):
+            # Let the warm-up finish, so that the models are already loaded
+            with metrics.span("warmup"):
+                wait_for_warmup()
+
+            # Find broken workflows before anything is sent to ComfyUI
+            if COMFY_VALIDATE_WORKFLOW:
+                with metrics.span("validate_workflow"):
+                    template = validated_data.get("template")
+                    if template:
+                        workflow_errors = template.validate(workflow)
+                    else:
+                        workflow_errors = validate_workflow(workflow)
+                if workflow_errors:
+                    return {"error": "Invalid workflow", "details": workflow_errors}
+
+            # Keep the images of jobs that run at the same time apart and make them easy to remove
+            input_subfolder = ""
+            if images and (COMFY_MAX_CONCURRENT_JOBS > 1 or COMFY_CLEANUP_FILES):
+                input_subfolder = f"job-{uuid.uuid4().hex}"
+                with INPUT_CACHE_LOCK:
+                    ACTIVE_INPUT_SUBFOLDERS.add(input_subfolder)
+                workflow = scope_image_names(workflow, images, input_subfolder)
+
+            try:
+                return execute_workflow(
+                    job,
+                    validated_data,
+                    workflow,
+                    input_subfolder,
+                    result_cache,
+                    cache_key,
+                    metrics,
+                    deadline,
+                    cancelled,
+                    on_update,
+                )
+            finally:
+                if input_subfolder:
+                    remove_input_subfolder(input_subfolder)
+    finally:
+        release_backend(backend)
+
+
+def run_prompt(workflow, metrics=None, deadline=None, cancelled=None, on_event=None):
+    """
+    Queue a workflow in ComfyUI and wait until it has finished. When it fails, times
+    out or is cancelled, its prompt is stopped and its files are removed.
+
+    Args:
+        workflow (dict): The workflow to queue
+        metrics (JobMetrics, optional): Records the durations of the stages of the job
+        deadline (float, optional): The time.monotonic() by which the job has to be done
+        cancelled (threading.Event, optional): Is set when the job was cancelled
+        on_event (callable, optional): Receives the events of the prompt, see
+                                       wait_for_completion
+
+    Returns:
+        tuple: The ID of the prompt, its history and an error message, if any.
+               The structure is (prompt_id, history, error_message).
+    """
+    # Subscribe to the execution events before queuing, so that none are missed
+    client_id = str(uuid.uuid4())
+    ws = None
+    if COMFY_COMPLETION_MODE == "websocket":
+        ws = connect_websocket(client_id)
+
+    try:
+        # Queue the workflow
+        try:
+            with measure(metrics, "queue"):
+                queued_workflow = queue_workflow(workflow, client_id)
+            prompt_id = queued_workflow["prompt_id"]
+            print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
+        except Exception as e:
+            return None, None, f"Error queuing workflow: {str(e)}"
+
+        # Wait for completion
+        with measure(metrics, "wait"):
+            history, error_message = wait_for_completion(
+                prompt_id, ws, metrics, deadline, cancelled, on_event
+            )
+        if error_message:
+            # Free ComfyUI for the next jobs, in case the prompt is still queued
+            cancelled_as = cancel_prompt(prompt_id)
+            if cancelled_as:
+                print(
+                    f"runpod-worker-comfy - {error_message}, "
+                    f"prompt {prompt_id} was {cancelled_as}"
+                )
+            if cancelled_as == "interrupted":
+                remove_prompt_outputs(prompt_id)
+            return prompt_id, None, error_message
+    finally:
+        if ws is not None:
+            ws.close()
+
+    record_output_files(history[prompt_id].get("outputs"))
+    return prompt_id, history, None
+
+
+def execute_workflow(
+    job,
+    validated_data,
+    workflow,
+    input_subfolder,
+    result_cache,
+    cache_key,
+    metrics=None,
+    deadline=None,
+    cancelled=None,
+    on_update=None,
+):
+    """
+    Upload the input images, run the workflow in ComfyUI and return its outputs
+
+    Args:
+        job (dict): The job with its "id"
+        validated_data (dict): The result of validate_input
+        workflow (dict): The workflow to queue
+        input_subfolder (str): The folder for the input images inside of the input folder
+        result_cache (DiskResultCache): The result cache or None
+        cache_key (str): The key of the job in the result cache or None
+        metrics (JobMetrics, optional): Records the durations of the stages of the job
+        deadline (float, optional): The time.monotonic() by which the job has to be done
+        cancelled (threading.Event, optional): Is set when the job was cancelled
+        on_update (callable, optional): Receives the progress and the output files
+                                        while the workflow is running
+
+    Returns:
+        dict: The result of the job, see handler
+    """
+    images = validated_data.get("images")
+
+    # Tell the client what is going on while the workflow is running
+    progress = None
+    send = on_update
+    if send is None and COMFY_PROGRESS_UPDATES and os.environ.get("RUNPOD_WEBHOOK_GET_JOB"):
+        send = lambda update: runpod.serverless.progress_update(job, update)
+    if send is not None:
+        progress = JobProgress(
+            send,
+            job["id"],
+            {
+                node_id: node.get("class_type")
+                for node_id, node in workflow.items()
+                if isinstance(node, dict)
+            },
+            validated_data["output_format"],
+            validated_data["output_quality"],
+            stream_outputs=on_update is not None,
+            previews=validated_data["previews"] or COMFY_STREAM_PREVIEWS,
+            metrics=metrics,
+        )
 
     # Upload images if they exist
-    upload_result = upload_images(images)
+    with measure(metrics, "upload"):
+        upload_result = upload_images(images, input_subfolder, metrics)
 
     if upload_result["status"] == "error":
         return upload_result
 
-    # Queue the workflow
-    try:
-        queued_workflow = queue_workflow(workflow)
-        prompt_id = queued_workflow["prompt_id"]
-        print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
-    except Exception as e:
-        return {"error": f"Error queuing workflow: {str(e)}"}
+    # Don't start a workflow for a job that is already gone
+    stop_reason = check_stopped(deadline, cancelled)
+    if stop_reason:
+        return {"error": stop_reason}
 
-    # Poll for completion
     print(f"runpod-worker-comfy - wait until image generation is complete")
-    retries = 0
-    try:
-        while retries < COMFY_POLLING_MAX_RETRIES:
-            history = get_history(prompt_id)
+    if COMFY_BATCH_WINDOW_MS > 0:
+        # Run the workflow together with compatible workflows of other jobs
+        prompt_id, history, error_message = BATCHER.run(
+            workflow, deadline, cancelled, progress, metrics
+        )
+    else:
+        prompt_id, history, error_message = run_prompt(
+            workflow, metrics, deadline, cancelled, progress
+        )
+    if error_message:
+        return {"error": error_message}
 
-            # Exit the loop if we have found the history
-            if prompt_id in history and history[prompt_id].get("outputs"):
-                break
-            else:
-                # Wait before trying again
-                time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
-        else:
-            return {"error": "Max retries reached while waiting for image generation"}
-    except Exception as e:
-        return {"error": f"Error waiting for image generation: {str(e)}"}
+    if cache_key:
+        result_cache.put(
+            cache_key,
+            history[prompt_id].get("outputs"),
+            get_output_path(),
+        )
 
     # Get the generated image and return it as URL in an AWS bucket or as base64
-    images_result = process_output_images(history[prompt_id].get("outputs"), job["id"])
+    try:
+        with measure(metrics, "outputs"):
+            images_result = process_output_images(
+                history[prompt_id].get("outputs"),
+                job["id"],
+                validated_data["output_format"],
+                validated_data["output_quality"],
+                metrics=metrics,
+                processed=progress.processed if progress is not None else None,
+            )
+    finally:
+        if COMFY_CLEANUP_FILES:
+            remove_output_files(history[prompt_id].get("outputs"))
 
     result = {**images_result, "refresh_worker": REFRESH_WORKER}
 
     return result
 
 
+# Runs the jobs of async_handler, one thread per job
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=max(COMFY_MAX_CONCURRENT_JOBS, 1))
+
+
+async def async_handler(job):
+    """
+    Handle a job without blocking the event loop of the RunPod worker, so that up to
+    COMFY_MAX_CONCURRENT_JOBS jobs can be handled at the same time. While ComfyUI runs
+    one workflow, the images of the next job are uploaded and it is queued, and the
+    outputs of the previous job are encoded or uploaded. When the job is cancelled,
+    its prompt is removed from ComfyUI. The RunPod worker doesn't cancel this task when
+    the job is cancelled in RunPod, that is noticed by watch_job_status.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: The result of handler
+    """
+    cancelled = threading.Event()
+    try:
+        # The job keeps running in its thread when this task is cancelled, until it
+        # notices the event and stops its prompt in ComfyUI
+        return await asyncio.shield(
+            asyncio.get_running_loop().run_in_executor(JOB_EXECUTOR, handler, job, cancelled)
+        )
+    except asyncio.CancelledError:
+        print(f"runpod-worker-comfy - job {job.get('id')} was cancelled")
+        cancelled.set()
+        raise
+
+
+async def stream_handler(job):
+    """
+    Handle a job like async_handler, but yield its progress and every output file as
+    soon as it was saved, see JobProgress. The last item is the result of the job,
+    without the base64 of the files that were already sent.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: The updates of the job, each with a "status"
+    """
+    loop = asyncio.get_running_loop()
+    updates = asyncio.Queue()
+    cancelled = threading.Event()
+    try:
+        running = loop.run_in_executor(
+            JOB_EXECUTOR,
+            handler,
+            job,
+            cancelled,
+            lambda update: loop.call_soon_threadsafe(updates.put_nowait, update),
+        )
+        sent = set()
+        while True:
+            update = asyncio.ensure_future(updates.get())
+            await asyncio.wait({update, running}, return_when=asyncio.FIRST_COMPLETED)
+            if not update.done():
+                update.cancel()
+                break
+            item = update.result()
+            for output in item.get("outputs", []):
+                sent.add((output["subfolder"], output["filename"]))
+            yield item
+        while not updates.empty():
+            yield updates.get_nowait()
+
+        result = await running
+        for outputs in result.get("outputs", {}).values():
+            for i, output in enumerate(outputs):
+                if (output["subfolder"], output["filename"]) in sent and "base64" in output:
+                    if result.get("message") == output["base64"]:
+                        del result["message"]
+                    outputs[i] = {k: v for k, v in output.items() if k != "base64"}
+                    outputs[i]["streamed"] = True
+        yield result
+    except (asyncio.CancelledError, GeneratorExit):
+        print(f"runpod-worker-comfy - job {job.get('id')} was cancelled")
+        cancelled.set()
+        raise
+
+
+def concurrency_modifier(current_concurrency):
+    """
+    Returns:
+        int: The number of jobs the RunPod worker may hand out at the same time
+    """
+    return max(COMFY_MAX_CONCURRENT_JOBS, 1)
+
+
+record_startup("handler_imported")
+
+
 # Start the handler only if this script is run directly
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    load_input_cache()
+    start_health_probe()
+    if COMFY_WARMUP_MODELS:
+        start_warmup()
+    if COMFY_JANITOR_INTERVAL_S > 0:
+        start_janitor()
+    if COMFY_METRICS_PORT:
+        start_metrics_server()
+    config = {"handler": async_handler}
+    if COMFY_STREAM_OUTPUTS:
+        # /runsync and /status return the list of all updates, /stream returns them
+        # while the job is running
+        config = {
+            "handler": stream_handler,
+            "return_aggregate_stream": True,
+            "refresh_worker": REFRESH_WORKER,
+        }
+    if COMFY_MAX_CONCURRENT_JOBS > 1:
+        config["concurrency_modifier"] = concurrency_modifier
+    runpod.serverless.start(config)
@@ -85,27 +85,51 @@ start_jupyter() {
 #                               Main Program                                   #
 # ---------------------------------------------------------------------------- #
 
+# The handler measures its startup from here, see record_startup in rp_handler.py
+export WORKER_STARTED_AT="$(date +%s.%N)"
+
+# Use libtcmalloc for better memory management of ComfyUI and the handler
+TCMALLOC="$(ldconfig -p | grep -Po "libtcmalloc.so.\d" | head -n 1)"
+
+# Start ComfyUI first, it takes the longest to boot. The handler accepts jobs in the
+# meantime and holds them until ComfyUI is listening
+if [ "$SERVE_API_LOCALLY" == "true" ] || [ "$SERVER_INPOD" == "true" ]; then
+    echo "runpod-worker-comfy: Starting ComfyUI IN POD mode"
+    COMFY_ARGS="--disable-auto-launch --disable-metadata --listen"
+else
+    echo "runpod-worker-comfy: Starting ComfyUI IN SERVER mode"
+    COMFY_ARGS="--disable-auto-launch --disable-metadata"
+fi
+
+if [ "${COMFY_INSTANCES:-1}" -gt 1 ]; then
+    # One ComfyUI per GPU, each with its own port and output folder. The handler
+    # spreads the jobs over them, see COMFY_BACKENDS in rp_handler.py
+    COMFY_BACKENDS=""
+    for ((i = 0; i < COMFY_INSTANCES; i++)); do
+        port=$((8188 + i))
+        mkdir -p "/comfyui/output/${port}"
+        LD_PRELOAD="${TCMALLOC}" python3 /comfyui/main.py ${COMFY_ARGS} --port ${port} --cuda-device ${i} --output-directory "/comfyui/output/${port}" &
+        COMFY_BACKENDS="${COMFY_BACKENDS:+${COMFY_BACKENDS},}127.0.0.1:${port}=/comfyui/output/${port}"
+    done
+    export COMFY_BACKENDS
+else
+    LD_PRELOAD="${TCMALLOC}" python3 /comfyui/main.py ${COMFY_ARGS} &
+fi
+
 start_nginx
 
 setup_ssh
 start_jupyter
 export_env_vars
 
-# Use libtcmalloc for better memory management
-TCMALLOC="$(ldconfig -p | grep -Po "libtcmalloc.so.\d" | head -n 1)"
+export HANDLER_STARTED_AT="$(date +%s.%N)"
 export LD_PRELOAD="${TCMALLOC}"
 
 # Serve the API and don't shutdown the container
 if [ "$SERVE_API_LOCALLY" == "true" ] || [ "$SERVER_INPOD" == "true" ]; then
-    echo "runpod-worker-comfy: Starting ComfyUI IN POD mode"
-    python3 /comfyui/main.py --disable-auto-launch --disable-metadata --listen &
-
     echo "runpod-worker-comfy: Starting RunPod Handler"
     python3 -u /rp_handler.py --rp_serve_api --rp_api_host=0.0.0.0
 else
-    echo "runpod-worker-comfy: Starting ComfyUI IN SERVER mode"
-    python3 /comfyui/main.py --disable-auto-launch --disable-metadata &
-
     echo "runpod-worker-comfy: Starting RunPod Handler"
     python3 -u /rp_handler.py
 fi
\ No newline at end of file
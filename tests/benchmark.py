@@ -0,0 +1,313 @@
+"""
+Benchmark of the handler against a fake ComfyUI server
+
+The fake server answers immediately and only waits `--inference-delay` seconds in
+the sampler nodes, so the measured latency minus that delay is the overhead of the
+worker itself: uploading, queuing, waiting for the events, reading and encoding the
+outputs.
+
+Usage:
+    python -m tests.benchmark --iterations 50 --output benchmark.json
+    python -m tests.benchmark --baseline benchmark.json
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI
+
+
+DEFAULT_WORKFLOWS = "test_resources/workflows/*.json"
+
+
+def percentile(values, percent):
+    """
+    Args:
+        values (list): The measured values
+        percent (float): The percentile between 0 and 100
+
+    Returns:
+        float: The value below which `percent` of the values are (nearest rank)
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(math.ceil(percent / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def peak_rss_mb():
+    """
+    Returns:
+        float: The peak resident set size of this process in MB, which includes the
+               fake server as it runs in the same process
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def load_workflows(pattern):
+    """
+    Args:
+        pattern (str): Glob of the files, which contain the input of a job
+
+    Returns:
+        dict: The input of each job by the name of its file
+    """
+    workflows = {}
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            workflows[os.path.splitext(os.path.basename(path))[0]] = json.load(f)["input"]
+    return workflows
+
+
+def run_jobs(job_input, iterations, concurrency):
+    """
+    Run the same job several times through the handler
+
+    Args:
+        job_input (dict): The input of the job
+        iterations (int): How often the job is run
+        concurrency (int): The number of jobs that run at the same time
+
+    Returns:
+        tuple: The latency of each job in seconds, the results and the total time
+    """
+    jobs = [
+        {"id": f"benchmark-{i}", "input": {**job_input, "metrics": True}}
+        for i in range(iterations)
+    ]
+
+    if concurrency <= 1:
+        latencies, results = [], []
+        start = time.perf_counter()
+        for job in jobs:
+            job_start = time.perf_counter()
+            results.append(rp_handler.handler(job))
+            latencies.append(time.perf_counter() - job_start)
+        return latencies, results, time.perf_counter() - start
+
+    async def run_job(job, slots):
+        async with slots:
+            job_start = time.perf_counter()
+            result = await rp_handler.async_handler(job)
+            return time.perf_counter() - job_start, result
+
+    async def run_all():
+        slots = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(run_job(job, slots) for job in jobs))
+
+    start = time.perf_counter()
+    timed_results = asyncio.run(run_all())
+    total = time.perf_counter() - start
+    return [t for t, _ in timed_results], [r for _, r in timed_results], total
+
+
+def summarize(latencies, results, total, requests, inference_delay):
+    """
+    Returns:
+        dict: The latency percentiles in ms, the throughput and the mean duration
+              of each stage of the handler
+    """
+    stages = Counter()
+    for result in results:
+        stages.update(result.get("metrics", {}).get("stages", {}))
+
+    p50 = percentile(latencies, 50)
+    return {
+        "jobs": len(latencies),
+        "errors": sum(1 for r in results if "error" in r or r.get("status") != "success"),
+        "p50_ms": round(p50 * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(sum(latencies) / max(len(latencies), 1) * 1000, 2),
+        "overhead_p50_ms": round(max(p50 - inference_delay, 0) * 1000, 2),
+        "throughput_jobs_per_s": round(len(latencies) / total, 2) if total else 0.0,
+        "requests": dict(requests),
+        "stages_mean_ms": {
+            stage: round(ms / max(len(results), 1), 2) for stage, ms in sorted(stages.items())
+        },
+    }
+
+
+def run_benchmark(
+    workflows,
+    iterations=20,
+    warmup=2,
+    inference_delay=0.0,
+    output_size=1024 * 1024,
+    concurrency=1,
+):
+    """
+    Run each workflow against a fake ComfyUI server
+
+    Args:
+        workflows (dict): The job inputs by name, see load_workflows
+        iterations (int): The number of measured jobs per workflow
+        warmup (int): The number of jobs per workflow that run before the measurement
+        inference_delay (float): Simulated inference time of a prompt in seconds
+        output_size (int): Size of each generated image in bytes
+        concurrency (int): The number of jobs that run at the same time
+
+    Returns:
+        dict: The settings, the summary of each workflow and the peak RSS
+    """
+    output_dir = tempfile.mkdtemp()
+    input_dir = tempfile.mkdtemp()
+    settings = {
+        "iterations": iterations,
+        "warmup": warmup,
+        "inference_delay_s": inference_delay,
+        "output_size": output_size,
+        "concurrency": concurrency,
+    }
+    report = {
+        "settings": settings,
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "workflows": {},
+    }
+
+    saved = {
+        name: getattr(rp_handler, name)
+        for name in (
+            "COMFY_HOST",
+            "COMFY_INPUT_PATH",
+            "COMFY_METRICS_LOG",
+            "COMFY_VALIDATE_WORKFLOW",
+            "COMFY_MAX_CONCURRENT_JOBS",
+            "JOB_EXECUTOR",
+        )
+    }
+    saved_output_path = os.environ.get("COMFY_OUTPUT_PATH")
+    saved_stdout = sys.stdout
+    try:
+        os.environ["COMFY_OUTPUT_PATH"] = output_dir
+        rp_handler.COMFY_INPUT_PATH = input_dir
+        rp_handler.COMFY_METRICS_LOG = False
+        # The fake server only knows the node definitions of test_input.json
+        rp_handler.COMFY_VALIDATE_WORKFLOW = False
+        rp_handler.COMFY_MAX_CONCURRENT_JOBS = concurrency
+        rp_handler.JOB_EXECUTOR = rp_handler.ThreadPoolExecutor(max(concurrency, 1))
+
+        with FakeComfyUI(
+            output_dir=output_dir,
+            input_dir=input_dir,
+            inference_delay=inference_delay,
+            output_size=output_size,
+        ) as server:
+            rp_handler.COMFY_HOST = server.address
+            for name, job_input in workflows.items():
+                # The handler logs every step, which would be measured as well
+                sys.stdout = open(os.devnull, "w")
+                try:
+                    run_jobs(job_input, warmup, concurrency)
+                    server.requests.clear()
+                    latencies, results, total = run_jobs(job_input, iterations, concurrency)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout = saved_stdout
+                report["workflows"][name] = summarize(
+                    latencies, results, total, server.requests, inference_delay
+                )
+    finally:
+        sys.stdout = saved_stdout
+        rp_handler.JOB_EXECUTOR.shutdown()
+        for name, value in saved.items():
+            setattr(rp_handler, name, value)
+        if saved_output_path is None:
+            os.environ.pop("COMFY_OUTPUT_PATH", None)
+        else:
+            os.environ["COMFY_OUTPUT_PATH"] = saved_output_path
+        shutil.rmtree(output_dir, ignore_errors=True)
+        shutil.rmtree(input_dir, ignore_errors=True)
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def compare(report, baseline, max_regression):
+    """
+    Compare the latencies of a report with a baseline
+
+    Args:
+        report (dict): The result of run_benchmark
+        baseline (dict): An earlier result of run_benchmark
+        max_regression (float): The allowed increase of p95 in percent
+
+    Returns:
+        list: The lines of the comparison and if a workflow regressed
+    """
+    lines = []
+    regressed = False
+    for name, summary in report["workflows"].items():
+        before = baseline.get("workflows", {}).get(name)
+        if not before:
+            lines.append(f"{name}: no baseline")
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_jobs_per_s"):
+            change = (summary[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            lines.append(f"{name}: {key} {before[key]} -> {summary[key]} ({change:+.1f}%)")
+            if key == "p95_ms" and change > max_regression:
+                regressed = True
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--workflows", default=DEFAULT_WORKFLOWS, help="Glob of the job inputs")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--inference-delay", type=float, default=0.0, help="In seconds")
+    parser.add_argument("--output-size", type=int, default=1024 * 1024, help="In bytes")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--output", help="Save the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare the results with this JSON file")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=10.0,
+        help="Exit with 1 if p95 increased by more percent than this compared to the baseline",
+    )
+    args = parser.parse_args(argv)
+
+    workflows = load_workflows(args.workflows)
+    if not workflows:
+        parser.error(f"no workflows found in {args.workflows}")
+
+    report = run_benchmark(
+        workflows,
+        iterations=args.iterations,
+        warmup=args.warmup,
+        inference_delay=args.inference_delay,
+        output_size=args.output_size,
+        concurrency=args.concurrency,
+    )
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines, regressed = compare(report, json.load(f), args.max_regression)
+        print("\n".join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+import asyncio
+import os
+import threading
+import uuid
+from collections import Counter
+
+from aiohttp import web, WSMsgType
+
+
+# The /object_info of the nodes that are used in test_input.json
+OBJECT_INFO = {
+    "CheckpointLoaderSimple": {
+        "input": {"required": {"ckpt_name": [["sd_xl_base_1.0.safetensors"]]}},
+        "output": ["MODEL", "CLIP", "VAE"],
+    },
+    "CLIPTextEncode": {
+        "input": {"required": {"text": ["STRING", {}], "clip": ["CLIP"]}},
+        "output": ["CONDITIONING"],
+    },
+    "EmptyLatentImage": {
+        "input": {
+            "required": {"width": ["INT", {}], "height": ["INT", {}], "batch_size": ["INT", {}]}
+        },
+        "output": ["LATENT"],
+    },
+    "KSampler": {
+        "input": {
+            "required": {
+                name: ["*"]
+                for name in (
+                    "model",
+                    "seed",
+                    "steps",
+                    "cfg",
+                    "sampler_name",
+                    "scheduler",
+                    "positive",
+                    "negative",
+                    "latent_image",
+                    "denoise",
+                )
+            }
+        },
+        "output": ["LATENT"],
+    },
+    "VAEDecode": {
+        "input": {"required": {"samples": ["LATENT"], "vae": ["VAE"]}},
+        "output": ["IMAGE"],
+    },
+    "SaveImage": {
+        "input": {"required": {"images": ["IMAGE"], "filename_prefix": ["STRING", {}]}},
+        "output": [],
+    },
+}
+
+
+# Nodes that take inference_delay to execute
+SAMPLER_NODES = ("KSampler", "KSamplerAdvanced", "SamplerCustom", "SamplerCustomAdvanced")
+
+# Nodes that write images and the type of their files
+IMAGE_OUTPUT_NODES = {"SaveImage": "output", "Image Save": "output", "PreviewImage": "temp"}
+
+
+class FakeComfyUI:
+    """
+    A minimal stand-in for the ComfyUI server that can be used in tests.
+
+    It implements the endpoints that the worker talks to (`/`, `/prompt`, `/history`,
+    `/upload/image`, `/object_info`, `/queue`, `/interrupt` and `/ws`) and simulates the
+    execution of a workflow by sending the same WebSocket events as ComfyUI and writing
+    output files into `output_dir`. Like ComfyUI, it executes one prompt at a time.
+
+    Args:
+        output_dir (str, optional): Folder where the generated images are written to
+        input_dir (str, optional): Folder where the uploaded images are written to
+        inference_delay (float, optional): Simulated inference time per prompt in seconds
+        output_size (int, optional): Size of each generated output file in bytes
+        drop_websocket (bool, optional): Close every WebSocket right after it was opened
+        fail_execution (bool, optional): Report an "execution_error" for every prompt
+        previews (bool, optional): Send a preview image after every sampler step
+    """
+
+    def __init__(
+        self,
+        output_dir=None,
+        input_dir=None,
+        inference_delay=0.0,
+        output_size=1024,
+        drop_websocket=False,
+        fail_execution=False,
+        previews=False,
+    ):
+        self.output_dir = output_dir
+        self.input_dir = input_dir
+        self.inference_delay = inference_delay
+        self.output_size = output_size
+        self.drop_websocket = drop_websocket
+        self.fail_execution = fail_execution
+        self.previews = previews
+
+        self.requests = Counter()
+        self.uploads = {}
+        self.prompts = {}
+        self.history = {}
+
+        self.pending = []
+        self.running = None
+        self.interrupted = set()
+
+        self._sockets = {}
+        self._execution_lock = None
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self.port = None
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.port}"
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start_site())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait(10)
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+        self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    async def _start_site(self):
+        # Like ComfyUI, only one prompt is executed at a time
+        self._execution_lock = asyncio.Lock()
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_get("/", self._index)
+        app.router.add_post("/prompt", self._prompt)
+        app.router.add_get("/history/{prompt_id}", self._history)
+        app.router.add_post("/upload/image", self._upload_image)
+        app.router.add_get("/object_info", self._object_info)
+        app.router.add_get("/queue", self._get_queue)
+        app.router.add_post("/queue", self._post_queue)
+        app.router.add_post("/interrupt", self._interrupt)
+        app.router.add_get("/ws", self._websocket)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def _index(self, request):
+        self.requests["/"] += 1
+        return web.Response(text="ComfyUI")
+
+    async def _prompt(self, request):
+        self.requests["/prompt"] += 1
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        self.prompts[prompt_id] = body
+        self.pending.append(prompt_id)
+        asyncio.ensure_future(
+            self._execute(prompt_id, body["prompt"], body.get("client_id"))
+        )
+        return web.json_response({"prompt_id": prompt_id, "number": 0, "node_errors": {}})
+
+    async def _history(self, request):
+        self.requests["/history"] += 1
+        prompt_id = request.match_info["prompt_id"]
+        if prompt_id in self.history:
+            return web.json_response({prompt_id: self.history[prompt_id]})
+        return web.json_response({})
+
+    async def _upload_image(self, request):
+        self.requests["/upload/image"] += 1
+        form = await request.post()
+        image = form["image"]
+        subfolder = form.get("subfolder", "")
+        name = f"{subfolder}/{image.filename}" if subfolder else image.filename
+        self.uploads[name] = image.file.read()
+        if self.input_dir:
+            os.makedirs(os.path.join(self.input_dir, subfolder), exist_ok=True)
+            with open(os.path.join(self.input_dir, name), "wb") as f:
+                f.write(self.uploads[name])
+        return web.json_response(
+            {"name": image.filename, "subfolder": subfolder, "type": "input"}
+        )
+
+    async def _object_info(self, request):
+        self.requests["/object_info"] += 1
+        return web.json_response(OBJECT_INFO)
+
+    async def _get_queue(self, request):
+        self.requests["/queue"] += 1
+        running = [self.running] if self.running else []
+        return web.json_response(
+            {
+                "queue_running": [[0, prompt_id, {}, {}, []] for prompt_id in running],
+                "queue_pending": [
+                    [number, prompt_id, {}, {}, []]
+                    for number, prompt_id in enumerate(self.pending, 1)
+                ],
+            }
+        )
+
+    async def _post_queue(self, request):
+        self.requests["/queue"] += 1
+        body = await request.json()
+        if body.get("clear"):
+            self.pending.clear()
+        for prompt_id in body.get("delete", []):
+            if prompt_id in self.pending:
+                self.pending.remove(prompt_id)
+        return web.Response()
+
+    async def _interrupt(self, request):
+        self.requests["/interrupt"] += 1
+        body = await request.json() if request.can_read_body else {}
+        prompt_id = body.get("prompt_id")
+        if self.running and prompt_id in (None, self.running):
+            self.interrupted.add(self.running)
+        return web.Response()
+
+    async def _websocket(self, request):
+        self.requests["/ws"] += 1
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId")
+        self._sockets[client_id] = ws
+        await ws.send_json(
+            {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": 0}}}}
+        )
+        if self.drop_websocket:
+            await ws.close()
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self._sockets.pop(client_id, None)
+        return ws
+
+    async def _send(self, client_id, event_type, data):
+        ws = self._sockets.get(client_id)
+        if ws is None or ws.closed:
+            return
+        try:
+            await ws.send_json({"type": event_type, "data": data})
+        except ConnectionError:
+            pass
+
+    async def _execute(self, prompt_id, workflow, client_id):
+        async with self._execution_lock:
+            # The prompt was deleted from the queue
+            if prompt_id not in self.pending:
+                return
+            self.pending.remove(prompt_id)
+            self.running = prompt_id
+            try:
+                await self._run(prompt_id, workflow, client_id)
+            finally:
+                self.running = None
+
+    async def _run(self, prompt_id, workflow, client_id):
+        await self._send(client_id, "execution_start", {"prompt_id": prompt_id})
+        outputs = {}
+        for node_id, node in workflow.items():
+            await self._send(
+                client_id, "executing", {"node": node_id, "prompt_id": prompt_id}
+            )
+            if self.fail_execution:
+                await self._send(
+                    client_id,
+                    "execution_error",
+                    {
+                        "prompt_id": prompt_id,
+                        "node_id": node_id,
+                        "node_type": node.get("class_type"),
+                        "exception_message": "simulated failure",
+                    },
+                )
+                self.history[prompt_id] = {"outputs": {}, "status": {"status_str": "error"}}
+                return
+            if node.get("class_type") in SAMPLER_NODES:
+                await self._sample(prompt_id, client_id, node_id, node)
+            if prompt_id in self.interrupted:
+                await self._send(
+                    client_id,
+                    "execution_interrupted",
+                    {"prompt_id": prompt_id, "node_id": node_id},
+                )
+                self.history[prompt_id] = {
+                    "outputs": outputs,
+                    "status": {"status_str": "error", "completed": False},
+                }
+                return
+            if node.get("class_type") in IMAGE_OUTPUT_NODES:
+                outputs[node_id] = {"images": self._write_images(prompt_id, node_id, node)}
+                await self._send(
+                    client_id,
+                    "executed",
+                    {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id},
+                )
+
+        await self._send(client_id, "execution_success", {"prompt_id": prompt_id})
+        self.history[prompt_id] = {
+            "outputs": outputs,
+            "status": {"status_str": "success", "completed": True},
+        }
+        await self._send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    async def _sample(self, prompt_id, client_id, node_id, node):
+        steps = node.get("inputs", {}).get("steps")
+        steps = steps if isinstance(steps, int) and steps > 0 else 10
+        for step in range(1, steps + 1):
+            # Stop early when the prompt is interrupted, like ComfyUI does between steps
+            deadline = asyncio.get_running_loop().time() + self.inference_delay / steps
+            while prompt_id not in self.interrupted:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, 0.02))
+            if prompt_id in self.interrupted:
+                return
+            await self._send(
+                client_id,
+                "progress",
+                {"value": step, "max": steps, "prompt_id": prompt_id, "node": node_id},
+            )
+            if self.previews:
+                await self._send_preview(client_id)
+
+    async def _send_preview(self, client_id):
+        ws = self._sockets.get(client_id)
+        if ws is None or ws.closed:
+            return
+        try:
+            # Event type 1 (preview image) and image type 1 (JPEG)
+            await ws.send_bytes(
+                (1).to_bytes(4, "big") + (1).to_bytes(4, "big") + b"\xff\xd8preview"
+            )
+        except ConnectionError:
+            pass
+
+    def _write_images(self, prompt_id, node_id, node):
+        output_type = IMAGE_OUTPUT_NODES[node["class_type"]]
+        prefix = node.get("inputs", {}).get("filename_prefix", "ComfyUI")
+        subfolder, prefix = os.path.split(str(prefix))
+        filename = f"{prefix}_{prompt_id[:8]}_{node_id}_.png"
+        if output_type == "temp":
+            return [{"filename": filename, "subfolder": subfolder, "type": output_type}]
+        if self.output_dir:
+            folder = os.path.join(self.output_dir, subfolder)
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, filename), "wb") as f:
+                f.write(b"\x89PNG\r\n\x1a\n" + os.urandom(max(self.output_size - 8, 0)))
+        return [{"filename": filename, "subfolder": subfolder, "type": "output"}]
@@ -0,0 +1,328 @@
+import unittest
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from src import restore_snapshot
+
+
+def git(*args, cwd=None):
+    return subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def create_wheel(folder, name, version):
+    """Write a minimal pure Python wheel without building it"""
+    dist_info = f"{name}-{version}.dist-info"
+    path = os.path.join(folder, f"{name}-{version}-py3-none-any.whl")
+    files = {
+        f"{name}/__init__.py": f"VERSION = '{version}'\n",
+        f"{dist_info}/METADATA": f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n",
+        f"{dist_info}/WHEEL": (
+            "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n"
+        ),
+    }
+    files[f"{dist_info}/RECORD"] = "".join(f"{n},,\n" for n in files) + f"{dist_info}/RECORD,,\n"
+    with zipfile.ZipFile(path, "w") as f:
+        for filename, content in files.items():
+            f.writestr(filename, content)
+
+
+class RegistryRequestHandler(BaseHTTPRequestHandler):
+    """Answers like the registry of custom nodes, serves the archives of self.server.files"""
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path.endswith("/install"):
+            name = path.split("/")[2]
+            archive = f"/{name}-{query.split('=')[1]}.zip"
+            if archive not in self.server.files:
+                self.send_error(404)
+                return
+            base = f"http://127.0.0.1:{self.server.server_port}"
+            content = json.dumps({"downloadUrl": base + archive}).encode("utf-8")
+        elif path in self.server.files:
+            content = self.server.files[path]
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def create_archive(files):
+    """Returns the content of a zip file with the given files"""
+    with tempfile.TemporaryFile() as f:
+        with zipfile.ZipFile(f, "w") as archive:
+            for filename, content in files.items():
+                archive.writestr(filename, content)
+        f.seek(0)
+        return f.read()
+
+
+class TestRestoreSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.workspace = os.path.join(self.root, "comfyui")
+        self.wheel_dir = os.path.join(self.root, "wheels")
+        os.makedirs(self.wheel_dir)
+        create_wheel(self.wheel_dir, "tinypkg", "1.0")
+
+        # A custom node with a requirement and an install script, in two versions
+        self.commits = self.create_repo(
+            "ComfyUI-Tiny",
+            [
+                {"nodes.py": "VERSION = 1\n"},
+                {
+                    "nodes.py": "VERSION = 2\n",
+                    "requirements.txt": "# needed by the nodes\ntinypkg==1.0\n",
+                    "install.py": "open('installed', 'a').write('x')\n",
+                },
+            ],
+        )
+        self.other_commits = self.create_repo("other-nodes", [{"other.py": "\n"}])
+
+        # An environment without pip, which is run by the pip of the tests
+        subprocess.run(
+            [sys.executable, "-m", "venv", "--without-pip", os.path.join(self.root, "venv")],
+            check=True,
+        )
+        self.python = os.path.join(self.root, "venv", "bin", "python")
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def create_repo(self, name, versions):
+        work = os.path.join(self.root, "work", name)
+        os.makedirs(work)
+        git("init", "-q", cwd=work)
+        commits = []
+        for files in versions:
+            for filename, content in files.items():
+                with open(os.path.join(work, filename), "w") as f:
+                    f.write(content)
+            git("add", ".", cwd=work)
+            git("-c", "user.name=test", "-c", "user.email=t@t", "commit", "-qm", "v", cwd=work)
+            commits.append(git("rev-parse", "HEAD", cwd=work))
+        git("clone", "-q", "--bare", work, os.path.join(self.root, "remote", f"{name}.git"))
+        return commits
+
+    def write_snapshot(self, nodes, pips=None, cnr_nodes=None):
+        path = os.path.join(self.root, "snapshot.json")
+        snapshot = {
+            "comfyui": "0" * 40,
+            "git_custom_nodes": {
+                os.path.join(self.root, "remote", f"{name}.git"): {
+                    "hash": commit,
+                    "disabled": disabled,
+                }
+                for name, commit, disabled in nodes
+            },
+            "cnr_custom_nodes": cnr_nodes or {},
+            "file_custom_nodes": [{"filename": "websocket_image_save.py", "disabled": False}],
+            "pips": pips or {},
+        }
+        with open(path, "w") as f:
+            json.dump(snapshot, f)
+        return path
+
+    def restore(self, path):
+        return restore_snapshot.restore_snapshot(
+            path,
+            workspace=self.workspace,
+            jobs=4,
+            wheel_dir=self.wheel_dir,
+            python=self.python,
+            offline=True,
+        )
+
+    def node_path(self, name):
+        return os.path.join(self.workspace, "custom_nodes", name)
+
+    def node_commit(self, name):
+        return git("rev-parse", "HEAD", cwd=self.node_path(name))
+
+    def import_version(self):
+        return subprocess.run(
+            [self.python, "-c", "import tinypkg; print(tinypkg.VERSION)"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    def test_nodes_are_cloned_and_their_requirements_installed(self):
+        path = self.write_snapshot(
+            [
+                ("ComfyUI-Tiny", self.commits[1], False),
+                ("other-nodes", self.other_commits[0], False),
+            ]
+        )
+
+        report = self.restore(path)
+
+        self.assertEqual(
+            {name: node["action"] for name, node in report["nodes"].items()},
+            {"ComfyUI-Tiny": "clone", "other-nodes": "clone"},
+        )
+        self.assertTrue(all("seconds" in node for node in report["nodes"].values()))
+        self.assertEqual(self.node_commit("ComfyUI-Tiny"), self.commits[1])
+        self.assertEqual(report["pip"]["packages"], 1)
+        self.assertEqual(self.import_version(), "1.0")
+        with open(os.path.join(self.node_path("ComfyUI-Tiny"), "installed")) as f:
+            self.assertEqual(f.read(), "x")
+
+    def test_installed_nodes_are_skipped(self):
+        path = self.write_snapshot([("ComfyUI-Tiny", self.commits[1], False)])
+        self.restore(path)
+
+        report = self.restore(path)
+
+        self.assertEqual(report["nodes"]["ComfyUI-Tiny"]["action"], "skip")
+        self.assertEqual(report["pip"]["packages"], 0)
+        # The install script didn't run again
+        with open(os.path.join(self.node_path("ComfyUI-Tiny"), "installed")) as f:
+            self.assertEqual(f.read(), "x")
+
+    def test_installed_node_is_moved_to_the_commit_of_the_snapshot(self):
+        self.restore(self.write_snapshot([("ComfyUI-Tiny", self.commits[0], False)]))
+        self.assertEqual(self.import_version(), "")
+
+        report = self.restore(self.write_snapshot([("ComfyUI-Tiny", self.commits[1], False)]))
+
+        self.assertEqual(report["nodes"]["ComfyUI-Tiny"]["action"], "checkout")
+        self.assertEqual(self.node_commit("ComfyUI-Tiny"), self.commits[1])
+        self.assertEqual(self.import_version(), "1.0")
+
+    def test_disabled_nodes_are_not_cloned(self):
+        path = self.write_snapshot([("other-nodes", self.other_commits[0], True)])
+
+        report = self.restore(path)
+
+        self.assertEqual(report["nodes"]["other-nodes"]["action"], "disabled")
+        self.assertFalse(os.path.exists(self.node_path("other-nodes")))
+
+    def test_failed_node_does_not_stop_the_others(self):
+        path = self.write_snapshot(
+            [
+                ("missing", "1" * 40, False),
+                ("other-nodes", self.other_commits[0], False),
+            ]
+        )
+
+        report_path = os.path.join(self.root, "report.json")
+        exit_code = restore_snapshot.main(
+            [path, "--workspace", self.workspace, "--python", self.python, "--report", report_path]
+        )
+
+        self.assertEqual(exit_code, 1)
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertIn("error", report["nodes"]["missing"])
+        self.assertFalse(os.path.exists(self.node_path("missing")))
+        self.assertNotIn("error", report["nodes"]["other-nodes"])
+        self.assertEqual(self.node_commit("other-nodes"), self.other_commits[0])
+
+    def test_pins_that_cannot_be_installed_are_skipped(self):
+        # A snapshot that was made on Windows
+        path = self.write_snapshot([], pips={"tinypkg==1.0": "", "pywin32==308": ""})
+
+        report_path = os.path.join(self.root, "report.json")
+        exit_code = restore_snapshot.main(
+            [
+                path,
+                "--workspace",
+                self.workspace,
+                "--python",
+                self.python,
+                "--wheel-dir",
+                self.wheel_dir,
+                "--offline",
+                "--report",
+                report_path,
+            ]
+        )
+
+        self.assertEqual(exit_code, 0)
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertEqual(report["pip"]["packages"], 1)
+        self.assertEqual(report["pip"]["skipped"], ["pywin32==308"])
+        self.assertEqual(self.import_version(), "1.0")
+
+    def test_registry_nodes_are_downloaded(self):
+        registry = ThreadingHTTPServer(("127.0.0.1", 0), RegistryRequestHandler)
+        registry.files = {}
+        for version in ("1.0.0", "1.1.0"):
+            registry.files[f"/comfyui-tiny-{version}.zip"] = create_archive(
+                {
+                    "__init__.py": "\n",
+                    "pyproject.toml": f'[project]\nname = "comfyui-tiny"\nversion = "{version}"\n',
+                    "requirements.txt": "tinypkg==1.0\n",
+                }
+            )
+        threading.Thread(target=registry.serve_forever, daemon=True).start()
+        self.addCleanup(registry.server_close)
+        self.addCleanup(registry.shutdown)
+        url = f"http://127.0.0.1:{registry.server_port}"
+
+        with patch.object(restore_snapshot, "COMFY_REGISTRY_URL", url):
+            first = self.restore(self.write_snapshot([], cnr_nodes={"comfyui-tiny": "1.0.0"}))
+            second = self.restore(self.write_snapshot([], cnr_nodes={"comfyui-tiny": "1.0.0"}))
+            update = self.restore(self.write_snapshot([], cnr_nodes={"comfyui-tiny": "1.1.0"}))
+            missing = self.restore(self.write_snapshot([], cnr_nodes={"comfyui-tiny": "2.0.0"}))
+
+        self.assertEqual(first["nodes"]["comfyui-tiny"]["action"], "install")
+        self.assertEqual(self.import_version(), "1.0")
+        self.assertEqual(second["nodes"]["comfyui-tiny"]["action"], "skip")
+        self.assertEqual(update["nodes"]["comfyui-tiny"]["action"], "install")
+        self.assertIn("error", missing["nodes"]["comfyui-tiny"])
+        # A failed download keeps the installed version
+        self.assertEqual(
+            restore_snapshot.get_node_version(self.node_path("comfyui-tiny")), "1.1.0"
+        )
+        self.assertEqual(
+            os.listdir(os.path.join(self.workspace, "custom_nodes")), ["comfyui-tiny"]
+        )
+
+    def test_missing_pips(self):
+        pips = {
+            "tinypkg==1.0": "",
+            "Pillow==10.0.0": "",
+            "typing_extensions==4.8.0": "",
+            "https://example.com/package.whl": "",
+            "-e git+https://example.com/repo.git#egg=repo": "",
+        }
+        installed = {"tinypkg": "1.0", "pillow": "9.0.0", "typing-extensions": "4.8.0"}
+
+        self.assertEqual(restore_snapshot.missing_pips(pips, installed), ["Pillow==10.0.0"])
+
+    def test_wheel_folder_is_only_used_when_it_has_wheels(self):
+        empty = os.path.join(self.root, "empty")
+        os.makedirs(empty)
+
+        with patch.object(restore_snapshot, "run") as run:
+            restore_snapshot.install_requirements(["tinypkg"], self.python, empty)
+            restore_snapshot.install_requirements(["tinypkg"], self.python, self.wheel_dir)
+
+        commands = [call.args[0] for call in run.call_args_list]
+        # No wheels are built, the requirements are installed directly
+        self.assertEqual(len(commands), 2)
+        self.assertTrue(all("install" in command for command in commands))
+        self.assertNotIn("--find-links", commands[0])
+        self.assertIn(self.wheel_dir, commands[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,59 +4,58 @@
 set -e
 
 # Store the path to the script we want to test
-SCRIPT_TO_TEST="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)/src/restore_snapshot.sh"
+SCRIPT_TO_TEST="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)/src/restore_snapshot.py"
 
-# Ensure the script exists and is executable
+# Ensure the script exists
 if [ ! -f "$SCRIPT_TO_TEST" ]; then
     echo "Error: Script not found at $SCRIPT_TO_TEST"
     exit 1
 fi
-chmod +x "$SCRIPT_TO_TEST"
 
-# Create test directory
+# Create test directory with an empty ComfyUI workspace
 TEST_DIR=$(mktemp -d)
+trap 'rm -rf "$TEST_DIR"' EXIT
 cd "$TEST_DIR"
-
-# Create a minimal mock snapshot file
-cat > test_restore_snapshot_temporary.json << 'EOF'
+mkdir -p comfyui/custom_nodes
+
+# Create a custom node in a local repository
+git init -q work/ComfyUI-Test-Nodes
+echo "NODE_CLASS_MAPPINGS = {}" > work/ComfyUI-Test-Nodes/__init__.py
+git -C work/ComfyUI-Test-Nodes add .
+git -C work/ComfyUI-Test-Nodes -c user.name=test -c user.email=test@test commit -qm "v1"
+COMMIT=$(git -C work/ComfyUI-Test-Nodes rev-parse HEAD)
+git clone -q --bare work/ComfyUI-Test-Nodes remote/ComfyUI-Test-Nodes.git
+
+# Create a snapshot with the custom node at its commit
+cat > test_restore_snapshot_temporary.json << EOF
 {
   "comfyui": "test-hash",
-  "git_custom_nodes": {},
+  "git_custom_nodes": {
+    "$TEST_DIR/remote/ComfyUI-Test-Nodes.git": {"hash": "$COMMIT", "disabled": false}
+  },
   "file_custom_nodes": [],
   "pips": {}
 }
 EOF
 
-# Create a mock comfy command that simulates the real comfy behavior
-cat > comfy << 'EOF'
-#!/bin/bash
-if [[ "$1" == "--workspace" && "$3" == "restore-snapshot" ]]; then
-    # Verify the snapshot file exists
-    if [[ ! -f "$4" ]]; then
-        echo "Error: Snapshot file not found"
-        exit 1
-    fi
-    echo "Mock: Restored snapshot from $4"
-    exit 0
-fi
-EOF
-
-chmod +x comfy
-export PATH="$TEST_DIR:$PATH"
-
-# Run the actual restore_snapshot script
+# Run the actual restore_snapshot script twice, the second run skips the node
 echo "Testing snapshot restoration..."
 echo "Script location: $SCRIPT_TO_TEST"
-"$SCRIPT_TO_TEST"
-
-# Verify the script executed successfully
-if [ $? -eq 0 ]; then
-    echo "✅ Test passed: Snapshot restoration script executed successfully"
+python3 "$SCRIPT_TO_TEST" test_restore_snapshot_temporary.json \
+    --workspace comfyui --report first.json
+python3 "$SCRIPT_TO_TEST" test_restore_snapshot_temporary.json \
+    --workspace comfyui --report second.json
+
+# Verify the custom node was cloned at the commit of the snapshot
+RESTORED=$(git -C comfyui/custom_nodes/ComfyUI-Test-Nodes rev-parse HEAD)
+ACTIONS=$(python3 -c '
+import json, sys
+print(" ".join(json.load(open(f))["nodes"]["ComfyUI-Test-Nodes"]["action"] for f in sys.argv[1:]))
+' first.json second.json)
+
+if [ "$RESTORED" = "$COMMIT" ] && [ "$ACTIONS" = "clone skip" ]; then
+    echo "✅ Test passed: Snapshot restoration script restored the custom node"
 else
-    echo "❌ Test failed: Snapshot restoration script failed"
+    echo "❌ Test failed: custom node at $RESTORED, actions: $ACTIONS"
     exit 1
 fi
-
-# Clean up
-rm -rf "$TEST_DIR"
-  
\ No newline at end of file
@@ -1,24 +1,86 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+from unittest.mock import patch, MagicMock, mock_open
 import sys
 import os
 import json
+import asyncio
 import base64
+import hashlib
+import http.client
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib3.exceptions import MaxRetryError, NewConnectionError
 
 # Make sure that "src" is known and can be used to import rp_handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI, OBJECT_INFO
+from tests import benchmark
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
 
 # Local folder for test resources
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
 
 
+class WorkerTestCase(unittest.TestCase):
+    """
+    Starts every test with an unknown health of ComfyUI and undoes the patches and
+    removes the temporary folders of a test after it
+    """
+
+    def setUp(self):
+        self.start_patches(
+            patch.dict(rp_handler.COMFY_HEALTH, {"state": "unknown", "checked_at": 0.0})
+        )
+
+    def start_patches(self, *patches):
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def create_temp_dir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        return path
+
+    def create_output_dir(self):
+        """Returns a temporary folder that is used as the output folder of ComfyUI"""
+        path = self.create_temp_dir()
+        self.start_patches(patch.dict(os.environ, {"COMFY_OUTPUT_PATH": path}))
+        return path
+
+    def load_test_input(self):
+        with open("test_input.json") as f:
+            return json.load(f)["input"]
+
+
 class TestRunpodWorkerComfy(unittest.TestCase):
     def test_valid_input_with_workflow_only(self):
         input_data = {"workflow": {"key": "value"}}
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None})
+        self.assertEqual(
+            validated_data,
+            {
+                "workflow": {"key": "value"},
+                "images": None,
+                "output_format": None,
+                "output_quality": None,
+                "metrics": False,
+                "timeout": None,
+                "previews": False,
+                "template": None,
+            },
+        )
 
     def test_valid_input_with_workflow_and_images(self):
         input_data = {
@@ -27,7 +89,18 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         }
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, input_data)
+        self.assertEqual(
+            validated_data,
+            {
+                **input_data,
+                "output_format": None,
+                "output_quality": None,
+                "metrics": False,
+                "timeout": None,
+                "previews": False,
+                "template": None,
+            },
+        )
 
     def test_input_missing_workflow(self):
         input_data = {"images": [{"name": "image1.png", "image": "base64string"}]}
@@ -43,7 +116,9 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNotNone(error)
         self.assertEqual(
-            error, "'images' must be a list of objects with 'name' and 'image' keys"
+            error,
+            "'images' must be a list of objects with 'name' and 'image' (or 'hash' "
+            "or 'url') keys",
         )
 
     def test_invalid_json_string_input(self):
@@ -56,7 +131,36 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         input_data = '{"workflow": {"key": "value"}}'
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None})
+        self.assertEqual(
+            validated_data,
+            {
+                "workflow": {"key": "value"},
+                "images": None,
+                "output_format": None,
+                "output_quality": None,
+                "metrics": False,
+                "timeout": None,
+                "previews": False,
+                "template": None,
+            },
+        )
+
+    def test_valid_input_with_output_format(self):
+        input_data = {"workflow": {}, "output_format": "JPG", "output_quality": 80}
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+        self.assertEqual(validated_data["output_format"], "jpeg")
+        self.assertEqual(validated_data["output_quality"], 80)
+
+    def test_input_with_invalid_output_format(self):
+        validated_data, error = rp_handler.validate_input(
+            {"workflow": {}, "output_format": "tiff"}
+        )
+        self.assertEqual(error, "'output_format' must be one of: png, jpeg, webp")
+        validated_data, error = rp_handler.validate_input(
+            {"workflow": {}, "output_quality": 101}
+        )
+        self.assertEqual(error, "'output_quality' must be an integer between 1 and 100")
 
     def test_empty_input(self):
         input_data = None
@@ -64,55 +168,101 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIsNotNone(error)
         self.assertEqual(error, "Please provide input")
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_up(self, mock_requests):
+    @patch.object(rp_handler.SESSION, "get")
+    def test_check_server_server_up(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_requests.return_value = mock_response
+        mock_get.return_value = mock_response
 
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertTrue(result)
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_down(self, mock_requests):
-        mock_requests.get.side_effect = rp_handler.requests.RequestException()
+    @patch.object(rp_handler.SESSION, "get")
+    def test_check_server_server_down(self, mock_get):
+        mock_get.side_effect = rp_handler.requests.RequestException()
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertFalse(result)
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_queue_prompt(self, mock_urlopen):
+    @patch.object(rp_handler.SESSION, "request")
+    def test_queue_prompt(self, mock_request):
         mock_response = MagicMock()
-        mock_response.read.return_value = json.dumps({"prompt_id": "123"}).encode()
-        mock_urlopen.return_value = mock_response
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"prompt_id": "123"}
+        mock_request.return_value = mock_response
         result = rp_handler.queue_workflow({"prompt": "test"})
         self.assertEqual(result, {"prompt_id": "123"})
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_get_history(self, mock_urlopen):
-        # Mock response data as a JSON string
-        mock_response_data = json.dumps({"key": "value"}).encode("utf-8")
-
-        # Define a mock response function for `read`
-        def mock_read():
-            return mock_response_data
-
-        # Create a mock response object
-        mock_response = Mock()
-        mock_response.read = mock_read
-
-        # Mock the __enter__ and __exit__ methods to support the context manager
-        mock_response.__enter__ = lambda s: s
-        mock_response.__exit__ = Mock()
-
-        # Set the return value of the urlopen mock
-        mock_urlopen.return_value = mock_response
+    @patch.object(rp_handler.SESSION, "request")
+    def test_get_history(self, mock_request):
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"key": "value"}
+        mock_request.return_value = mock_response
 
         # Call the function under test
         result = rp_handler.get_history("123")
 
         # Assertions
         self.assertEqual(result, {"key": "value"})
-        mock_urlopen.assert_called_with("http://127.0.0.1:8188/history/123")
+        mock_request.assert_called_with(
+            "GET",
+            "http://127.0.0.1:8188/history/123",
+            timeout=(rp_handler.COMFY_CONNECT_TIMEOUT_S, rp_handler.COMFY_READ_TIMEOUT_S),
+        )
+
+    @patch("rp_handler.time.sleep")
+    @patch.object(rp_handler.SESSION, "request")
+    def test_comfy_request_retries_unavailable(self, mock_request, mock_sleep):
+        unavailable = MagicMock(status_code=503)
+        ok = MagicMock(status_code=200)
+        mock_request.side_effect = [unavailable, rp_handler.requests.ConnectionError(), ok]
+
+        response = rp_handler.comfy_request("GET", "/history/123", retries=3)
+
+        self.assertIs(response, ok)
+        self.assertEqual(mock_request.call_count, 3)
+
+    @patch.object(rp_handler.SESSION, "request")
+    def test_comfy_request_does_not_retry_post_after_read_timeout(self, mock_request):
+        mock_request.side_effect = rp_handler.requests.ReadTimeout()
+
+        with self.assertRaises(rp_handler.requests.ReadTimeout):
+            rp_handler.comfy_request("POST", "/prompt", retries=3)
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch.object(rp_handler.SESSION, "request")
+    def test_comfy_request_does_not_retry_post_after_unavailable(self, mock_request):
+        unavailable = MagicMock(status_code=503)
+        mock_request.return_value = unavailable
+
+        response = rp_handler.comfy_request("POST", "/prompt", retries=3)
+
+        self.assertIs(response, unavailable)
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch.object(rp_handler.SESSION, "request")
+    def test_comfy_request_does_not_retry_post_after_disconnect(self, mock_request):
+        mock_request.side_effect = rp_handler.requests.ConnectionError(
+            "Connection aborted.", http.client.RemoteDisconnected("Remote end closed connection")
+        )
+
+        with self.assertRaises(rp_handler.requests.ConnectionError):
+            rp_handler.queue_workflow({"1": {}})
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch("rp_handler.time.sleep")
+    @patch.object(rp_handler.SESSION, "request")
+    def test_comfy_request_retries_post_when_connection_is_refused(self, mock_request, mock_sleep):
+        ok = MagicMock(status_code=200)
+        refused = rp_handler.requests.ConnectionError(
+            MaxRetryError(None, "/prompt", NewConnectionError(None, "Connection refused"))
+        )
+        mock_request.side_effect = [refused, rp_handler.requests.ConnectTimeout(), ok]
+
+        response = rp_handler.comfy_request("POST", "/prompt", retries=3)
+
+        self.assertIs(response, ok)
+        self.assertEqual(mock_request.call_count, 3)
 
     @patch("builtins.open", new_callable=mock_open, read_data=b"test")
     def test_base64_encode(self, mock_file):
@@ -122,6 +272,23 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(result, test_data)
 
+    def test_base64_encode_memory(self):
+        content = os.urandom(12 * 1024 * 1024)
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.remove, f.name)
+
+        tracemalloc.start()
+        try:
+            result = rp_handler.base64_encode(f.name)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(result, base64.b64encode(content).decode("ascii"))
+        # The encoded file is 4/3 of its size, it is held as chunks and as the string
+        self.assertLess(peak, 2.7 * len(content))
+
     @patch("rp_handler.os.path.exists")
     @patch("rp_handler.rp_upload.upload_image")
     @patch.dict(
@@ -201,7 +368,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIn("simulated_uploaded", result["message"])
         self.assertEqual(result["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch.object(rp_handler.SESSION, "request")
     def test_upload_images_successful(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 200
@@ -217,7 +384,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch.object(rp_handler.SESSION, "request")
     def test_upload_images_failed(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 400
@@ -232,3 +399,1683 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")
+
+
+class TestCompletionListener(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        self.job = {"id": "job-1", "input": self.load_test_input()}
+
+    def run_handler(self, server):
+        with patch.object(rp_handler, "COMFY_HOST", server.address):
+            return rp_handler.handler(self.job)
+
+    def test_handler_waits_on_websocket(self):
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=0.3) as server:
+            result = self.run_handler(server)
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(server.requests["/ws"], 1)
+        # The history is only fetched once after the execution finished
+        self.assertEqual(server.requests["/history"], 1)
+        # All HTTP requests of the job share keep-alive connections
+        stats = rp_handler.get_connection_stats()
+        self.assertGreater(stats["reused"], 0)
+
+    def test_handler_falls_back_to_polling_when_websocket_drops(self):
+        with FakeComfyUI(
+            output_dir=self.output_dir, inference_delay=0.3, drop_websocket=True
+        ) as server:
+            with patch.object(rp_handler, "COMFY_POLLING_INTERVAL_MS", 50):
+                result = self.run_handler(server)
+
+        self.assertEqual(result["status"], "success")
+        self.assertGreater(server.requests["/history"], 1)
+
+    def test_handler_reports_execution_error(self):
+        with FakeComfyUI(output_dir=self.output_dir, fail_execution=True) as server:
+            result = self.run_handler(server)
+
+        self.assertIn("simulated failure", result["error"])
+
+
+class TestComfyHealth(WorkerTestCase):
+    @patch.object(rp_handler.SESSION, "get")
+    def test_warm_worker_skips_probe(self, mock_get):
+        rp_handler.set_comfy_health(True)
+
+        self.assertTrue(rp_handler.ensure_comfy_available())
+        mock_get.assert_not_called()
+
+    @patch.object(rp_handler.SESSION, "get")
+    def test_expired_health_is_probed_again(self, mock_get):
+        mock_get.return_value = MagicMock(status_code=200)
+        rp_handler.set_comfy_health(True)
+
+        with patch.object(rp_handler, "COMFY_HEALTH_TTL_S", 0):
+            self.assertTrue(rp_handler.ensure_comfy_available())
+        mock_get.assert_called_once()
+
+    @patch.object(rp_handler.SESSION, "request")
+    def test_failed_request_marks_unhealthy(self, mock_request):
+        rp_handler.set_comfy_health(True)
+        mock_request.side_effect = rp_handler.requests.ConnectionError()
+
+        with self.assertRaises(rp_handler.requests.ConnectionError):
+            rp_handler.comfy_request("POST", "/prompt", retries=0)
+        self.assertEqual(rp_handler.COMFY_HEALTH["state"], "unhealthy")
+
+    @patch.object(rp_handler.SESSION, "get")
+    def test_handler_fails_fast_when_comfy_is_down(self, mock_get):
+        mock_get.side_effect = rp_handler.requests.ConnectionError()
+        rp_handler.set_comfy_health(False)
+
+        result = rp_handler.handler({"id": "job-1", "input": {"workflow": {}}})
+
+        self.assertIn("ComfyUI API is not available", result["error"])
+        self.assertTrue(result["refresh_worker"])
+        self.assertEqual(mock_get.call_count, rp_handler.COMFY_API_FAILFAST_RETRIES)
+
+
+class TestUploadImages(unittest.TestCase):
+    def test_iter_base64_decode_in_chunks(self):
+        blob = os.urandom(100_000)
+        encoded = "data:image/png;base64," + base64.b64encode(blob).decode("utf-8")
+
+        chunks = list(
+            rp_handler.iter_base64_decode(rp_handler.strip_base64(encoded), 4096)
+        )
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), blob)
+
+    def test_sniff_mime_type(self):
+        self.assertEqual(rp_handler.sniff_mime_type(b"\xff\xd8\xff\xe0", "a.png"), "image/jpeg")
+        self.assertEqual(
+            rp_handler.sniff_mime_type(b"RIFF\x00\x00\x00\x00WEBPVP8 ", "a"), "image/webp"
+        )
+        self.assertEqual(rp_handler.sniff_mime_type(b"unknown", "mask.png"), "image/png")
+
+    def test_upload_images_concurrently(self):
+        images = {f"image_{i}.png": os.urandom(300_000) for i in range(6)}
+
+        with FakeComfyUI() as server, patch.object(rp_handler, "COMFY_HOST", server.address):
+            result = rp_handler.upload_images(
+                [
+                    {"name": name, "image": base64.b64encode(blob).decode("utf-8")}
+                    for name, blob in images.items()
+                ]
+            )
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(server.uploads, images)
+
+    @patch.object(rp_handler.SESSION, "request")
+    def test_upload_images_collects_invalid_base64(self, mock_request):
+        mock_request.return_value = MagicMock(status_code=200)
+
+        result = rp_handler.upload_images(
+            [
+                {"name": "broken.png", "image": "not base64!"},
+                {"name": "ok.png", "image": base64.b64encode(b"ok").decode("utf-8")},
+            ]
+        )
+
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(len(result["details"]), 1)
+        self.assertIn("broken.png", result["details"][0])
+
+
+class TestProcessOutputImages(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        os.environ.pop("BUCKET_ENDPOINT_URL", None)
+
+    def write_output(self, filename, content, subfolder=""):
+        os.makedirs(os.path.join(self.output_dir, subfolder), exist_ok=True)
+        with open(os.path.join(self.output_dir, subfolder, filename), "wb") as f:
+            f.write(content)
+        return {"filename": filename, "subfolder": subfolder, "type": "output"}
+
+    def test_returns_all_outputs_grouped_by_node(self):
+        outputs = {
+            "9": {
+                "images": [
+                    self.write_output("batch_00001_.png", b"first"),
+                    self.write_output("batch_00002_.png", b"second"),
+                ]
+            },
+            "12": {"gifs": [self.write_output("anim_00001_.webp", b"anim", "videos")]},
+            "13": {"images": [{"filename": "preview.png", "subfolder": "", "type": "temp"}]},
+        }
+
+        result = rp_handler.process_output_images(outputs, "123")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(list(result["outputs"]), ["9", "12"])
+        self.assertEqual(
+            [item["base64"] for item in result["outputs"]["9"]],
+            [base64.b64encode(b"first").decode(), base64.b64encode(b"second").decode()],
+        )
+        gif = result["outputs"]["12"][0]
+        self.assertEqual(gif["output_type"], "gifs")
+        self.assertEqual(gif["subfolder"], "videos")
+        self.assertEqual(result["message"], gif["base64"])
+
+    def test_reports_missing_files(self):
+        outputs = {
+            "9": {
+                "images": [
+                    self.write_output("exists.png", b"data"),
+                    {"filename": "missing.png", "subfolder": "", "type": "output"},
+                ]
+            }
+        }
+
+        result = rp_handler.process_output_images(outputs, "123")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(len(result["outputs"]["9"]), 1)
+        self.assertIn("missing.png", result["errors"][0])
+
+    @patch.object(rp_handler, "ENCODE_CHUNK_SIZE", 3 * 1024)
+    def test_base64_encode_in_chunks(self):
+        content = os.urandom(10_000)
+        item = self.write_output("large.png", content)
+
+        encoded = rp_handler.base64_encode(os.path.join(self.output_dir, item["filename"]))
+
+        self.assertEqual(encoded, base64.b64encode(content).decode("utf-8"))
+
+    def test_reencode_images(self):
+        from PIL import Image
+
+        path = os.path.join(self.output_dir, "ComfyUI_00001_.png")
+        Image.new("RGBA", (64, 64), (255, 0, 0, 255)).save(path)
+        outputs = {
+            "9": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": ""}]},
+            "10": {"gifs": [self.write_output("anim.gif", b"not converted")]},
+        }
+
+        result = rp_handler.process_output_images(outputs, "123", "webp", 50)
+
+        image = result["outputs"]["9"][0]
+        self.assertEqual(image["filename"], "ComfyUI_00001_.webp")
+        self.assertEqual(base64.b64decode(image["base64"])[8:12], b"WEBP")
+        self.assertEqual(
+            base64.b64decode(result["outputs"]["10"][0]["base64"]), b"not converted"
+        )
+
+    def test_no_outputs(self):
+        result = rp_handler.process_output_images({"9": {"images": []}}, "123")
+
+        self.assertEqual(result["status"], "error")
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+class TestUploadOutputFile(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.start_patches(
+            mock_aws(),
+            patch.dict(
+                os.environ,
+                {
+                    "BUCKET_ENDPOINT_URL": "https://s3.us-east-1.amazonaws.com",
+                    "BUCKET_ACCESS_KEY_ID": "testing",
+                    "BUCKET_SECRET_ACCESS_KEY": "testing",
+                },
+            ),
+        )
+        rp_handler.S3_CLIENT.clear()
+        self.addCleanup(rp_handler.S3_CLIENT.clear)
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="outputs")
+
+        self.output_dir = self.create_temp_dir()
+        self.path = os.path.join(self.output_dir, "ComfyUI_00001_.mp4")
+        self.content = os.urandom(6 * 1024 * 1024)
+        with open(self.path, "wb") as f:
+            f.write(self.content)
+
+    @patch.object(rp_handler, "BUCKET_NAME", "outputs")
+    @patch.object(rp_handler, "BUCKET_MULTIPART_THRESHOLD_MB", 5)
+    @patch.object(rp_handler, "BUCKET_MULTIPART_CHUNKSIZE_MB", 5)
+    def test_multipart_upload_with_presigned_url(self):
+        url = rp_handler.upload_output_file("job-1", self.path)
+
+        self.assertIn("X-Amz-Signature", url)
+        key = url.split("/outputs/")[1].split("?")[0]
+        self.assertTrue(key.startswith("job-1/"))
+        obj = boto3.client("s3", region_name="us-east-1").get_object(
+            Bucket="outputs", Key=key
+        )
+        self.assertEqual(obj["Body"].read(), self.content)
+        self.assertEqual(obj["ContentType"], "video/mp4")
+        # Uploaded in 2 parts
+        self.assertTrue(obj["ETag"].endswith('-2"'))
+
+    @patch.object(rp_handler, "BUCKET_NAME", "outputs")
+    @patch.object(rp_handler, "BUCKET_URL_MODE", "public")
+    @patch.object(rp_handler, "BUCKET_PUBLIC_URL", "https://cdn.example.com/")
+    def test_public_url(self):
+        url = rp_handler.upload_output_file("job-1", self.path)
+
+        self.assertRegex(url, r"^https://cdn\.example\.com/job-1/[0-9a-f]{8}\.mp4$")
+
+    def test_client_is_reused(self):
+        client, _ = rp_handler.get_s3_client()
+        self.assertIs(rp_handler.get_s3_client()[0], client)
+
+
+class TestInputCache(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_dir = self.create_temp_dir()
+        self.start_patches(
+            patch.object(rp_handler, "COMFY_INPUT_PATH", self.input_dir),
+            patch.object(rp_handler, "INPUT_CACHE", rp_handler.OrderedDict()),
+            patch.object(rp_handler, "INPUT_CACHE_NAMES", {}),
+        )
+        self.server = FakeComfyUI(input_dir=self.input_dir).start()
+        self.addCleanup(self.server.stop)
+        self.start_patches(patch.object(rp_handler, "COMFY_HOST", self.server.address))
+
+    def upload(self, name, content):
+        return rp_handler.upload_images(
+            [{"name": name, "image": base64.b64encode(content).decode("utf-8")}]
+        )
+
+    def test_identical_payload_is_not_uploaded_again(self):
+        content = os.urandom(1000)
+
+        self.upload("mask.png", content)
+        result = self.upload("mask.png", content)
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["details"], ["Reused cached mask.png"])
+        self.assertEqual(self.server.requests["/upload/image"], 1)
+
+    def test_changed_payload_is_uploaded(self):
+        self.upload("mask.png", b"first")
+        self.upload("mask.png", b"second")
+
+        self.assertEqual(self.server.requests["/upload/image"], 2)
+        with open(os.path.join(self.input_dir, "mask.png"), "rb") as f:
+            self.assertEqual(f.read(), b"second")
+
+    def test_reference_image_by_hash(self):
+        content = os.urandom(1000)
+        self.upload("reference.png", content)
+
+        result = rp_handler.upload_images(
+            [{"name": "other.png", "hash": hashlib.sha256(content).hexdigest()}]
+        )
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(self.server.requests["/upload/image"], 1)
+        with open(os.path.join(self.input_dir, "other.png"), "rb") as f:
+            self.assertEqual(f.read(), content)
+
+    def test_unknown_hash(self):
+        result = rp_handler.upload_images([{"name": "other.png", "hash": "abc"}])
+
+        self.assertEqual(result["status"], "error")
+        self.assertIn("unknown image hash", result["details"][0])
+
+    def test_images_are_uploaded_to_servers_on_other_machines(self):
+        content = os.urandom(1000)
+        # The server doesn't read its input images from the input folder of the worker
+        self.start_patches(patch.object(rp_handler, "LOCAL_HOSTNAMES", ()))
+
+        self.upload("mask.png", content)
+        result = self.upload("mask.png", content)
+
+        self.assertEqual(result["details"], ["Successfully uploaded mask.png"])
+        self.assertEqual(self.server.requests["/upload/image"], 2)
+        self.assertEqual(len(rp_handler.INPUT_CACHE), 0)
+
+    def test_only_servers_on_this_machine_share_the_input_folder(self):
+        for host, local in [
+            ("127.0.0.1:8188", True),
+            ("localhost:8189", True),
+            ("[::1]:8188", True),
+            ("10.0.0.2:8188", False),
+            ("comfyui-1:8188", False),
+        ]:
+            with self.subTest(host=host):
+                self.assertEqual(rp_handler.ComfyBackend(host).local, local)
+
+    @patch.object(rp_handler, "COMFY_INPUT_CACHE_MAX_MB", 1)
+    def test_least_recently_used_images_are_evicted(self):
+        contents = [os.urandom(400 * 1024) for _ in range(3)]
+        for name, content in zip(["a.png", "b.png", "c.png"], contents):
+            self.upload(name, content)
+            self.upload(f"{rp_handler.INPUT_CACHE_FOLDER}/{name}", content)
+
+        self.assertEqual(len(rp_handler.INPUT_CACHE), 2)
+        self.assertNotIn(hashlib.sha256(contents[0]).hexdigest(), rp_handler.INPUT_CACHE)
+        cache_dir = os.path.join(self.input_dir, rp_handler.INPUT_CACHE_FOLDER)
+        self.assertEqual(sorted(os.listdir(cache_dir)), ["b.png", "c.png"])
+        # Only the files in the cache folder are removed
+        self.assertTrue(os.path.exists(os.path.join(self.input_dir, "a.png")))
+
+    @patch.object(rp_handler, "COMFY_INPUT_CACHE_MAX_MB", 1)
+    def test_images_of_running_jobs_are_not_evicted(self):
+        first, second = os.urandom(600 * 1024), os.urandom(600 * 1024)
+        self.start_patches(patch.object(rp_handler, "ACTIVE_INPUT_SUBFOLDERS", set()))
+
+        # Job A has uploaded its image, but ComfyUI didn't load it yet, when job B
+        # uploads an image that doesn't fit into the cache anymore
+        rp_handler.ACTIVE_INPUT_SUBFOLDERS.update({"job-a", "job-b"})
+        rp_handler.upload_images(
+            [{"name": "a.png", "image": base64.b64encode(first).decode("utf-8")}], "job-a"
+        )
+        rp_handler.upload_images(
+            [{"name": "b.png", "image": base64.b64encode(second).decode("utf-8")}], "job-b"
+        )
+
+        self.assertTrue(os.path.exists(os.path.join(self.input_dir, "job-a", "a.png")))
+        self.assertEqual(len(rp_handler.INPUT_CACHE), 2)
+
+        # Once job A is done, its image is kept in the cache folder and evicted
+        rp_handler.remove_input_subfolder("job-a")
+
+        self.assertEqual(len(rp_handler.INPUT_CACHE), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.input_dir, "job-a")))
+        cache_dir = os.path.join(self.input_dir, rp_handler.INPUT_CACHE_FOLDER)
+        self.assertEqual(os.listdir(cache_dir), [])
+        self.assertTrue(os.path.exists(os.path.join(self.input_dir, "job-b", "b.png")))
+
+    @patch.object(rp_handler, "COMFY_INPUT_CACHE_MAX_MB", 1)
+    def test_cache_folder_is_indexed_after_a_restart(self):
+        cache_dir = os.path.join(self.input_dir, rp_handler.INPUT_CACHE_FOLDER)
+        os.makedirs(cache_dir)
+        contents = [os.urandom(400 * 1024) for _ in range(3)]
+        for i, content in enumerate(contents):
+            path = os.path.join(cache_dir, hashlib.sha256(content).hexdigest())
+            with open(path, "wb") as f:
+                f.write(content)
+            os.utime(path, (1000 + i, 1000 + i))
+        with open(os.path.join(cache_dir, "notes.txt"), "w") as f:
+            f.write("not an image")
+
+        self.assertEqual(rp_handler.load_input_cache(), 3)
+
+        # The oldest image was evicted to stay below COMFY_INPUT_CACHE_MAX_MB
+        kept = [hashlib.sha256(content).hexdigest() for content in contents[1:]]
+        self.assertEqual(sorted(os.listdir(cache_dir)), sorted(kept + ["notes.txt"]))
+        result = rp_handler.upload_images(
+            [{"name": "other.png", "hash": hashlib.sha256(contents[2]).hexdigest()}]
+        )
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(self.server.requests["/upload/image"], 0)
+        with open(os.path.join(self.input_dir, "other.png"), "rb") as f:
+            self.assertEqual(f.read(), contents[2])
+
+
+class TestResultCache(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        self.cache_dir = self.create_temp_dir()
+        self.start_patches(
+            patch.object(rp_handler, "COMFY_RESULT_CACHE", "disk"),
+            patch.object(rp_handler, "COMFY_RESULT_CACHE_PATH", self.cache_dir),
+        )
+        self.workflow = self.load_test_input()["workflow"]
+
+    def test_repeated_job_is_served_from_cache(self):
+        job = {"id": "job-1", "input": {"workflow": self.workflow}}
+        with FakeComfyUI(output_dir=self.output_dir) as server:
+            with patch.object(rp_handler, "COMFY_HOST", server.address):
+                first = rp_handler.handler(job)
+                second = rp_handler.handler({**job, "id": "job-2"})
+
+        self.assertEqual(server.requests["/prompt"], 1)
+        self.assertNotIn("cached", first)
+        self.assertTrue(second["cached"])
+        self.assertEqual(second["outputs"], first["outputs"])
+
+    def test_random_seed_is_not_cached(self):
+        self.workflow["3"]["inputs"]["seed"] = -1
+
+        self.assertIsNone(rp_handler.result_cache_key(self.workflow, None))
+
+    def test_seeded_random_noise_is_cached(self):
+        with open("test_resources/workflows/workflow_flux1_schnell.json") as f:
+            workflow = json.load(f)["input"]["workflow"]
+
+        self.assertFalse(rp_handler.has_random_seed(workflow))
+        self.assertTrue(
+            rp_handler.has_random_seed({"1": {"class_type": "CR Random Hex Color", "inputs": {}}})
+        )
+
+    def test_key_is_canonical(self):
+        image = {"name": "a.png", "image": base64.b64encode(b"a").decode("utf-8")}
+        reordered = dict(reversed(list(self.workflow.items())))
+
+        key = rp_handler.result_cache_key(self.workflow, [image])
+
+        self.assertEqual(key, rp_handler.result_cache_key(reordered, [image]))
+        self.assertEqual(
+            key,
+            rp_handler.result_cache_key(
+                self.workflow, [{"name": "a.png", "hash": hashlib.sha256(b"a").hexdigest()}]
+            ),
+        )
+        self.assertNotEqual(
+            key,
+            rp_handler.result_cache_key(
+                self.workflow,
+                [{"name": "a.png", "image": base64.b64encode(b"b").decode("utf-8")}],
+            ),
+        )
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = rp_handler.DiskResultCache(self.cache_dir, 1500)
+        for i, key in enumerate(["a", "b", "c"]):
+            with open(os.path.join(self.output_dir, f"{key}.png"), "wb") as f:
+                f.write(os.urandom(600))
+            outputs = {"9": {"images": [{"filename": f"{key}.png", "subfolder": ""}]}}
+            cache.put(key, outputs, self.output_dir)
+            os.utime(os.path.join(self.cache_dir, key), (i, i))
+
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+
+
+class TestValidateWorkflow(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.models_dir = self.create_temp_dir()
+        os.makedirs(os.path.join(self.models_dir, "checkpoints"))
+        self.start_patches(
+            patch.object(rp_handler, "OBJECT_INFO", dict(OBJECT_INFO)),
+            patch.object(rp_handler, "MODEL_FOLDER_CACHE", {}),
+            patch.object(rp_handler, "COMFY_MODELS_PATH", self.models_dir),
+            patch.object(rp_handler, "COMFY_EXTRA_MODEL_PATHS", "src/extra_model_paths.yaml"),
+        )
+        self.workflow = self.load_test_input()["workflow"]
+
+    def messages(self, workflow):
+        return [e["message"] for e in rp_handler.validate_workflow(workflow)]
+
+    def test_valid_workflow(self):
+        self.assertEqual(rp_handler.validate_workflow(self.workflow), [])
+
+    def test_dangling_link(self):
+        self.workflow["8"]["inputs"]["samples"] = ["42", 0]
+        self.workflow["8"]["inputs"]["vae"] = ["4", 3]
+
+        self.assertEqual(
+            self.messages(self.workflow),
+            [
+                "input 'samples' is linked to missing node 42",
+                "input 'vae' is linked to missing output 3 of node 4",
+            ],
+        )
+
+    def test_unknown_node_type_and_missing_input(self):
+        self.workflow["10"] = {"class_type": "DoesNotExist", "inputs": {}}
+        del self.workflow["5"]["inputs"]["width"]
+
+        errors = rp_handler.validate_workflow(self.workflow)
+
+        self.assertEqual(
+            [(e["node_id"], e["message"]) for e in errors],
+            [
+                ("5", "required input 'width' is missing"),
+                ("10", "unknown node type 'DoesNotExist'"),
+            ],
+        )
+
+    def test_cycle(self):
+        self.workflow["3"]["inputs"]["latent_image"] = ["8", 0]
+        self.workflow["8"]["inputs"]["samples"] = ["3", 0]
+
+        self.assertIn("the links between the nodes form a cycle", self.messages(self.workflow))
+
+    def test_missing_model_file(self):
+        self.workflow["4"]["inputs"]["ckpt_name"] = "missing.safetensors"
+
+        self.assertEqual(
+            self.messages(self.workflow),
+            ["checkpoints model 'missing.safetensors' does not exist"],
+        )
+
+        # A model that was added after /object_info was fetched
+        with open(os.path.join(self.models_dir, "checkpoints", "missing.safetensors"), "w"):
+            pass
+        self.assertEqual(self.messages(self.workflow), [])
+
+    def test_model_folders_include_extra_model_paths(self):
+        folders = rp_handler.get_model_folders()
+
+        self.assertIn("/runpod-volume/models/checkpoints/", folders["checkpoints"])
+        self.assertIn(os.path.join(self.models_dir, "diffusion_models"), folders["unet"])
+
+    def test_handler_rejects_invalid_workflow_before_queuing(self):
+        rp_handler.OBJECT_INFO.clear()
+        self.workflow["8"]["inputs"]["samples"] = ["42", 0]
+
+        with FakeComfyUI() as server, patch.object(rp_handler, "COMFY_HOST", server.address):
+            rp_handler.set_comfy_health(True)
+            result = rp_handler.handler({"id": "job-1", "input": {"workflow": self.workflow}})
+
+        self.assertEqual(result["error"], "Invalid workflow")
+        self.assertEqual(result["details"][0]["node_id"], "8")
+        self.assertEqual(server.requests["/prompt"], 0)
+        self.assertEqual(server.requests["/object_info"], 1)
+
+
+class TestConcurrentJobs(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        self.input_dir = self.create_temp_dir()
+        self.start_patches(patch.object(rp_handler, "COMFY_INPUT_PATH", self.input_dir))
+        self.workflow = self.load_test_input()["workflow"]
+
+    def run_jobs(self, server, jobs, concurrency):
+        async def run_all():
+            return await asyncio.gather(*(rp_handler.async_handler(job) for job in jobs))
+
+        with patch.object(rp_handler, "COMFY_HOST", server.address), patch.object(
+            rp_handler, "COMFY_MAX_CONCURRENT_JOBS", concurrency
+        ), patch.object(
+            rp_handler, "JOB_EXECUTOR", rp_handler.ThreadPoolExecutor(concurrency)
+        ):
+            start = time.monotonic()
+            results = asyncio.run(run_all())
+            return results, time.monotonic() - start
+
+    def test_post_processing_overlaps_with_inference(self):
+        jobs = [{"id": f"job-{i}", "input": {"workflow": self.workflow}} for i in range(4)]
+        process_output_images = rp_handler.process_output_images
+
+        def slow_process_output_images(*args, **kwargs):
+            # Simulate encoding and uploading the outputs
+            time.sleep(0.3)
+            return process_output_images(*args, **kwargs)
+
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=0.3) as server, patch.object(
+            rp_handler, "process_output_images", slow_process_output_images
+        ):
+            _, sequential = self.run_jobs(server, jobs, 1)
+            results, concurrent = self.run_jobs(server, jobs, 4)
+
+        self.assertTrue(all(r["status"] == "success" for r in results))
+        self.assertEqual(len({json.dumps(r["outputs"]) for r in results}), 4)
+        # 4 x (0.3s inference + 0.3s post-processing) vs. 4 x 0.3s + 0.3s
+        self.assertLess(concurrent, sequential * 0.8)
+
+    def test_input_images_of_concurrent_jobs_are_kept_apart(self):
+        self.workflow["10"] = {"class_type": "LoadImage", "inputs": {"image": "input.png"}}
+        jobs = [
+            {
+                "id": f"job-{i}",
+                "input": {
+                    "workflow": self.workflow,
+                    "images": [
+                        {"name": "input.png", "image": base64.b64encode(content).decode()}
+                    ],
+                },
+            }
+            for i, content in enumerate([b"first", b"second"])
+        ]
+
+        with FakeComfyUI(
+            output_dir=self.output_dir, input_dir=self.input_dir, inference_delay=0.1
+        ) as server, patch.object(rp_handler, "COMFY_VALIDATE_WORKFLOW", False):
+            results, _ = self.run_jobs(server, jobs, 2)
+
+        self.assertTrue(all(r["status"] == "success" for r in results))
+        used = {
+            prompt["prompt"]["10"]["inputs"]["image"]: server.uploads[
+                prompt["prompt"]["10"]["inputs"]["image"]
+            ]
+            for prompt in server.prompts.values()
+        }
+        self.assertEqual(sorted(used.values()), [b"first", b"second"])
+        # The input images are removed after the jobs, only the input cache is kept
+        self.assertEqual(os.listdir(self.input_dir), [rp_handler.INPUT_CACHE_FOLDER])
+
+
+class TestMetrics(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        self.start_patches(
+            patch.object(rp_handler, "COMFY_METRICS_LOG", False),
+            patch.dict(
+                rp_handler.METRICS,
+                {
+                    "jobs": {},
+                    "stages": rp_handler.Histogram("stage_seconds", "stage", "stages"),
+                    "nodes": rp_handler.Histogram("node_seconds", "class_type", "nodes"),
+                },
+            ),
+        )
+        self.job = {"id": "job-1", "input": self.load_test_input()}
+
+    def run_handler(self):
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=0.2) as server:
+            with patch.object(rp_handler, "COMFY_HOST", server.address):
+                return rp_handler.handler(self.job)
+
+    def test_metrics_are_only_returned_on_request(self):
+        result = self.run_handler()
+
+        self.assertEqual(result["status"], "success")
+        self.assertNotIn("metrics", result)
+
+    def test_metrics_break_down_the_job(self):
+        self.job["input"]["metrics"] = True
+
+        result = self.run_handler()
+
+        metrics = result["metrics"]
+        for stage in ("validate", "server_check", "upload", "queue", "wait", "outputs"):
+            self.assertIn(stage, metrics["stages"])
+        self.assertIn("output_read", metrics["stages"])
+        self.assertIn("encode", metrics["stages"])
+        self.assertGreaterEqual(metrics["stages"]["wait"], 200)
+        self.assertGreaterEqual(metrics["total_ms"], metrics["stages"]["wait"])
+        # The execution time of the nodes comes from the WebSocket events
+        self.assertEqual(metrics["nodes"]["3"]["class_type"], "KSampler")
+        self.assertGreaterEqual(metrics["nodes"]["3"]["ms"], 200)
+
+    def test_jobs_are_exported_for_prometheus(self):
+        self.run_handler()
+        rp_handler.handler({"id": "job-2", "input": {}})
+
+        server = rp_handler.start_metrics_server()
+        try:
+            response = rp_handler.requests.get(f"http://127.0.0.1:{server.server_port}/metrics")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('runpod_worker_comfy_jobs_total{status="success"} 1', response.text)
+        self.assertIn('runpod_worker_comfy_jobs_total{status="error"} 1', response.text)
+        self.assertIn('stage_seconds_count{stage="wait"} 1', response.text)
+        self.assertIn('node_seconds_bucket{class_type="KSampler",le="0.1"} 0', response.text)
+        self.assertIn('node_seconds_bucket{class_type="KSampler",le="0.25"} 1', response.text)
+
+    def test_nodes_that_are_not_in_the_workflow_are_exported(self):
+        metrics = rp_handler.JobMetrics()
+        metrics.class_types = {"3": "KSampler"}
+        metrics.add_node("3", 0.2)
+        # An expanded node of a node group, which is not in the submitted workflow
+        metrics.add_node("3.0.0.1", 0.1)
+
+        rp_handler.record_job_metrics("job-1", metrics, {"status": "success"})
+
+        text = rp_handler.render_metrics()
+        self.assertIn('node_seconds_count{class_type="KSampler"} 1', text)
+        self.assertIn('node_seconds_count{class_type="unknown"} 1', text)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 95), 95)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile([7], 99), 7)
+
+    def test_benchmark_reports_latency_and_requests(self):
+        workflows = benchmark.load_workflows("test_resources/workflows/workflow_sd3.json")
+
+        with patch.dict(rp_handler.COMFY_HEALTH, {"state": "unknown", "checked_at": 0.0}):
+            report = benchmark.run_benchmark(
+                workflows, iterations=3, warmup=1, output_size=1024
+            )
+
+        summary = report["workflows"]["workflow_sd3"]
+        self.assertEqual(summary["jobs"], 3)
+        self.assertEqual(summary["errors"], 0)
+        self.assertLessEqual(summary["p50_ms"], summary["p99_ms"])
+        self.assertEqual(summary["requests"]["/prompt"], 3)
+        self.assertIn("wait", summary["stages_mean_ms"])
+        self.assertGreater(report["peak_rss_mb"], 0)
+        # The settings of the handler are restored
+        self.assertEqual(rp_handler.COMFY_HOST, "127.0.0.1:8188")
+
+    def test_regression_against_baseline(self):
+        keys = ("p50_ms", "p95_ms", "p99_ms", "throughput_jobs_per_s")
+        baseline = {"workflows": {"sd3": dict(zip(keys, (10, 10, 10, 10)))}}
+        report = {"workflows": {"sd3": dict(zip(keys, (10, 12, 12, 9)))}}
+
+        _, regressed = benchmark.compare(report, baseline, max_regression=10)
+        self.assertTrue(regressed)
+        _, regressed = benchmark.compare(report, baseline, max_regression=25)
+        self.assertFalse(regressed)
+
+
+class TestCancellation(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        self.start_patches(
+            patch.object(rp_handler, "CANCEL_CHECK_INTERVAL_S", 0.05),
+            patch.object(rp_handler, "COMFY_POLLING_INTERVAL_MS", 50),
+        )
+        self.workflow = self.load_test_input()["workflow"]
+
+    def test_invalid_timeout(self):
+        _, error = rp_handler.validate_input({"workflow": {}, "timeout": -1})
+        self.assertEqual(error, "'timeout' must be a positive number of seconds")
+
+    def test_timed_out_job_interrupts_its_prompt_and_removes_its_outputs(self):
+        # A preview that is saved before the sampler runs
+        workflow = {
+            "1": {"class_type": "SaveImage", "inputs": {"filename_prefix": "early"}},
+            **self.workflow,
+        }
+        job = {"id": "job-1", "input": {"workflow": workflow, "timeout": 0.5}}
+
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=10) as server:
+            with patch.object(rp_handler, "COMFY_HOST", server.address), patch.object(
+                rp_handler, "COMFY_VALIDATE_WORKFLOW", False
+            ):
+                start = time.monotonic()
+                result = rp_handler.handler(job)
+                elapsed = time.monotonic() - start
+
+        self.assertEqual(result["error"], "Job timed out")
+        self.assertLess(elapsed, 5)
+        self.assertEqual(server.requests["/interrupt"], 1)
+        self.assertEqual(list(server.history.values())[0]["status"]["status_str"], "error")
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_job_timeout_from_environment(self):
+        job = {"id": "job-1", "input": {"workflow": self.workflow}}
+
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=10) as server:
+            with patch.object(rp_handler, "COMFY_HOST", server.address), patch.object(
+                rp_handler, "COMFY_JOB_TIMEOUT_S", 0.3
+            ), patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling"):
+                result = rp_handler.handler(job)
+
+        self.assertEqual(result["error"], "Job timed out")
+        self.assertEqual(server.requests["/interrupt"], 1)
+
+    def test_pending_prompt_is_deleted_from_the_queue(self):
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=10) as server:
+            with patch.object(rp_handler, "COMFY_HOST", server.address):
+                running = rp_handler.queue_workflow(self.workflow)["prompt_id"]
+                pending = rp_handler.queue_workflow(self.workflow)["prompt_id"]
+                while server.running != running:
+                    time.sleep(0.01)
+
+                self.assertEqual(rp_handler.cancel_prompt(pending), "deleted")
+                self.assertEqual(rp_handler.cancel_prompt(running), "interrupted")
+                while server.running:
+                    time.sleep(0.01)
+                self.assertIsNone(rp_handler.cancel_prompt(running))
+
+        self.assertNotIn(pending, server.history)
+        self.assertIn(running, server.interrupted)
+
+    def test_cancelled_async_job_interrupts_its_prompt(self):
+        job = {"id": "job-1", "input": {"workflow": self.workflow}}
+
+        async def run_and_cancel():
+            task = asyncio.ensure_future(rp_handler.async_handler(job))
+            while not server.running:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=10) as server:
+            with patch.object(rp_handler, "COMFY_HOST", server.address):
+                asyncio.run(run_and_cancel())
+                deadline = time.monotonic() + 5
+                while server.running and time.monotonic() < deadline:
+                    time.sleep(0.01)
+
+        self.assertEqual(len(server.interrupted), 1)
+
+    def test_job_cancelled_in_runpod_interrupts_its_prompt(self):
+        job = {"id": "job-1", "input": {"workflow": self.workflow}}
+        api = ThreadingHTTPServer(("127.0.0.1", 0), StatusRequestHandler)
+        api.status = "IN_PROGRESS"
+        api.requests = []
+        threading.Thread(target=api.serve_forever, daemon=True).start()
+        environment = {"RUNPOD_API_KEY": "key", "RUNPOD_ENDPOINT_ID": "endpoint"}
+
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=10) as server, patch.dict(
+            os.environ, environment
+        ), patch.object(rp_handler, "COMFY_HOST", server.address), patch.object(
+            rp_handler, "RUNPOD_API_URL", f"http://127.0.0.1:{api.server_port}"
+        ), patch.object(
+            rp_handler, "COMFY_CANCEL_POLL_S", 0.05
+        ):
+            threading.Timer(0.5, lambda: setattr(api, "status", "CANCELLED")).start()
+            result = rp_handler.handler(job)
+        api.shutdown()
+        api.server_close()
+
+        self.assertEqual(result["error"], "Job was cancelled")
+        self.assertEqual(len(server.interrupted), 1)
+        self.assertEqual(api.requests[0], ("/endpoint/status/job-1", "Bearer key"))
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    """Answers requests for the status of a job like the RunPod API"""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Authorization")))
+        body = json.dumps({"id": "job-1", "status": self.server.status}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFileLifecycle(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        self.input_dir = self.create_temp_dir()
+        self.start_patches(
+            patch.object(rp_handler, "COMFY_INPUT_PATH", self.input_dir),
+            patch.dict(rp_handler.INPUT_CACHE, clear=True),
+            patch.dict(rp_handler.INPUT_CACHE_NAMES, clear=True),
+            patch.dict(rp_handler.OUTPUT_FILES, clear=True),
+        )
+        workflow = self.load_test_input()["workflow"]
+        workflow["10"] = {"class_type": "LoadImage", "inputs": {"image": "input.png"}}
+        self.job_input = {
+            "workflow": workflow,
+            "images": [{"name": "input.png", "image": base64.b64encode(b"pixels").decode()}],
+        }
+
+    def run_jobs(self, count=1):
+        results = []
+        with FakeComfyUI(output_dir=self.output_dir, input_dir=self.input_dir) as server:
+            with patch.object(rp_handler, "COMFY_HOST", server.address), patch.object(
+                rp_handler, "COMFY_VALIDATE_WORKFLOW", False
+            ):
+                for i in range(count):
+                    results.append(rp_handler.handler({"id": f"job-{i}", "input": self.job_input}))
+        return results, server
+
+    def test_files_of_a_job_are_removed_after_it_finished(self):
+        results, server = self.run_jobs(2)
+
+        self.assertTrue(all(r["status"] == "success" for r in results))
+        self.assertEqual(os.listdir(self.output_dir), ["ComfyUI"])
+        self.assertEqual(os.listdir(os.path.join(self.output_dir, "ComfyUI")), [])
+        self.assertEqual(os.listdir(self.input_dir), [rp_handler.INPUT_CACHE_FOLDER])
+        # The image is kept in the input cache and not uploaded again
+        self.assertEqual(server.requests["/upload/image"], 1)
+        self.assertEqual(len(server.prompts), 2)
+
+    def test_files_are_kept_without_cleanup(self):
+        with patch.object(rp_handler, "COMFY_CLEANUP_FILES", False):
+            results, server = self.run_jobs()
+
+        self.assertEqual(results[0]["status"], "success")
+        self.assertEqual(len(os.listdir(os.path.join(self.output_dir, "ComfyUI"))), 1)
+        self.assertIn("input.png", server.uploads)
+
+    def test_outputs_are_copied_to_the_volume(self):
+        volume = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, volume, ignore_errors=True)
+
+        with patch.object(rp_handler, "OUTPUT_VOLUME_PATH", volume):
+            results, _ = self.run_jobs()
+
+        item = results[0]["outputs"]["9"][0]
+        self.assertNotIn("base64", item)
+        self.assertEqual(results[0]["message"], item["path"])
+        self.assertTrue(item["path"].startswith(os.path.join(volume, "job-0", "ComfyUI")))
+        self.assertTrue(os.path.isfile(item["path"]))
+        self.assertEqual(os.listdir(os.path.join(self.output_dir, "ComfyUI")), [])
+
+    def test_janitor_removes_old_and_too_many_files(self):
+        now = time.time()
+
+        def create(folder, name, size, age, record=True):
+            path = os.path.join(folder, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"0" * size)
+            os.utime(path, (now - age, now - age))
+            if record and folder == self.output_dir:
+                rp_handler.OUTPUT_FILES[path] = None
+            return path
+
+        old = create(self.input_dir, "job-abc/a.png", 10, 7200)
+        os.utime(os.path.dirname(old), (now - 7200, now - 7200))
+        large = create(self.output_dir, "b.png", 100, 600)
+        recent = create(self.output_dir, "c.png", 100, 60)
+        # Files that the worker didn't create are never removed
+        example = create(self.input_dir, "example.png", 1000, 7200)
+        baked = create(self.output_dir, "baked.png", 1000, 7200, record=False)
+        cached = create(self.input_dir, f"{rp_handler.INPUT_CACHE_FOLDER}/hash", 1000, 7200)
+
+        removed = rp_handler.clean_folders(3600, 150)
+
+        self.assertEqual(removed, 2)
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(os.path.exists(os.path.dirname(old)))
+        self.assertFalse(os.path.exists(large))
+        self.assertNotIn(large, rp_handler.OUTPUT_FILES)
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(example))
+        self.assertTrue(os.path.exists(baked))
+        self.assertTrue(os.path.exists(cached))
+
+    def test_janitor_removes_outputs_that_were_kept_without_cleanup(self):
+        with patch.object(rp_handler, "COMFY_CLEANUP_FILES", False):
+            results, _ = self.run_jobs()
+        self.assertEqual(results[0]["status"], "success")
+
+        removed = rp_handler.clean_folders(0, 0)
+
+        self.assertEqual(removed, 1)
+        self.assertEqual(os.listdir(os.path.join(self.output_dir, "ComfyUI")), [])
+        self.assertEqual(rp_handler.OUTPUT_FILES, {})
+
+    def test_janitor_keeps_files_of_running_jobs(self):
+        path = os.path.join(self.output_dir, "a.png")
+        with open(path, "wb") as f:
+            f.write(b"0" * 100)
+        rp_handler.OUTPUT_FILES[path] = None
+
+        with patch.dict(rp_handler.RUNNING_JOBS, {"job": time.time() - 10}):
+            removed = rp_handler.clean_folders(0, 0)
+
+        self.assertEqual(removed, 0)
+        self.assertTrue(os.path.exists(path))
+
+
+class TestProgress(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        self.start_patches(patch.object(rp_handler, "COMFY_PROGRESS_INTERVAL_S", 0))
+        self.job = {"id": "job-1", "input": self.load_test_input()}
+
+    def test_progress_is_sent_to_runpod(self):
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=0.1) as server:
+            with patch.object(rp_handler, "COMFY_HOST", server.address), patch.dict(
+                os.environ, {"RUNPOD_WEBHOOK_GET_JOB": "https://api.runpod.ai"}
+            ), patch.object(rp_handler.runpod.serverless, "progress_update") as progress_update:
+                result = rp_handler.handler(self.job)
+
+        self.assertEqual(result["status"], "success")
+        updates = [call.args[1] for call in progress_update.call_args_list]
+        self.assertTrue(all(call.args[0] is self.job for call in progress_update.call_args_list))
+        steps = [u for u in updates if u["status"] == "progress"]
+        self.assertEqual(len(steps), 20)
+        self.assertEqual(
+            steps[-1],
+            {"status": "progress", "node": "3", "class_type": "KSampler", "value": 20, "max": 20},
+        )
+        self.assertIn({"status": "executing", "node": "8", "class_type": "VAEDecode"}, updates)
+        # Without streaming, the outputs are only part of the result
+        self.assertFalse([u for u in updates if u["status"] == "output"])
+
+    def test_progress_is_throttled(self):
+        sent = []
+        progress = rp_handler.JobProgress(sent.append, "job-1", {"3": "KSampler"})
+        with patch.object(rp_handler, "COMFY_PROGRESS_INTERVAL_S", 60):
+            for step in range(1, 21):
+                progress("progress", {"node": "3", "value": step, "max": 20})
+
+        self.assertEqual(len(sent), 1)
+
+    def test_stream_handler_yields_progress_and_outputs(self):
+        self.job["input"]["previews"] = True
+
+        async def collect():
+            return [update async for update in rp_handler.stream_handler(self.job)]
+
+        with FakeComfyUI(
+            output_dir=self.output_dir, inference_delay=0.1, previews=True
+        ) as server, patch.object(rp_handler, "COMFY_HOST", server.address):
+            updates = asyncio.run(collect())
+
+        statuses = [update["status"] for update in updates]
+        self.assertIn("progress", statuses)
+        self.assertIn("executing", statuses)
+        self.assertIn("preview", statuses)
+        preview = updates[statuses.index("preview")]
+        self.assertEqual(base64.b64decode(preview["image"]), b"\xff\xd8preview")
+
+        output = updates[statuses.index("output")]
+        self.assertEqual(output["node"], "9")
+        self.assertIn("base64", output["outputs"][0])
+
+        # The last item is the result, without the files that were already sent
+        result = updates[-1]
+        self.assertEqual(result["status"], "success")
+        self.assertNotIn("message", result)
+        streamed = result["outputs"]["9"][0]
+        self.assertTrue(streamed["streamed"])
+        self.assertNotIn("base64", streamed)
+        self.assertEqual(streamed["filename"], output["outputs"][0]["filename"])
+
+
+class TestWarmup(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        self.models_dir = self.create_temp_dir()
+        self.start_patches(
+            patch.dict(
+                rp_handler.WARMUP,
+                {"state": "disabled", "models": {}, "preload_ms": None, "total_ms": None},
+            ),
+            patch.dict(rp_handler.MODEL_FOLDER_CACHE, {"checkpoints": [self.models_dir]}),
+            patch.object(rp_handler, "WARMUP_THREAD", None),
+        )
+
+    def test_warmup_workflow_loads_the_model(self):
+        workflow = rp_handler.build_warmup_workflow("model.safetensors")
+
+        self.assertEqual(workflow["4"]["inputs"]["ckpt_name"], "model.safetensors")
+        self.assertEqual(workflow["3"]["inputs"]["steps"], 1)
+        self.assertEqual(workflow["5"]["inputs"]["width"], 64)
+        # The template stays unchanged
+        self.assertEqual(rp_handler.WARMUP_WORKFLOW["4"]["inputs"]["ckpt_name"], "")
+
+    def test_warmup_workflow_can_be_a_job_input(self):
+        with patch.object(rp_handler, "COMFY_WARMUP_WORKFLOW", "test_input.json"):
+            template = rp_handler.load_warmup_workflow()
+
+        workflow = rp_handler.build_warmup_workflow("model.safetensors", template)
+        self.assertEqual(workflow["9"]["class_type"], "SaveImage")
+        self.assertEqual(workflow["4"]["inputs"]["ckpt_name"], "model.safetensors")
+
+    def test_warmup_runs_one_prompt_per_model(self):
+        with FakeComfyUI(output_dir=self.output_dir) as server, patch.object(
+            rp_handler, "COMFY_HOST", server.address
+        ):
+            warmup = rp_handler.warm_up(["a.safetensors", "b.safetensors"])
+
+        self.assertEqual(warmup["state"], "done")
+        self.assertEqual(set(warmup["models"]), {"a.safetensors", "b.safetensors"})
+        self.assertFalse([m for m in warmup["models"].values() if "error" in m])
+        self.assertEqual(
+            sorted(p["prompt"]["4"]["inputs"]["ckpt_name"] for p in server.prompts.values()),
+            ["a.safetensors", "b.safetensors"],
+        )
+        self.assertIsNotNone(warmup["total_ms"])
+
+    def test_failed_warmup_does_not_block_the_worker(self):
+        with FakeComfyUI(output_dir=self.output_dir, fail_execution=True) as server, patch.object(
+            rp_handler, "COMFY_HOST", server.address
+        ):
+            warmup = rp_handler.warm_up(["a.safetensors"])
+
+        self.assertEqual(warmup["state"], "done")
+        self.assertIn("simulated failure", warmup["models"]["a.safetensors"]["error"])
+
+    def test_model_files_are_preloaded(self):
+        with open(os.path.join(self.models_dir, "a.safetensors"), "wb") as f:
+            f.write(b"\0" * 1024)
+
+        with patch.object(rp_handler, "COMFY_PRELOAD_MODELS", True), patch.object(
+            rp_handler, "preload_model_file", wraps=rp_handler.preload_model_file
+        ) as preload, patch.object(rp_handler, "warm_up_model", return_value=None), patch.object(
+            rp_handler, "ensure_comfy_available", return_value=True
+        ):
+            warmup = rp_handler.warm_up(["a.safetensors", "missing.safetensors"])
+
+        preload.assert_called_once_with(os.path.join(self.models_dir, "a.safetensors"))
+        self.assertIsNotNone(warmup["preload_ms"])
+        self.assertEqual(rp_handler.preload_model_file(preload.call_args.args[0]), 1024)
+
+    def test_jobs_wait_for_the_warmup(self):
+        with open("test_input.json") as f:
+            job = {"id": "job-1", "input": {**json.load(f)["input"], "metrics": True}}
+
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=0.3) as server, patch.object(
+            rp_handler, "COMFY_HOST", server.address
+        ), patch.object(rp_handler, "COMFY_WARMUP_MODELS", ["sd_xl_base_1.0.safetensors"]):
+            rp_handler.start_warmup()
+            server_ready = rp_handler.start_metrics_server()
+            try:
+                ready = rp_handler.requests.get(
+                    f"http://127.0.0.1:{server_ready.server_port}/ready"
+                )
+                result = rp_handler.handler(job)
+                ready_after = rp_handler.requests.get(
+                    f"http://127.0.0.1:{server_ready.server_port}/ready"
+                )
+            finally:
+                server_ready.shutdown()
+                server_ready.server_close()
+
+        self.assertEqual(ready.status_code, 503)
+        self.assertEqual(ready_after.status_code, 200)
+        self.assertEqual(result["status"], "success")
+        self.assertIn("sd_xl_base_1.0.safetensors", ready_after.json()["models"])
+        # The job only started after the warm-up prompt
+        self.assertGreaterEqual(result["metrics"]["stages"]["warmup"], 100)
+
+
+class TestBatching(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.create_output_dir()
+        self.start_patches(
+            patch.object(rp_handler, "COMFY_BATCH_WINDOW_MS", 1000),
+            patch.object(rp_handler, "BATCHER", rp_handler.WorkflowBatcher(1, 3)),
+        )
+        self.workflow = self.load_test_input()["workflow"]
+
+    def variant(self, text, seed):
+        workflow = json.loads(json.dumps(self.workflow))
+        workflow["6"]["inputs"]["text"] = text
+        workflow["3"]["inputs"]["seed"] = seed
+        return workflow
+
+    def run_jobs(self, server, workflows):
+        async def run_all():
+            first = asyncio.ensure_future(rp_handler.async_handler(jobs[0]))
+            # The other jobs arrive while the first one is running
+            await asyncio.sleep(0.1)
+            others = asyncio.gather(*(rp_handler.async_handler(job) for job in jobs[1:]))
+            return [await first] + list(await others)
+
+        jobs = [{"id": f"job-{i}", "input": {"workflow": w}} for i, w in enumerate(workflows)]
+        with patch.object(rp_handler, "COMFY_HOST", server.address), patch.object(
+            rp_handler, "COMFY_MAX_CONCURRENT_JOBS", len(jobs)
+        ), patch.object(rp_handler, "JOB_EXECUTOR", rp_handler.ThreadPoolExecutor(len(jobs))):
+            return asyncio.run(run_all())
+
+    def test_compatible_workflows_have_the_same_key(self):
+        key = rp_handler.batch_key(self.workflow)
+
+        self.assertEqual(rp_handler.batch_key(self.variant("a cat", 1)), key)
+        other_model = self.variant("a cat", 1)
+        other_model["4"]["inputs"]["ckpt_name"] = "other.safetensors"
+        self.assertNotEqual(rp_handler.batch_key(other_model), key)
+        other_size = self.variant("a cat", 1)
+        other_size["5"]["inputs"]["width"] = 1024
+        self.assertNotEqual(rp_handler.batch_key(other_size), key)
+
+    def test_merged_workflow_shares_the_same_nodes(self):
+        with patch.object(rp_handler, "get_object_info", return_value=OBJECT_INFO):
+            merged, mappings = rp_handler.merge_workflows(
+                [self.variant("a cat", 1), self.variant("a dog", 2)]
+            )
+
+        class_types = sorted(node["class_type"] for node in merged.values())
+        # One checkpoint loader, latent and negative prompt for both workflows
+        self.assertEqual(class_types.count("CheckpointLoaderSimple"), 1)
+        self.assertEqual(class_types.count("EmptyLatentImage"), 1)
+        self.assertEqual(class_types.count("CLIPTextEncode"), 3)
+        self.assertEqual(class_types.count("KSampler"), 2)
+        self.assertEqual(class_types.count("SaveImage"), 2)
+        self.assertEqual(mappings[0]["4"], mappings[1]["4"])
+        self.assertNotEqual(mappings[0]["9"], mappings[1]["9"])
+        self.assertEqual(merged[mappings[1]["3"]]["inputs"]["model"], [mappings[0]["4"], 0])
+        self.assertEqual(merged[mappings[1]["6"]]["inputs"]["text"], "a dog")
+
+    def test_jobs_that_arrive_while_comfyui_is_busy_are_batched(self):
+        workflows = [self.variant(f"prompt {i}", i) for i in range(3)]
+
+        with FakeComfyUI(output_dir=self.output_dir, inference_delay=0.3) as server:
+            results = self.run_jobs(server, workflows)
+
+        self.assertTrue(all(r["status"] == "success" for r in results))
+        # The first job runs alone, the others together in one prompt
+        self.assertEqual(len(server.prompts), 2)
+        merged = server.prompts[list(server.prompts)[1]]["prompt"]
+        self.assertEqual(len(merged), 11)
+        filenames = [r["outputs"]["9"][0]["filename"] for r in results]
+        self.assertEqual(len(set(filenames)), 3)
+        # Every job gets the output of its own workflow
+        for i in (1, 2):
+            index = filenames[i].split("_")[-3]
+            self.assertEqual(merged[f"{index}_6"]["inputs"]["text"], f"prompt {i}")
+
+    def test_batched_jobs_record_their_metrics(self):
+        workflows = [self.variant(f"prompt {i}", i) for i in range(3)]
+        stages = rp_handler.Histogram("stage_seconds", "stage", "stages")
+        nodes = rp_handler.Histogram("node_seconds", "class_type", "nodes")
+        jobs = {}
+
+        with patch.object(rp_handler, "COMFY_METRICS_LOG", False), patch.dict(
+            rp_handler.METRICS, {"jobs": jobs, "stages": stages, "nodes": nodes}
+        ), patch.object(rp_handler, "COMFY_RETURN_METRICS", True):
+            with FakeComfyUI(output_dir=self.output_dir, inference_delay=0.2) as server:
+                results = self.run_jobs(server, workflows)
+
+        self.assertEqual(len(server.prompts), 2)
+        for result in results:
+            metrics = result["metrics"]
+            for stage in ("queue", "wait", "comfy_queue"):
+                self.assertIn(stage, metrics["stages"])
+            # The nodes are reported with the IDs of the workflow of the job
+            self.assertEqual(metrics["nodes"]["3"]["class_type"], "KSampler")
+            self.assertGreaterEqual(metrics["nodes"]["3"]["ms"], 200)
+        self.assertIn("batch_window", results[1]["metrics"]["stages"])
+        self.assertEqual(jobs, {"success": 3})
+        self.assertEqual(nodes.series["KSampler"][2], 3)
+        self.assertEqual(stages.series["queue"][2], 3)
+
+    def test_failed_batch_runs_the_workflows_alone(self):
+        workflows = [self.variant(f"prompt {i}", i) for i in range(3)]
+
+        with FakeComfyUI(output_dir=self.output_dir, fail_execution=True) as server:
+            # Another batch is running, so all jobs wait for each other
+            rp_handler.BATCHER.running = 1
+            results = self.run_jobs(server, workflows)
+
+        self.assertTrue(all("simulated failure" in r["error"] for r in results))
+        # The batch and its three workflows alone
+        self.assertEqual(len(server.prompts), 4)
+
+
+class TestStartup(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.start_patches(
+            patch.dict(rp_handler.STARTUP, {"container_started": 100.0}, clear=True),
+            patch.object(rp_handler.time, "time", return_value=103.5),
+        )
+
+    def test_events_are_recorded_once(self):
+        rp_handler.record_startup("comfy_listening")
+        with patch.object(rp_handler.time, "time", return_value=110.0):
+            rp_handler.record_startup("comfy_listening")
+
+        self.assertEqual(
+            rp_handler.get_startup_timeline(), {"container_started": 0.0, "comfy_listening": 3.5}
+        )
+
+    def test_timeline_is_logged_with_the_first_job(self):
+        with patch("builtins.print") as mock_print:
+            rp_handler.handler({"id": "job-1", "input": {}})
+            rp_handler.handler({"id": "job-2", "input": {}})
+
+        logged = [
+            call.args[0] for call in mock_print.call_args_list if "startup" in call.args[0]
+        ]
+        self.assertEqual(
+            logged,
+            [
+                "runpod-worker-comfy - startup "
+                + json.dumps({"container_started": 0.0, "first_job_accepted": 3.5})
+            ],
+        )
+        self.assertIn(
+            'runpod_worker_comfy_startup_seconds{event="first_job_accepted"} 3.5',
+            rp_handler.render_metrics(),
+        )
+
+
+class TestBackends(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_dirs = [self.create_temp_dir(), self.create_temp_dir()]
+        self.input_dir = self.create_temp_dir()
+        self.start_patches(
+            patch.object(rp_handler, "COMFY_INPUT_PATH", self.input_dir),
+            patch.object(rp_handler, "COMFY_API_AVAILABLE_INTERVAL_MS", 10),
+        )
+        self.workflow = self.load_test_input()["workflow"]
+
+    def test_backend_with_the_least_jobs_is_selected(self):
+        backends = [rp_handler.ComfyBackend(f"127.0.0.1:{port}") for port in (1, 2)]
+
+        with patch.object(rp_handler, "BACKENDS", backends):
+            first = rp_handler.select_backend({})
+            second = rp_handler.select_backend({})
+            rp_handler.release_backend(first)
+            third = rp_handler.select_backend({})
+
+        self.assertEqual([first, second, third], [backends[0], backends[1], backends[0]])
+        self.assertEqual([b.outstanding for b in backends], [1, 1])
+
+    def test_backend_that_loaded_the_models_is_preferred(self):
+        backends = [rp_handler.ComfyBackend(f"127.0.0.1:{port}") for port in (1, 2)]
+        backends[1].models["sd_xl_base_1.0.safetensors"] = True
+
+        with patch.object(rp_handler, "BACKENDS", backends):
+            selected = rp_handler.select_backend(self.workflow)
+            # The affinity is worth one job, so the next job goes to the idle backend
+            other = rp_handler.select_backend({})
+
+        self.assertEqual(selected, backends[1])
+        self.assertEqual(other, backends[0])
+
+    def test_unhealthy_backend_is_skipped(self):
+        backends = [rp_handler.ComfyBackend(f"127.0.0.1:{port}") for port in (1, 2)]
+        backends[0].health.update(state="unhealthy", checked_at=time.monotonic())
+        backends[1].outstanding = 3
+
+        with patch.object(rp_handler, "BACKENDS", backends):
+            self.assertEqual(rp_handler.select_backend({}), backends[1])
+
+    def test_jobs_run_on_all_backends(self):
+        jobs = [{"id": f"job-{i}", "input": {"workflow": self.workflow}} for i in range(2)]
+
+        async def run_all():
+            return await asyncio.gather(*(rp_handler.async_handler(job) for job in jobs))
+
+        with FakeComfyUI(
+            output_dir=self.output_dirs[0], inference_delay=0.3
+        ) as first, FakeComfyUI(output_dir=self.output_dirs[1], inference_delay=0.3) as second:
+            backends = [
+                rp_handler.ComfyBackend(server.address, folder)
+                for server, folder in zip((first, second), self.output_dirs)
+            ]
+            with patch.object(rp_handler, "BACKENDS", backends), patch.object(
+                rp_handler, "COMFY_MAX_CONCURRENT_JOBS", 2
+            ), patch.object(rp_handler, "JOB_EXECUTOR", rp_handler.ThreadPoolExecutor(2)):
+                start = time.monotonic()
+                results = asyncio.run(run_all())
+                duration = time.monotonic() - start
+                metrics = rp_handler.render_metrics()
+
+        self.assertTrue(all(r["status"] == "success" for r in results))
+        self.assertEqual([first.requests["/prompt"], second.requests["/prompt"]], [1, 1])
+        # Both prompts ran at the same time instead of one after the other
+        self.assertLess(duration, 0.55)
+        self.assertEqual([b.outstanding for b in backends], [0, 0])
+        self.assertIn(f'runpod_worker_comfy_backend_jobs{{backend="{first.address}"}} 0', metrics)
+
+    def test_job_fails_over_to_an_available_backend(self):
+        with FakeComfyUI(output_dir=self.output_dirs[1]) as server:
+            backends = [
+                rp_handler.ComfyBackend("127.0.0.1:1", self.output_dirs[0]),
+                rp_handler.ComfyBackend(server.address, self.output_dirs[1]),
+            ]
+            # Checked long ago, so the backend is tried again
+            backends[0].health.update(state="unhealthy", checked_at=time.monotonic() - 60)
+            with patch.object(rp_handler, "BACKENDS", backends):
+                result = rp_handler.handler({"id": "job-1", "input": {"workflow": self.workflow}})
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(server.requests["/prompt"], 1)
+        self.assertEqual(backends[0].health["state"], "unhealthy")
+        self.assertEqual([b.outstanding for b in backends], [0, 0])
+
+
+class TestTemplates(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.templates_dir = self.create_temp_dir()
+        self.output_dir = self.create_output_dir()
+        shutil.copy("test_input.json", os.path.join(self.templates_dir, "sdxl.json"))
+        self.workflow = self.load_test_input()["workflow"]
+        broken = json.loads(json.dumps(self.workflow))
+        broken["8"]["inputs"]["samples"] = ["42", 0]
+        with open(os.path.join(self.templates_dir, "broken.json"), "w") as f:
+            json.dump(broken, f)
+        with open(os.path.join(self.templates_dir, "notes.txt"), "w") as f:
+            f.write("not a template")
+
+        self.templates = rp_handler.load_templates(f"/does/not/exist,{self.templates_dir}")
+        self.start_patches(
+            patch.object(rp_handler, "TEMPLATES", self.templates),
+            patch.object(rp_handler, "OBJECT_INFO", dict(OBJECT_INFO)),
+        )
+
+    def test_only_valid_templates_are_loaded(self):
+        self.assertEqual(list(self.templates), ["sdxl"])
+        self.assertEqual(self.templates["sdxl"].workflow, self.workflow)
+
+    def test_params_are_applied_to_a_copy(self):
+        validated_data, error = rp_handler.validate_input(
+            {"template": "sdxl", "params": {"6.text": "a red fox", "3.seed": 7}}
+        )
+
+        self.assertIsNone(error)
+        workflow = validated_data["workflow"]
+        template = self.templates["sdxl"]
+        self.assertEqual(workflow["6"]["inputs"]["text"], "a red fox")
+        self.assertEqual(workflow["3"]["inputs"]["seed"], 7)
+        self.assertEqual(template.workflow, self.workflow)
+        # The nodes without params are shared with the template
+        self.assertIs(workflow["7"], template.workflow["7"])
+        self.assertIs(validated_data["template"], template)
+
+    def test_invalid_template_input(self):
+        cases = [
+            ({"template": "missing"}, "Unknown template 'missing'"),
+            ({"template": ["sdxl"]}, "'template' must be the name of a template"),
+            ({"template": {"name": "sdxl"}}, "'template' must be the name of a template"),
+            (
+                {"template": "sdxl", "workflow": self.workflow},
+                "Provide either 'workflow' or 'template', not both",
+            ),
+            ({"template": "sdxl", "params": ["6.text"]}, "'params' must be an object"),
+            (
+                {"template": "sdxl", "params": {"42.text": "a"}},
+                "'params' refers to unknown node '42' in '42.text'",
+            ),
+            (
+                {"template": "sdxl", "params": {"6.txt": "a"}},
+                "'params' refers to unknown input 'txt' in '6.txt'",
+            ),
+        ]
+        for job_input, expected in cases:
+            with self.subTest(job_input=job_input):
+                self.assertEqual(rp_handler.validate_input(job_input), (None, expected))
+
+    def test_template_is_validated_once(self):
+        template = self.templates["sdxl"]
+        validate_workflow = rp_handler.validate_workflow
+
+        with patch.object(
+            rp_handler, "validate_workflow", side_effect=validate_workflow
+        ) as mock_validate:
+            for text in ("first", "second"):
+                workflow, _ = template.apply({"6.text": text})
+                self.assertEqual(template.validate(workflow), [])
+            self.assertEqual(mock_validate.call_count, 1)
+
+            # Another model or link has to be checked again
+            workflow, _ = template.apply({"4.ckpt_name": "missing.safetensors"})
+            template.validate(workflow)
+            workflow, _ = template.apply({"8.samples": ["42", 0]})
+            errors = template.validate(workflow)
+
+        self.assertEqual(mock_validate.call_count, 3)
+        self.assertEqual(errors[0]["message"], "input 'samples' is linked to missing node 42")
+
+    def test_job_with_template(self):
+        job = {"id": "job-1", "input": {"template": "sdxl", "params": {"6.text": "a red fox"}}}
+
+        with FakeComfyUI(output_dir=self.output_dir) as server, patch.object(
+            rp_handler, "COMFY_HOST", server.address
+        ):
+            result = rp_handler.handler(job)
+
+        self.assertEqual(result["status"], "success")
+        (prompt,) = server.prompts.values()
+        self.assertEqual(prompt["prompt"]["6"]["inputs"]["text"], "a red fox")
+        self.assertEqual(prompt["prompt"]["7"], self.workflow["7"])
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    """Serves the files of the ImageServer with an ETag, answers 304 when it matches"""
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        server.requests.append((path, self.headers.get("If-None-Match")))
+        time.sleep(server.delay)
+        if path not in server.files:
+            self.send_error(404)
+            return
+        content, etag = server.files[path]
+        if etag and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestImageUrls(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = self.create_temp_dir()
+        self.input_dir = self.create_temp_dir()
+        self.output_dir = self.create_output_dir()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageRequestHandler)
+        self.server.files = {}
+        self.server.requests = []
+        self.server.delay = 0.0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.start_patches(
+            patch.object(rp_handler, "COMFY_URL_CACHE_PATH", self.cache_dir),
+            patch.object(rp_handler, "COMFY_INPUT_PATH", self.input_dir),
+            patch.object(rp_handler, "COMFY_VALIDATE_WORKFLOW", False),
+            patch.object(rp_handler, "INPUT_CACHE", rp_handler.OrderedDict()),
+            patch.object(rp_handler, "INPUT_CACHE_NAMES", {}),
+        )
+        self.workflow = self.load_test_input()["workflow"]
+
+    def test_images_are_fetched_in_parallel(self):
+        self.server.delay = 0.3
+        self.server.files = {
+            "/a.png": (b"\x89PNG\r\n\x1a\nfirst", '"a1"'),
+            "/b.png": (b"\x89PNG\r\n\x1a\nsecond", '"b1"'),
+        }
+        job = {
+            "id": "job-1",
+            "input": {
+                "workflow": self.workflow,
+                "images": [
+                    {"name": "a.png", "url": f"{self.url}/a.png"},
+                    {"name": "b.png", "url": f"{self.url}/b.png?signature=secret"},
+                ],
+            },
+        }
+
+        with FakeComfyUI(output_dir=self.output_dir, input_dir=self.input_dir) as comfy:
+            with patch.object(rp_handler, "COMFY_HOST", comfy.address):
+                start = time.monotonic()
+                result = rp_handler.handler(job)
+                duration = time.monotonic() - start
+
+        self.assertEqual(result["status"], "success")
+        self.assertLess(duration, 0.55)
+        uploads = {os.path.basename(name): content for name, content in comfy.uploads.items()}
+        self.assertEqual(
+            uploads,
+            {"a.png": b"\x89PNG\r\n\x1a\nfirst", "b.png": b"\x89PNG\r\n\x1a\nsecond"},
+        )
+
+    def test_cached_image_is_revalidated_with_its_etag(self):
+        self.server.files = {"/a.png": (b"first", '"v1"')}
+        url = f"{self.url}/a.png"
+
+        first, error = rp_handler.fetch_image_url(url)
+        self.assertIsNone(error)
+        second, _ = rp_handler.fetch_image_url(url)
+        self.server.files = {"/a.png": (b"changed", '"v2"')}
+        third, _ = rp_handler.fetch_image_url(url)
+
+        self.assertEqual(
+            self.server.requests, [("/a.png", None), ("/a.png", '"v1"'), ("/a.png", '"v1"')]
+        )
+        self.assertEqual(first["path"], second["path"])
+        self.assertEqual(second["sha256"], hashlib.sha256(b"first").hexdigest())
+        self.assertEqual(third["sha256"], hashlib.sha256(b"changed").hexdigest())
+        with open(third["path"], "rb") as f:
+            self.assertEqual(f.read(), b"changed")
+
+    def test_image_without_etag_is_not_cached(self):
+        self.server.files = {"/a.png": (b"content", None)}
+
+        image, error = rp_handler.fetch_image_url(f"{self.url}/a.png")
+
+        self.assertIsNone(error)
+        self.assertTrue(image["temporary"])
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(image["path"])])
+
+    def test_fetch_errors(self):
+        self.server.files = {"/large.png": (b"x" * (1024 * 1024 + 1), '"l"')}
+        with patch.object(rp_handler, "COMFY_URL_MAX_MB", 1):
+            _, too_large = rp_handler.fetch_image_url(f"{self.url}/large.png")
+        _, missing = rp_handler.fetch_image_url(f"{self.url}/missing.png?token=secret")
+        self.server.delay = 1.0
+        with patch.object(rp_handler, "COMFY_URL_TIMEOUT_S", 0.2):
+            _, timeout = rp_handler.fetch_image_url(f"{self.url}/large.png")
+
+        self.assertEqual(too_large, f"{self.url}/large.png is larger than 1 MB")
+        self.assertIn("404", missing)
+        self.assertNotIn("secret", missing)
+        self.assertIn("timed out", timeout)
+        # No partial downloads are left behind
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_least_recently_used_images_are_evicted(self):
+        cache = rp_handler.UrlCache(self.cache_dir, 10)
+        paths = []
+        for i in range(3):
+            temporary = os.path.join(self.cache_dir, f".{i}.tmp")
+            with open(temporary, "wb") as f:
+                f.write(b"12345")
+            paths.append(cache.put(f"{self.url}/{i}", temporary, {"size": 5})["path"])
+            # The modification time marks the use of an entry
+            os.utime(paths[-1], (i, i))
+        cache.evict()
+
+        self.assertIsNone(cache.get(f"{self.url}/0"))
+        self.assertEqual(cache.get(f"{self.url}/2")["path"], paths[2])
+        names = [os.path.basename(path) for path in paths[1:]]
+        self.assertEqual(
+            sorted(os.listdir(self.cache_dir)), sorted(names + [f"{n}.json" for n in names])
+        )
+
+    def test_invalid_url(self):
+        _, error = rp_handler.validate_input(
+            {"workflow": {}, "images": [{"name": "a.png", "url": "file:///etc/passwd"}]}
+        )
+
+        self.assertEqual(error, "'url' of image 'a.png' must be http(s):// or s3://")
+
+    @unittest.skipIf(mock_aws is None, "moto is not installed")
+    def test_image_from_s3(self):
+        with mock_aws(), patch.dict(
+            os.environ,
+            {
+                "BUCKET_ENDPOINT_URL": "https://s3.us-east-1.amazonaws.com",
+                "BUCKET_ACCESS_KEY_ID": "testing",
+                "BUCKET_SECRET_ACCESS_KEY": "testing",
+            },
+        ):
+            rp_handler.S3_CLIENT.clear()
+            client = boto3.client("s3", region_name="us-east-1")
+            client.create_bucket(Bucket="inputs")
+            client.put_object(Bucket="inputs", Key="images/a.png", Body=b"content")
+
+            first, error = rp_handler.fetch_image_url("s3://inputs/images/a.png")
+            second, _ = rp_handler.fetch_image_url("s3://inputs/images/a.png")
+            rp_handler.S3_CLIENT.clear()
+
+        self.assertIsNone(error)
+        self.assertEqual(first["sha256"], hashlib.sha256(b"content").hexdigest())
+        self.assertEqual(second["path"], first["path"])